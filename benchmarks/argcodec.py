@@ -0,0 +1,61 @@
+#!/usr/bin/python
+
+"""
+argcodec.py
+
+Benchmark for parsing the repr() encoded arguments of the remote helper
+protocol and the event logs, see dtester.utils.parseArgs. Generates a mix
+of typical messages, with text and binary process output, and reports
+the number of lines parsed per second.
+
+Copyright (c) 2016 Markus Wanner
+
+Distributed under the Boost Software License, Version 1.0. (See
+accompanying file LICENSE).
+"""
+
+import sys, time, random
+
+from dtester.utils import parseArgs, formatArgs
+
+
+def generateLines(count):
+    rnd = random.Random(42)
+    lines = []
+    for i in range(count):
+        kind = rnd.randrange(4)
+        if kind == 0:
+            args = [i, "LOG:  database system is ready to accept " +
+                    "connections (pid %d)\n" % rnd.randrange(32768)]
+        elif kind == 1:
+            args = [i, "".join([chr(rnd.randrange(256))
+                                for j in range(rnd.randrange(200))])]
+        elif kind == 2:
+            args = [i, rnd.randrange(1000), "it's a \"quoted\" line\n"]
+        else:
+            args = [i, rnd.random() * 1000, 0, 7968, 4, 1, 160, 8]
+        lines.append(formatArgs(args))
+    return lines
+
+
+def main(count):
+    lines = generateLines(count)
+    size = sum([len(line) for line in lines])
+
+    errors = []
+    t = time.time()
+    for line in lines:
+        parseArgs(line, errors.append)
+    elapsed = time.time() - t
+
+    assert len(errors) == 0, errors[0]
+    print "%d lines (%.1f MB) in %.2fs: %.0f lines/s, %.1f MB/s" % (
+        count, size / 1024.0 / 1024.0, elapsed, count / elapsed,
+        size / elapsed / 1024.0 / 1024.0)
+
+
+if __name__ == "__main__":
+    count = 200000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    main(count)
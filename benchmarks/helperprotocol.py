@@ -0,0 +1,103 @@
+#!/usr/bin/python
+
+"""
+helperprotocol.py
+
+Benchmark for the throughput of the remote helper protocol, comparing the
+text protocol with the binary one. Runs remhelper.py locally, connected
+via a pair of pipes, and appends 64 MB (or the given amount of MB) of
+random binary data to a file, in chunks of 4 KB.
+
+Copyright (c) 2016 Markus Wanner
+
+Distributed under the Boost Software License, Version 1.0. (See
+accompanying file LICENSE).
+"""
+
+import os, sys, time, shutil, tempfile, threading, subprocess
+
+from dtester.utils import parseArgs, formatArgs, encodeFrame, \
+    FrameDecoder, BINARY_PROTOCOL
+
+CHUNK_SIZE = 4096
+
+HELPER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           os.pardir, "remhelper.py")
+
+
+class Replies(threading.Thread):
+    """ Reads the helper's replies, counting the 'done' ones.
+    """
+    def __init__(self, fd, expected):
+        threading.Thread.__init__(self)
+        self.fd = fd
+        self.expected = expected
+        self.decoder = None
+        self.done = 0
+
+    def run(self):
+        while self.done < self.expected:
+            if self.decoder:
+                data = os.read(self.fd.fileno(), 65536)
+                assert len(data) > 0, "helper terminated"
+                replies = self.decoder.feed(data)
+            else:
+                line = self.fd.readline()
+                assert len(line) > 0, "helper terminated"
+                cmd, rest = (line.rstrip("\n") + " ").split(" ", 1)
+                replies = [(cmd, parseArgs(rest, sys.stderr.write))]
+            for cmd, args in replies:
+                if cmd == 'protocol':
+                    # the rest of the output is binary
+                    self.decoder = FrameDecoder()
+                elif cmd == 'done':
+                    self.done += 1
+                elif cmd != 'hello':
+                    raise Exception("unexpected reply: %s %s" % (cmd, args))
+
+
+def measure(size_mb, binary):
+    count = size_mb * 1024 * 1024 / CHUNK_SIZE
+    chunks = [os.urandom(CHUNK_SIZE) for i in range(16)]
+
+    workdir = os.path.join(tempfile.mkdtemp(), "work")
+    helper = subprocess.Popen([sys.executable, HELPER_PATH],
+                              stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    replies = Replies(helper.stdout, count + 1)
+    replies.start()
+
+    if binary:
+        helper.stdin.write("use_protocol 0 %s\n" % repr(BINARY_PROTOCOL))
+        request = lambda cmd, *args: encodeFrame(cmd, args)
+    else:
+        request = lambda cmd, *args: "%s %s\n" % (cmd, formatArgs(args))
+
+    t = time.time()
+    helper.stdin.write(request("set_work_dir", 1, workdir))
+    path = os.path.join(workdir, "data")
+    for i in range(count):
+        helper.stdin.write(request("append", i + 2, path,
+                                   chunks[i % len(chunks)]))
+    helper.stdin.flush()
+    replies.join()
+    elapsed = time.time() - t
+
+    helper.stdin.close()
+    helper.wait()
+    assert os.path.getsize(path) == count * CHUNK_SIZE
+    shutil.rmtree(os.path.dirname(workdir))
+    return elapsed, count * CHUNK_SIZE
+
+
+def main(size_mb):
+    for mode, binary in (("text", False), ("binary", True)):
+        elapsed, size = measure(size_mb, binary)
+        print "%-7s %8.2fs %8.1f MB/s" % (
+            mode, elapsed, size / elapsed / 1024.0 / 1024.0)
+
+
+if __name__ == "__main__":
+    size_mb = 64
+    if len(sys.argv) > 1:
+        size_mb = int(sys.argv[1])
+    main(size_mb)
@@ -0,0 +1,75 @@
+#!/usr/bin/python
+
+"""
+linesplit.py
+
+Micro-benchmark for splitting process output into lines, comparing the
+incremental LineSplitter against naive re-splitting of the whole buffer
+upon every chunk received.
+
+Copyright (c) 2016 Markus Wanner
+
+Distributed under the Boost Software License, Version 1.0. (See
+accompanying file LICENSE).
+"""
+
+import sys, time
+
+from dtester.processes import LineSplitter
+
+CHUNK_SIZE = 4096
+
+
+class NaiveSplitter:
+    """ The previous approach of SimpleProcessLineBasedProtocol.
+    """
+    def __init__(self, emit):
+        self.emit = emit
+        self.buffer = ""
+
+    def feed(self, data):
+        self.buffer += data
+        lines = self.buffer.split("\n")
+        for line in lines[:-1]:
+            self.emit(line + "\n")
+        self.buffer = lines[-1]
+
+
+def chunks(line_length, total_size):
+    line = "x" * (line_length - 1) + "\n"
+    data = line * max(1, total_size / line_length)
+    for offset in xrange(0, len(data), CHUNK_SIZE):
+        yield data[offset:offset + CHUNK_SIZE]
+
+
+def measure(splitter_factory, line_length, total_size):
+    count = [0]
+    def emit(line):
+        count[0] += 1
+    splitter = splitter_factory(emit)
+    data = list(chunks(line_length, total_size))
+    t = time.time()
+    for chunk in data:
+        splitter.feed(chunk)
+    return time.time() - t, count[0]
+
+
+def main(args):
+    total_size = 10 * 1024 * 1024
+    if len(args) > 0:
+        total_size = int(args[0]) * 1024 * 1024
+
+    candidates = (
+        ('naive', NaiveSplitter),
+        ('incremental', lambda emit: LineSplitter(emit)),
+    )
+    for line_length in (1024, total_size):
+        for name, factory in candidates:
+            t_diff, count = measure(factory, line_length, total_size)
+            print "%-12s %9d byte lines: %6d lines in %0.3f seconds " \
+                  "(%0.1f MB/s)" % (name, line_length, count, t_diff,
+                                    total_size / t_diff / 1024 / 1024)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
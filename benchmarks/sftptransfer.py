@@ -0,0 +1,227 @@
+#!/usr/bin/python
+
+"""
+sftptransfer.py
+
+Benchmark for SFTP file transfers, comparing the former 8 KB stop-and-wait
+chunking with pipelined requests. Runs an in-process Twisted conch server
+on the loopback interface, serving local files, then uploads and downloads
+a file of 64 MB (or the given amount of MB) of random data. An artificial
+delay per request (in ms, the second argument) simulates the round trip
+time of a remote network.
+
+Copyright (c) 2016 Markus Wanner
+
+Distributed under the Boost Software License, Version 1.0. (See
+accompanying file LICENSE).
+"""
+
+import os, sys, time, shutil, tempfile
+
+from zope.interface import implements
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from twisted.conch import avatar
+from twisted.conch.ssh import factory, keys, session, filetransfer, \
+    userauth, transport
+from twisted.cred import portal, checkers
+from twisted.internet import reactor, defer, protocol, task
+from twisted.python import components
+
+from dtester.net.ssh import SimpleSSHTransport, SimpleSSHConnection
+
+USER = "bench"
+PASSWORD = "bench"
+
+# settings of the former implementation: (chunk size, window)
+STOP_AND_WAIT = (8192, 1)
+PIPELINED = (65536, 16)
+
+
+class BenchAvatar(avatar.ConchUser):
+
+    def __init__(self, username):
+        avatar.ConchUser.__init__(self)
+        self.username = username
+        self.channelLookup['session'] = session.SSHSession
+        self.subsystemLookup['sftp'] = filetransfer.FileTransferServer
+
+
+class BenchRealm:
+    implements(portal.IRealm)
+
+    def requestAvatar(self, avatarId, mind, *interfaces):
+        return interfaces[0], BenchAvatar(avatarId), lambda: None
+
+
+class BenchFile:
+    """ A local file served via SFTP, answering each request after the
+        configured delay.
+    """
+    implements(filetransfer.ISFTPFile)
+
+    def __init__(self, path, flags):
+        if flags & filetransfer.FXF_WRITE:
+            self.fd = open(path, 'w')
+        else:
+            self.fd = open(path, 'r')
+
+    def delayed(self, fn, *args):
+        return task.deferLater(reactor, SERVER_DELAY, fn, *args)
+
+    def readChunk(self, offset, length):
+        return self.delayed(self.doRead, offset, length)
+
+    def doRead(self, offset, length):
+        self.fd.seek(offset)
+        data = self.fd.read(length)
+        if len(data) == 0:
+            raise EOFError()
+        return data
+
+    def writeChunk(self, offset, data):
+        return self.delayed(self.doWrite, offset, data)
+
+    def doWrite(self, offset, data):
+        self.fd.seek(offset)
+        self.fd.write(data)
+
+    def close(self):
+        self.fd.close()
+
+    def getAttrs(self):
+        return {}
+
+    def setAttrs(self, attrs):
+        pass
+
+
+class BenchSFTPServer:
+    """ Just enough of an SFTP server to open, read and write files.
+    """
+    implements(filetransfer.ISFTPServer)
+
+    def __init__(self, avatar):
+        self.avatar = avatar
+
+    def gotVersion(self, otherVersion, extData):
+        return {}
+
+    def openFile(self, filename, flags, attrs):
+        return BenchFile(filename, flags)
+
+components.registerAdapter(BenchSFTPServer, BenchAvatar,
+                           filetransfer.ISFTPServer)
+
+# delay in seconds per SFTP request, set by main()
+SERVER_DELAY = 0.0
+
+
+class BenchUserAuth(userauth.SSHUserAuthClient):
+
+    def getPassword(self, prompt=None):
+        return defer.succeed(PASSWORD)
+
+
+class BenchClient(SimpleSSHTransport):
+    """ A L{SimpleSSHTransport} authenticating with a password and firing
+        the factory's deferred once the connection is usable.
+    """
+    def connectionSecure(self):
+        self.conn = SimpleSSHConnection(self)
+        self.requestService(BenchUserAuth(USER, self.conn))
+
+    def sshServiceStarted(self):
+        self.factory.ready.callback(self)
+
+    def connectionLost(self, reason):
+        transport.SSHClientTransport.connectionLost(self, reason)
+
+
+class BenchRunner:
+
+    def log(self, msg):
+        sys.stderr.write(msg + "\n")
+
+
+def makeServerFactory():
+    key = keys.Key(rsa.generate_private_key(public_exponent=65537,
+                                            key_size=2048,
+                                            backend=default_backend()))
+    checker = checkers.InMemoryUsernamePasswordDatabaseDontUse()
+    checker.addUser(USER, PASSWORD)
+
+    serverFactory = factory.SSHFactory()
+    serverFactory.publicKeys = {'ssh-rsa': key.public()}
+    serverFactory.privateKeys = {'ssh-rsa': key}
+    serverFactory.portal = portal.Portal(BenchRealm(), [checker])
+    return serverFactory
+
+
+@defer.inlineCallbacks
+def measure(client, srcPath, destPath, chunkSize, window):
+    client.sftpChunkSize = chunkSize
+    client.sftpWindow = window
+
+    t = time.time()
+    yield client.uploadFile(srcPath, destPath)
+    upload = time.time() - t
+
+    t = time.time()
+    yield client.downloadFile(destPath, srcPath + ".back")
+    download = time.time() - t
+
+    defer.returnValue((upload, download))
+
+
+@defer.inlineCallbacks
+def run(size_mb):
+    workdir = tempfile.mkdtemp()
+    srcPath = os.path.join(workdir, "source")
+    destPath = os.path.join(workdir, "dest")
+    data = os.urandom(1024 * 1024)
+    fd = open(srcPath, 'w')
+    for i in range(size_mb):
+        fd.write(data)
+    fd.close()
+    size = size_mb * 1024 * 1024
+
+    port = reactor.listenTCP(0, makeServerFactory(), interface="127.0.0.1")
+    clientFactory = protocol.ClientFactory()
+    clientFactory.protocol = BenchClient
+    clientFactory.runner = BenchRunner()
+    clientFactory.ready = defer.Deferred()
+    reactor.connectTCP("127.0.0.1", port.getHost().port, clientFactory)
+    client = yield clientFactory.ready
+
+    try:
+        for mode, (chunkSize, window) in (("stop-and-wait", STOP_AND_WAIT),
+                                          ("pipelined", PIPELINED)):
+            upload, download = yield measure(client, srcPath, destPath,
+                                             chunkSize, window)
+            assert os.path.getsize(srcPath + ".back") == size
+            print "%-14s upload %8.1f MB/s   download %8.1f MB/s" % (
+                mode, size / upload / 1024.0 / 1024.0,
+                size / download / 1024.0 / 1024.0)
+    finally:
+        client.transport.loseConnection()
+        yield port.stopListening()
+        shutil.rmtree(workdir)
+
+
+def main(size_mb):
+    d = run(size_mb)
+    d.addErrback(lambda failure: failure.printTraceback())
+    d.addBoth(lambda result: reactor.stop())
+    reactor.run()
+
+
+if __name__ == "__main__":
+    size_mb = 64
+    if len(sys.argv) > 1:
+        size_mb = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        SERVER_DELAY = float(sys.argv[2]) / 1000.0
+    main(size_mb)
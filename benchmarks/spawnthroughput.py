@@ -0,0 +1,66 @@
+#!/usr/bin/python
+
+"""
+spawnthroughput.py
+
+Benchmark for the output throughput of local processes, comparing
+processes spawned in a pseudo terminal with ones connected via plain
+pipes. The process writes 1 GB (or the given amount of MB) to its
+standard output, which is received as ProcessOutStreamEvents.
+
+Copyright (c) 2016 Markus Wanner
+
+Distributed under the Boost Software License, Version 1.0. (See
+accompanying file LICENSE).
+"""
+
+import sys, time
+
+from twisted.internet import reactor, defer
+
+from dtester.events import EventMatcher, ProcessOutStreamEvent
+from dtester.processes import SimpleProcess
+
+BLOCK_SIZE = 65536
+
+
+def measure(size_mb, usePTY):
+    count = (size_mb * 1024 * 1024) / BLOCK_SIZE
+    args = ['dd', 'if=/dev/zero', 'bs=%d' % BLOCK_SIZE,
+            'count=%d' % count]
+    proc = SimpleProcess('bench', 'dd', 'dd', '/tmp', args=args,
+                         lineBasedOutput=False, usePTY=usePTY)
+
+    received = [0, 0]
+    def countData(event):
+        received[0] += len(event.data)
+        received[1] += 1
+    proc.addHook(EventMatcher(ProcessOutStreamEvent), countData)
+
+    t = time.time()
+    d = proc.getTerminationDeferred()
+    d.addCallback(lambda exitCode: (time.time() - t, received[0],
+                                    received[1]))
+    proc.start()
+    proc.closeStdin()
+    return d
+
+
+@defer.inlineCallbacks
+def main(size_mb):
+    try:
+        for mode, usePTY in (("pty", True), ("pipe", False)):
+            elapsed, size, chunks = yield measure(size_mb, usePTY)
+            print "%-5s %8.2fs %8.1f MB/s %9d bytes %7d chunks" % (
+                mode, elapsed, size / elapsed / 1024.0 / 1024.0,
+                size, chunks)
+    finally:
+        reactor.stop()
+
+
+if __name__ == "__main__":
+    size_mb = 1024
+    if len(sys.argv) > 1:
+        size_mb = int(sys.argv[1])
+    reactor.callWhenRunning(main, size_mb)
+    reactor.run()
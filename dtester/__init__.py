@@ -6,6 +6,7 @@
 """
 
 import basics
+import compilation
 import db
 import events
 import exceptions
@@ -40,4 +41,51 @@ test_def = {
     'timeout':            {'class': dtests.TimeoutTest},
     'var_need':           {'class': dtests.VariableNeeds},
     'resource':           {'class': dtests.ResourceTest},
+    'composite_matcher':  {'class': dtests.CompositeMatcherTest},
+    'flow_control':       {'class': dtests.FlowControlTest},
+    'line_splitter':      {'class': dtests.LineSplitterTest},
+    'environment':        {'class': dtests.EnvironmentTest},
+    'resource_usage':     {'class': dtests.ResourceUsageTest},
+    'output_mode':        {'class': dtests.OutputModeTest},
+    'stdin_feed':         {'class': dtests.StdinFeedTest},
+    'stop_schedule':      {'class': dtests.StopScheduleTest},
+    'launcher':           {'class': dtests.LauncherTest},
+    'event_log':          {'class': dtests.EventLogTest},
+    'event_log_merge':    {'class': dtests.EventLogMergeTest},
+    'event_log_stream':   {'class': dtests.EventLogStreamTest},
+    'file_handle_cache':  {'class': dtests.FileHandleCacheTest},
+    'arg_codec':          {'class': dtests.ArgCodecTest},
+    'frame_codec':        {'class': dtests.FrameCodecTest},
+    'command_pipeline':   {'class': dtests.CommandPipelineTest},
+    'chunked_transfer':   {'class': dtests.ChunkedTransferTest},
+    'event_store':        {'class': dtests.EventStoreTest},
+    'tail_server':        {'class': dtests.TailServerTest},
+    'localhost':          {'class': runner.Localhost,
+                           'args': ('tmp/localhost',)},
+    'process_group':      {'class': dtests.ProcessGroupTest,
+                           'uses': ('localhost',)},
+    'ignore_rules':       {'class': dtests.IgnoreRulesTest},
+    'tree_src':           {'class': basics.Directory,
+                           'uses': ('localhost',),
+                           'args': ('dtester',)},
+    'tree_copy':          {'class': compilation.RemoteWorkingTreeCopy,
+                           'uses': ('tree_src', 'localhost'),
+                           'args': ('tree',)},
+    'tree_transfer':      {'class': dtests.TreeTransferTest,
+                           'uses': ('tree_src', 'tree_copy')},
+    'tree_archive':       {'class': dtests.ArchiveTreeCopy,
+                           'uses': ('tree_src', 'localhost'),
+                           'args': ('tree',)},
+    'archive_transfer':   {'class': dtests.TreeTransferTest,
+                           'uses': ('tree_src', 'tree_archive')},
+    'tree_cached':        {'class': dtests.CachedTreeCopy,
+                           'uses': ('tree_src', 'localhost'),
+                           'args': ('tree',)},
+    'cached_transfer':    {'class': dtests.TreeTransferTest,
+                           'uses': ('tree_src', 'tree_cached')},
+    'tree_locked_cache':  {'class': dtests.LockedCacheTreeCopy,
+                           'uses': ('tree_src', 'localhost'),
+                           'args': ('tree',)},
+    'locked_cache_transfer': {'class': dtests.TreeTransferTest,
+                           'uses': ('tree_src', 'tree_locked_cache')},
 }
@@ -69,10 +69,11 @@ class PreparationProcessMixin:
     """ A mixin for TestSuites which require a single process to run in
         preparation (i.e. during setUp).
     """
-    def runProcess(self, host, name, cmdline, cwd=None, lineBasedOutput=True, ignoreOutput=False):
+    def runProcess(self, host, name, cmdline, cwd=None, lineBasedOutput=True,
+                   ignoreOutput=False, usePTY=False):
         proc, d = host.prepareProcess(self.test_name + "." + name, cmdline,
                                       cwd=cwd, lineBasedOutput=lineBasedOutput,
-                                      ignoreOutput=ignoreOutput)
+                                      ignoreOutput=ignoreOutput, usePTY=usePTY)
         d.addCallback(self.expectExitCode, 0, self.description)
         self.processSettings(proc)
         reactor.callLater(0.0, self.startProcess, proc, d)
@@ -89,6 +90,27 @@ class PreparationProcessMixin:
         pass
 
 
+class ProcessGroupMixin:
+    """ A mixin for controlled hosts, preparing a group of processes from
+        their specifications via the host's prepareProcess, see
+        L{IControlledHost.prepareProcesses}.
+    """
+    def prepareProcesses(self, specs):
+        procs = []
+        ds = []
+        for spec in specs:
+            spec = dict(spec)
+            name = spec.pop('name')
+            cmdline = spec.pop('cmdline')
+            env = spec.pop('env', {})
+            proc, d = self.prepareProcess(name, cmdline, **spec)
+            for key, value in env.iteritems():
+                proc.addEnvVar(key, value)
+            procs.append(proc)
+            ds.append(d)
+        return procs, defer.gatherResults(ds)
+
+
 class ControllableHost(TestSuite):
     """ A manually configured controllable host.
     """
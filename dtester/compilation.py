@@ -9,6 +9,8 @@
 Basic classes for compiling, building and installing software.
 """
 
+import time, collections
+
 from twisted.internet import defer
 
 from zope.interface import implements
@@ -16,6 +18,7 @@ from zope.interface import implements
 from dtester.interfaces import IControlledHost, IDirectory
 from dtester.test import TestSuite
 from dtester.basics import Directory, PreparationProcessMixin
+from dtester.utils import ignoreNames
 
 
 class WorkingTreeCopy(Directory):
@@ -64,13 +67,56 @@ class RemoteWorkingTreeCopy(TestSuite):
              ('dest_host', IControlledHost))
     args = (('dest_prefix', str),)
 
+    # Maximum number of files transferred concurrently, matching the
+    # default size of the SFTP client pool of remote hosts.
+    maxConcurrentTransfers = 4
+
+    # Minimum interval between progress updates, in seconds.
+    progressInterval = 0.5
+
+    # Whether to transfer the tree as a single tar archive stream, rather
+    # than file by file, and whether to compress that archive.
+    useArchive = False
+    compressArchive = False
+
+    # Names of files and directories not to transfer, including all
+    # contents of such directories, in either mode: VCS book-keeping and
+    # backup files.
+    ignorePattern = ".git;_MTN;*~;*.bak;.gitignore"
+
+    # Whether to keep a copy of the tree in a cache on the destination
+    # host, transferring only new or changed files to that cache and
+    # hard linking the working tree from there. The cache defaults to a
+    # directory named by the dest_prefix within the host's cache dir. As
+    # other runs may use the same cache, it's locked while updating and
+    # linking. If locked by another run, the tree gets transferred
+    # without the cache.
+    useCache = False
+    cachePath = None
+
     def postInit(self):
         self.src_host = self.src.getHost()
         self.src_path = self.src.getPath()
+        self.ignoredName = ignoreNames(self.ignorePattern)
+
+        self.pendingFiles = collections.deque()
+        self.filesTotal = 0
+        self.bytesTotal = 0
+        self.filesDone = 0
+        self.bytesDone = 0
+        self.transferStart = None
+        self.lastProgress = 0.0
 
     def setUpDescription(self):
-        return "transferring working tree to %s" % (
+        desc = "transferring working tree to %s" % (
             self.dest_host.getHostName(),)
+        if self.transferStart is not None:
+            elapsed = max(time.time() - self.transferStart, 0.001)
+            desc += ": %d of %d files, %.1f of %.1f MiB, %.0f files/s" % (
+                self.filesDone, self.filesTotal,
+                self.bytesDone / 1048576.0, self.bytesTotal / 1048576.0,
+                self.filesDone / elapsed)
+        return desc
 
     def tearDownDescription(self):
         return "removing working tree from %s" % (
@@ -79,36 +125,201 @@ class RemoteWorkingTreeCopy(TestSuite):
     def setUp(self):
         self.dest_path = self.dest_host.getTempDir(self.dest_prefix)
 
+        # files are transferred to the cache instead, if any
+        self.transfer_path = self.dest_path
+
         d = defer.maybeDeferred(self.dest_host.makeDirectory, self.dest_path)
-        d.addCallback(self.listFilesOnSrcHost)
+        if self.useArchive:
+            d.addCallback(self.transferArchive)
+        elif self.useCache:
+            d.addCallback(self.prepareCache)
+            d.addCallback(self.lockCache)
+        else:
+            d.addCallback(self.listFilesOnSrcHost)
+            d.addCallback(self.transferFiles)
+        return d
+
+    def transferArchive(self, result):
+        sink = self.dest_host.receiveTree(self.dest_path, self.compressArchive)
+        d = defer.maybeDeferred(self.src_host.sendTree, self.src_path, sink,
+                                self.ignorePattern, self.compressArchive)
+        d.addCallback(lambda ign: sink.close())
+        return d
+
+    def prepareCache(self, result):
+        self.transfer_path = self.cachePath
+        if self.transfer_path is None:
+            self.transfer_path = self.dest_host.joinPath(
+                self.dest_host.getCacheDir(), self.dest_prefix)
+
+        # the cache most likely exists already
+        d = defer.maybeDeferred(self.dest_host.makeDirectory,
+                                self.transfer_path)
+        d.addErrback(lambda failure: None)
+        return d
+
+    def lockCache(self, result):
+        d = defer.maybeDeferred(self.dest_host.lockDirectory,
+                                self.transfer_path)
+        d.addCallbacks(self.transferViaCache, self.transferWithoutCache)
+        return d
+
+    def transferViaCache(self, result):
+        d = self.listFilesOnBothHosts(None)
+        d.addCallback(self.updateCache)
+        d.addCallback(lambda ign: self.dest_host.linkTree(
+            self.transfer_path, self.dest_path))
+        d.addBoth(self.unlockCache)
+        return d
+
+    def unlockCache(self, result):
+        d = defer.maybeDeferred(self.dest_host.unlockDirectory,
+                                self.transfer_path)
+        d.addCallback(lambda ign: result)
+        return d
+
+    def transferWithoutCache(self, failure):
+        self.runner.log("not using the cache %s on %s: %s" % (
+            self.transfer_path, self.dest_host.getHostName(),
+            failure.getErrorMessage()))
+        self.transfer_path = self.dest_path
+        d = self.listFilesOnSrcHost(None)
         d.addCallback(self.transferFiles)
         return d
 
+    def listFilesOnBothHosts(self, result):
+        return defer.gatherResults([
+            defer.maybeDeferred(self.src_host.recursiveList, self.src_path),
+            defer.maybeDeferred(self.dest_host.recursiveList,
+                                self.transfer_path)], consumeErrors=True)
+
+    def updateCache(self, lists):
+        file_list, cache_list = lists
+        cached = {}
+        for (etype, path, atime, mtime, ctime, size) in cache_list:
+            cached[path] = (etype, mtime, size)
+
+        # Compare the source tree against the cache, by type, size and
+        # modification time.
+        changed = []
+        outdated = []
+        for entry in file_list:
+            etype, path, atime, mtime, ctime, size = entry
+            if self.isIgnored(path):
+                continue
+            cached_entry = cached.pop(path, None)
+            if cached_entry is None:
+                changed.append(entry)
+            elif cached_entry[0] != etype or (etype == 'file' and (
+                    cached_entry[2] != size or
+                    abs(cached_entry[1] - mtime) > 0.001)):
+                # Removing rather than overwriting changed files leaves
+                # alone the trees linked to them.
+                outdated.append(path)
+                changed.append(entry)
+
+        # everything left in the cache is gone from the source tree
+        outdated.extend(cached.keys())
+
+        ds = []
+        for path in sorted(outdated):
+            ds.append(defer.maybeDeferred(self.dest_host.recursiveRemove,
+                self.dest_host.joinPath(self.transfer_path, path)))
+        d = defer.gatherResults(ds, consumeErrors=True)
+        d.addCallback(lambda ign: self.transferFiles(changed))
+        return d
+
     def listFilesOnSrcHost(self, result):
         return defer.maybeDeferred(self.src_host.recursiveList, self.src_path)
 
+    def isIgnored(self, path):
+        # Applies the ignore patterns to each component of the relative
+        # path, just like the archive mode does while walking the tree.
+        for name in path.split('/'):
+            if self.ignoredName(name):
+                return True
+        return False
+
     def transferFiles(self, file_list):
-        cmds = []
-        for (etype, path, atime, mtime, ctime) in file_list:
-            # For copying source code, we ignoring VCS book-keeping and
-            # backup files.
-            if path.endswith('.git') or path.endswith('~') or \
-                path.endswith('.bak') or ('/_MTN' in path) or path == '.gitignore':
+        dirs = []
+        files = []
+        times = []
+        for (etype, path, atime, mtime, ctime, size) in file_list:
+            if self.isIgnored(path):
                 continue
 
-            dest_path = self.dest_host.joinPath(self.dest_path, path)
+            dest_path = self.dest_host.joinPath(self.transfer_path, path)
             if etype == 'dir':
-                cmds.append((self.dest_host.makeDirectory, dest_path))
+                dirs.append(dest_path)
             else:
                 assert etype == 'file'
-                cmds.append((self.transferSingleFile, path))
-                cmds.append((self.adjustFileTimes, dest_path, atime, mtime))
+                files.append((size, path))
+                times.append((dest_path, atime, mtime))
+
+        # Directories and file times are adjusted in batches, while file
+        # contents are transferred concurrently, smallest files first.
+        files.sort()
+        self.pendingFiles = collections.deque(files)
+        self.filesTotal = len(files)
+        self.bytesTotal = sum([size for size, path in files])
+
+        d = defer.maybeDeferred(self.dest_host.makeDirectories, dirs)
+        d.addCallback(self.startTransfers)
+        d.addCallback(lambda ign: self.dest_host.utimes(times))
+        return d
 
-        return self.runSequentialCommandsIgnoringResults(cmds)
+    def startTransfers(self, result):
+        self.transferStart = time.time()
+        workers = []
+        for i in range(min(self.maxConcurrentTransfers,
+                           len(self.pendingFiles))):
+            # One worker starts from the largest files, so these are
+            # transferred alongside the many small ones, rather than all
+            # at the very end.
+            workers.append(self.startTransferWorker(largestFirst=(i == 0)))
+        return defer.gatherResults(workers, consumeErrors=True)
+
+    def startTransferWorker(self, largestFirst):
+        worker = defer.Deferred()
+        worker.addCallback(self.transferNextFile, worker, largestFirst)
+        worker.callback(None)
+        return worker
+
+    def transferNextFile(self, result, worker, largestFirst):
+        if len(self.pendingFiles) == 0:
+            return None
+
+        if largestFirst:
+            size, path = self.pendingFiles.pop()
+        else:
+            size, path = self.pendingFiles.popleft()
+
+        # Continue with the next file from the worker's callback chain,
+        # which avoids deep recursion for synchronous transfers.
+        worker.addCallback(self.transferNextFile, worker, largestFirst)
+
+        d = defer.maybeDeferred(self.transferSingleFile, path)
+        d.addCallbacks(self.fileTransferred, self.abortTransfers,
+                       callbackArgs=(size,))
+        return d
+
+    def fileTransferred(self, result, size):
+        self.filesDone += 1
+        self.bytesDone += size
+        now = time.time()
+        if now - self.lastProgress >= self.progressInterval or \
+                self.filesDone == self.filesTotal:
+            self.lastProgress = now
+            self.reportSetUpProgress()
+
+    def abortTransfers(self, failure):
+        # stops the other workers
+        self.pendingFiles.clear()
+        return failure
 
     def transferSingleFile(self, path):
         src_path = self.src_host.joinPath(self.src_path, path)
-        dest_path = self.dest_host.joinPath(self.dest_path, path)
+        dest_path = self.dest_host.joinPath(self.transfer_path, path)
 
         from dtester.runner import Localhost
         if isinstance(self.src_host, Localhost) and isinstance(self.dest_host, Localhost):
@@ -151,9 +362,6 @@ class RemoteWorkingTreeCopy(TestSuite):
             d.addCallback(lambda ign: os.remove(tmp_path))
             return d
 
-    def adjustFileTimes(self, path, atime, mtime):
-        return self.dest_host.utime(path, atime, mtime)
-
     def printDownloadError(self, failure, path, hostname):
         self.runner.log("error downloading %s from %s" % (repr(path), hostname))
         return failure
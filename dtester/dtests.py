@@ -9,14 +9,18 @@
 self-testing code for dtester
 """
 
-import os
+import os, re, imp, signal
 import time
+from StringIO import StringIO
 
-from twisted.internet import defer
+from twisted.internet import defer, reactor, protocol, task
+from twisted.protocols.basic import LineReceiver
+from twisted.python import failure
 
 from zope.interface import implements, interface
 
-import exceptions, reporter, runner, test
+import compilation, events, evlog, evstore, exceptions, interfaces, \
+    launcher, processes, reporter, runner, tailserver, test, utils
 
 class IMockTestSuite(interface.Interface):
     """ Meaningless sample interface to be implemented and checked against.
@@ -324,3 +328,1153 @@ class ResourceTest(AbstractSelfTest):
                'uses': ('resource',),
                'onlyAfter': ('u2',)}
         }
+
+
+class CompositeMatcherTest(test.BaseTest):
+
+    description = "composite matchers over multiple event sources"
+
+    def run(self):
+        self.node1 = events.EventSource()
+        self.node2 = events.EventSource()
+
+        m = events.AllOfMatcher(
+            (self.node1, events.EventMatcher(events.ProcessOutStreamEvent,
+                                             pattern="ready")),
+            (self.node2, events.EventMatcher(events.ProcessOutStreamEvent,
+                                             pattern="joined")),
+            within=5.0)
+        d = self.waitForComposite(m)
+        reactor.callLater(0.0, self.throwOut, self.node2, "node joined\n")
+        reactor.callLater(0.0, self.throwOut, self.node1, "starting\n")
+        reactor.callLater(0.01, self.throwOut, self.node1, "ready\n")
+        d.addCallback(self.checkAllOf)
+        d.addCallback(self.startSequence)
+        return d
+
+    def throwOut(self, source, data):
+        source.throwEvent(events.ProcessOutStreamEvent, data)
+
+    def checkAllOf(self, result):
+        self.assertEqual([ev.data for ev in result],
+                         ["ready\n", "node joined\n"],
+                         "all-of matcher delivered unexpected events")
+        self.assertEqual(len(self.node1.hooks) + len(self.node2.hooks), 0,
+                         "composite matcher left hooks installed")
+
+    def startSequence(self, result):
+        m = events.SequenceMatcher(
+            (self.node1, events.EventMatcher(events.ProcessOutStreamEvent,
+                                             pattern="A")),
+            (self.node2, events.EventMatcher(events.ProcessOutStreamEvent,
+                                             pattern="B")))
+        d = self.waitForComposite(m)
+        # B before A doesn't count
+        reactor.callLater(0.0, self.throwOut, self.node2, "B1")
+        reactor.callLater(0.01, self.throwOut, self.node1, "A1")
+        reactor.callLater(0.02, self.throwOut, self.node2, "B2")
+        d.addCallback(self.checkSequence)
+        return d
+
+    def checkSequence(self, result):
+        self.assertEqual([ev.data for ev in result], ["A1", "B2"],
+                         "sequence matcher delivered unexpected events")
+        self.checkRemoteSequence()
+
+    def checkRemoteSequence(self):
+        # A single remote line matching two steps must not satisfy both,
+        # even though each of their remote hooks reports it.
+        from dtester.net import ssh
+        parent = RemoteHookParent()
+        proc = ssh.RemoteProcess(parent, "node1", defer.Deferred(), 1)
+        results = []
+        m = events.SequenceMatcher(*[
+            (proc, events.EventMatcher(events.ProcessOutStreamEvent,
+                                       pattern=pattern))
+            for pattern in ("a", "b", "c")])
+        m.install(results.append)
+
+        parent.remoteLine(proc, "a\n")
+        parent.remoteLine(proc, "b c\n")
+        self.assertEqual(results, [],
+                         "one remote line satisfied two steps")
+        parent.remoteLine(proc, "c\n")
+        self.assertEqual([[ev.data for ev in result] for result in results],
+                         [["a\n", "b c\n", "c\n"]],
+                         "sequence matcher delivered unexpected events")
+
+
+class RemoteHookParent:
+    """ Stands in for the L{TestSSHSuite} of a remote process, reporting
+        lines to each remote hook they match, like the remote helper.
+    """
+    def __init__(self):
+        self.hooks = []
+
+    def addProcessHook(self, jobid, stream, pattern):
+        self.hooks.append((len(self.hooks) + 1, pattern))
+        return len(self.hooks)
+
+    def dropProcessHook(self, jobid, hook_id):
+        pass
+
+    def remoteLine(self, proc, line):
+        for hook_id, pattern in self.hooks:
+            if re.search(pattern, line):
+                proc.triggerHookCallback(hook_id, line)
+
+
+class CountingEventSource(events.EventSource):
+    """ An event source counting calls to its flow control methods.
+    """
+    def __init__(self):
+        events.EventSource.__init__(self)
+        self.pauses = 0
+        self.resumes = 0
+
+    def pauseProducing(self):
+        self.pauses += 1
+
+    def resumeProducing(self):
+        self.resumes += 1
+
+class FlowControlTest(test.BaseTest):
+
+    description = "event source flow control"
+
+    def run(self):
+        self.delivered = []
+        self.logged = []
+
+        # Only the log-only consumer may lose events, the other one
+        # pauses the source.
+        self.dropping = CountingEventSource()
+        self.dropping.setFlowControl(4, 2, 'drop')
+        self.dropping.addDroppableHook(
+            events.EventMatcher(events.StreamDataEvent), self.logged.append)
+        self.dropping.addHook(events.EventMatcher(events.StreamDataEvent),
+                              self.delivered.append)
+
+        self.pausing = CountingEventSource()
+        self.pausing.setFlowControl(4, 2, 'pause')
+        self.pausing.addHook(events.EventMatcher(events.StreamDataEvent),
+                             self.delivered.append)
+
+        for i in range(10):
+            self.dropping.throwEvent(events.ProcessOutStreamEvent, str(i))
+            self.pausing.throwEvent(events.ProcessOutStreamEvent, str(i))
+        self.dropping.throwEvent(events.ProcessEndedEvent, 0)
+
+        self.assertEqual(self.dropping.droppedEvents, 8,
+                         "unexpected number of dropped events")
+        self.assertEqual(self.dropping.pauses, 1,
+                         "dropping source did not pause producing")
+        self.assertEqual(self.pausing.pauses, 1,
+                         "source did not pause producing")
+
+        d = self.sleep(0.01)
+        d.addCallback(self.checkDelivery)
+        return d
+
+    def checkDelivery(self, result):
+        self.assertEqual(len(self.logged), 2,
+                         "unexpected number of logged events")
+        self.assertEqual(len(self.delivered), 10 + 10,
+                         "unexpected number of delivered events")
+        self.assertEqual(self.dropping.resumes, 1,
+                         "dropping source did not resume producing")
+        self.assertEqual(self.pausing.resumes, 1,
+                         "source did not resume producing")
+        self.assertEqual(self.pausing.pendingEvents, 0,
+                         "events left pending")
+
+
+class LineSplitterTest(test.BaseTest):
+
+    description = "incremental line splitting"
+
+    def run(self):
+        data = "first\nsecond line\n\nfourth line, not terminated"
+        expected = ["first\n", "second line\n", "\n",
+                    "fourth line, not terminated"]
+
+        for chunk_size in (1, 2, 3, 7, len(data)):
+            lines = []
+            splitter = processes.LineSplitter(lines.append)
+            for offset in range(0, len(data), chunk_size):
+                splitter.feed(data[offset:offset + chunk_size])
+            splitter.flush()
+            self.assertEqual(lines, expected,
+                "unexpected lines for chunk size %d" % chunk_size)
+
+        lines = []
+        splitter = processes.LineSplitter(lines.append, maxLineLength=4)
+        splitter.feed("abc")
+        splitter.feed("defg")
+        splitter.feed("hi\n")
+        self.assertEqual(lines, ["abcdefg", "hi\n"],
+                         "unexpected lines with forced flush")
+
+
+class EnvironmentTest(test.BaseTest):
+
+    description = "environment layers and variable substitution"
+
+    def run(self):
+        base = processes.EnvironmentLayer({'PATH': '/bin', 'HOME': '/root'})
+        env = base.derive()
+        env['PATH'] = processes.substituteEnvVars(
+            "/opt/bin:$PATH:${HOME}/bin:$PATHX", env)
+        self.assertEqual(env['PATH'], "/opt/bin:/bin:/root/bin:$PATHX",
+                         "unexpected substitution result")
+        self.assertEqual(base['PATH'], "/bin",
+                         "modification leaked into the base layer")
+
+        flat = env.flatten()
+        self.assertEqual(flat, {'PATH': "/opt/bin:/bin:/root/bin:$PATHX",
+                                'HOME': '/root'},
+                         "unexpected flattened environment")
+        self.assertEqual(id(env.flatten()), id(flat),
+                         "flattened environment not cached")
+        env['LANG'] = 'C'
+        self.assertEqual(env.flatten().get('LANG'), 'C',
+                         "flattened environment not invalidated")
+
+
+class ResourceUsageTest(test.BaseTest):
+
+    description = "aggregation and reporting of resource usage"
+
+    def run(self):
+        a = events.ResourceUsage(1.5, 0.25, 2048, 10, 2, 8, 0)
+        b = events.ResourceUsage(0.5, 0.25, 1024, 5, 1, 0, 16)
+        total = a + b
+        self.assertEqual(total.toTuple(), (2.0, 0.5, 2048, 15, 3, 8, 16),
+                         "unexpected aggregated resource usage")
+
+        out = StringIO()
+        rep = reporter.StreamReporter(outs=out, showResourceUsage=True)
+        rep.resourceSummary({'foo': total})
+        lines = out.getvalue().split('\n')
+        self.assertEqual(lines[1].split(),
+                         ['foo', '2.00s', '0.50s', '2048kB', '15', '3',
+                          '8', '16'],
+                         "unexpected resource usage summary")
+
+        # Processes exiting immediately may already be reaped right after
+        # spawning, they need to report their resource usage as well.
+        procs = []
+        ds = []
+        for usePTY in (False, True):
+            proc = processes.SimpleProcess(self.test_name, 'true', 'true',
+                self.runner.getTmpDir(), args=['true'], usePTY=usePTY)
+            proc.start()
+            procs.append(proc)
+            ds.append(proc.getTerminationDeferred())
+        d = defer.gatherResults(ds)
+        d.addCallback(self.checkReaped, procs)
+        return d
+
+    def checkReaped(self, exitCodes, procs):
+        self.assertEqual(exitCodes, [0, 0], "unexpected exit codes")
+        for proc in procs:
+            self.assertEqual(isinstance(proc.rusage, events.ResourceUsage),
+                             True, "no resource usage reported")
+
+
+class OutputModeTest(test.BaseTest):
+
+    description = "redirection of process output to a file"
+
+    def run(self):
+        self.path = os.path.join(self.runner.getTmpDir(), "output_mode.out")
+        self.lines = []
+        proc = processes.SimpleProcess(self.test_name, 'sh', 'sh',
+            self.runner.getTmpDir(),
+            args=['sh', '-c', 'echo out; echo err >&2'],
+            outputMode='file', outputFile=self.path, tailOutput=True)
+        proc.addHook(events.EventMatcher(events.ProcessOutputFileEvent),
+                     lambda event: self.lines.append(event.data))
+        proc.start()
+        d = proc.getTerminationDeferred()
+        d.addCallback(self.checkOutput)
+        return d
+
+    def checkOutput(self, exitCode):
+        self.assertEqual(exitCode, 0, "unexpected exit code")
+        self.assertEqual(open(self.path).read(), "out\nerr\n",
+                         "unexpected output file contents")
+        self.assertEqual(self.lines, ["out\n", "err\n"],
+                         "unexpected events from tailing the output")
+
+
+class StdinFeedTest(test.BaseTest):
+
+    description = "streaming input into a process"
+
+    def run(self):
+        self.output = []
+        proc = processes.SimpleProcess(self.test_name, 'cat', 'cat',
+            self.runner.getTmpDir(), args=['cat'], lineBasedOutput=False)
+        proc.addHook(events.EventMatcher(events.ProcessOutStreamEvent),
+                     lambda event: self.output.append(event.data))
+        proc.start()
+        proc.feedFromIterator("line %d\n" % i for i in range(1000))
+        d = proc.getTerminationDeferred()
+        d.addCallback(self.checkOutput)
+        return d
+
+    def checkOutput(self, exitCode):
+        self.assertEqual(exitCode, 0, "unexpected exit code")
+        self.assertEqual("".join(self.output),
+                         "".join(["line %d\n" % i for i in range(1000)]),
+                         "unexpected output of the process")
+
+
+class StopScheduleTest(test.BaseTest):
+
+    description = "escalation of signals for stopping a process"
+
+    def run(self):
+        schedule = ((signal.SIGINT, 0.1), (signal.SIGKILL, None))
+        proc = processes.SimpleProcess(self.test_name, 'sh', 'sh',
+            self.runner.getTmpDir(),
+            args=['sh', '-c', 'trap "" INT; sleep 30 & wait; wait'],
+            stopSchedule=schedule)
+        proc.start()
+        self.t_stop = None
+        d = self.sleep(0.1)
+        d.addCallback(self.stopProcess, proc)
+        d.addCallback(self.checkTermination)
+        return d
+
+    def stopProcess(self, result, proc):
+        self.t_stop = time.time()
+        return proc.stop()
+
+    def checkTermination(self, exitCode):
+        self.assertEqual(time.time() - self.t_stop < 5.0, True,
+                         "process not killed in time")
+
+
+class EndedProtocol(protocol.ProcessProtocol):
+
+    def __init__(self):
+        self.ended = defer.Deferred()
+        self.reason = None
+
+    def processEnded(self, reason):
+        self.reason = reason
+        self.ended.callback(None)
+
+class LauncherTest(test.BaseTest):
+
+    description = "spawning processes via the pre-forked launcher"
+
+    def run(self):
+        self.launcher = launcher.ProcessLauncher()
+        self.launcher.start(self.runner.log)
+
+        self.output = []
+        proc = processes.SimpleProcess(self.test_name, 'sh', 'sh',
+            self.runner.getTmpDir(),
+            args=['sh', '-c', 'echo out; echo err >&2; exit 3'],
+            launcher=self.launcher)
+        proc.addHook(events.EventMatcher(events.StreamDataEvent),
+                     lambda event: self.output.append((event.name,
+                                                       event.data)))
+        proc.start()
+        d = proc.getTerminationDeferred()
+        d.addCallback(self.checkCommand, proc)
+        d.addCallback(self.signalProcess)
+        d.addCallback(self.checkSignalled)
+        d.addBoth(self.stopLauncher)
+        d.addCallback(self.stopWithProcesses)
+        d.addCallback(self.checkTerminated)
+        d.addCallback(self.stopUnresponsive)
+        d.addCallback(self.checkKilled)
+        return d
+
+    def checkCommand(self, exitCode, proc):
+        self.assertEqual(exitCode, 3, "unexpected exit code")
+        self.assertEqual(sorted(self.output),
+                         [("err", "err\n"), ("out", "out\n")],
+                         "unexpected output events")
+        self.assertEqual(isinstance(proc.rusage, events.ResourceUsage), True,
+                         "no resource usage reported")
+        self.assertEqual(proc.rusage.maxrss > 0, True,
+                         "unexpected resource usage")
+
+    def signalProcess(self, result):
+        proto = EndedProtocol()
+        transport = self.launcher.spawnProcess(proto, '/bin/sh',
+            args=['sh', '-c', 'exec sleep 30'], env=dict(os.environ))
+        reactor.callLater(0.1, transport.signalProcess, 'TERM')
+        d = proto.ended
+        d.addCallback(lambda ignored: proto.reason.value)
+        return d
+
+    def checkSignalled(self, reason):
+        self.assertEqual(reason.signal, signal.SIGTERM,
+                         "process not terminated by the signal")
+
+    def stopLauncher(self, result):
+        d = self.launcher.stop()
+        d.addCallback(lambda ignored: result)
+        return d
+
+    def spawnSleeper(self, cmd):
+        proto = EndedProtocol()
+        self.launcher.spawnProcess(proto, '/bin/sh',
+            args=['sh', '-c', cmd], env=dict(os.environ))
+        return proto
+
+    def stopLater(self):
+        # gives the processes a chance to start and set up their traps
+        return task.deferLater(reactor, 0.2, self.launcher.stop)
+
+    def stopWithProcesses(self, result):
+        # Processes left running get terminated or, if they ignore
+        # SIGTERM, killed upon stopping the launcher.
+        self.launcher = launcher.ProcessLauncher(killTimeout=0.2)
+        self.launcher.start(self.runner.log)
+        self.protos = [self.spawnSleeper('sleep 30'),
+                       self.spawnSleeper('trap "" TERM; sleep 30')]
+        return self.stopLater()
+
+    def checkTerminated(self, result):
+        signals = [proto.reason.value.signal for proto in self.protos]
+        self.assertEqual(signals, [signal.SIGTERM, signal.SIGKILL],
+                         "left-over processes not stopped")
+
+    def stopUnresponsive(self, result):
+        # A launcher failing to terminate its processes in time gets
+        # killed itself.
+        self.messages = []
+        self.launcher = launcher.ProcessLauncher(killTimeout=30.0,
+                                                 stopTimeout=0.3)
+        self.launcher.start(self.messages.append)
+        self.protos = [self.spawnSleeper('trap "" TERM; sleep 30')]
+        return self.stopLater()
+
+    def checkKilled(self, result):
+        # The helper didn't get to kill the process, clean up after it.
+        pid = self.protos[0].transport.pid
+        if pid is not None:
+            os.killpg(pid, signal.SIGKILL)
+
+        reason = self.protos[0].reason.value
+        self.assertEqual(reason.exitCode, 255,
+                         "process of the killed launcher not ended")
+        self.assertEqual(len([msg for msg in self.messages
+                              if "still alive: sh -c" in msg]), 1,
+                         "left-over process not logged")
+
+
+class ProcessGroupTest(test.BaseTest):
+
+    description = "preparing and starting a group of processes"
+
+    needs = (('host', interfaces.IControlledHost),)
+
+    def run(self):
+        self.output = {}
+        specs = [{'name': "%s.node%d" % (self.test_name, i),
+                  'cmdline': ['sh', '-c', 'echo $NODE'],
+                  'env': {'NODE': str(i)}} for i in range(4)]
+        procs, d = self.host.prepareProcesses(specs)
+        for proc in procs:
+            proc.addHook(events.EventMatcher(events.ProcessOutStreamEvent),
+                         self.gotOutput)
+        self.host.startAll(procs)
+        d.addCallback(self.checkResults)
+        return d
+
+    def gotOutput(self, event):
+        self.output[event.source.test_name] = event.data
+
+    def checkResults(self, exitCodes):
+        self.assertEqual(exitCodes, [0, 0, 0, 0], "unexpected exit codes")
+        self.assertEqual(sorted(self.output.values()),
+                         ["0\n", "1\n", "2\n", "3\n"],
+                         "unexpected output of the processes")
+
+
+class EventLogTest(test.BaseTest):
+
+    description = "binary event log writer and text conversion"
+
+    def run(self):
+        path = os.path.join(self.runner.getTmpDir(), "evlog_test.bin")
+        records = [(1000.5, "t1", "out", "foo\n"),
+                   (1001.25, "t2", "err", "\x00binary\xff"),
+                   (1002.0, "t1", "out", "")]
+
+        writer = evlog.EventLogWriter(path)
+        writer.start()
+        for record in records:
+            writer.append(*record)
+        writer.close()
+
+        self.assertEqual(list(evlog.readEventLog(path)), records,
+                         "records differ after reading back")
+
+        out = StringIO()
+        evlog.convertEventLog(path, out)
+        self.assertEqual(out.getvalue(),
+                         "1000.500000:t1:out:'foo\\n'\n" +
+                         "1001.250000:t2:err:'\\x00binary\\xff'\n" +
+                         "1002.000000:t1:out:''\n",
+                         "unexpected text conversion")
+
+
+class EventLogMergeTest(test.BaseTest):
+
+    description = "merging the event logs of multiple hosts"
+
+    def run(self):
+        self.directory = os.path.join(self.runner.getTmpDir(), "merge_test")
+        os.makedirs(self.directory)
+        self.errors = []
+
+        # two remote hosts with text logs, added first
+        logs = [("node1", [(1.0, "a1"), (2.0, "a2"), (2.0, "a3"),
+                           (3.0, "a4")]),
+                ("node2", [(0.5, "b1"), (2.0, "b2"), (2.0, "b3"),
+                           (5.0, "b4")])]
+        merger = evlog.EventLogMerger(self.directory,
+                                      utils.FileHandleCache(self.directory),
+                                      self.errors.append)
+        merger.start()
+        for host, entries in logs:
+            path = os.path.join(self.directory, host + "-event.log")
+            fd = open(path, 'w')
+            for t, data in entries:
+                fd.write("%.6f:%s:out:%s\n" % (t, host, repr(data)))
+            fd.close()
+            merger.add(host, path)
+
+        # and the binary local one, demultiplexed already
+        path = os.path.join(self.directory, "localhost-event.bin.z")
+        writer = evlog.EventLogWriter(path)
+        writer.start()
+        for t, data in [(1.0, "c1"), (2.0, "c2"), (4.0, "c3")]:
+            writer.append(t, "local", "out", data)
+        writer.close()
+        merger.add("localhost", path, demultiplexed=True)
+
+        d = merger.finish()
+        d.addCallback(self.checkResults)
+        return d
+
+    def checkResults(self, result):
+        self.assertEqual(self.errors, [], "unexpected errors: %s" %
+                         self.errors)
+
+        # ordered by timestamp, then by the order the hosts were added
+        expected = [("node2", "b1"), ("node1", "a1"), ("localhost", "c1"),
+                    ("node1", "a2"), ("node1", "a3"), ("node2", "b2"),
+                    ("node2", "b3"), ("localhost", "c2"), ("node1", "a4"),
+                    ("localhost", "c3"), ("node2", "b4")]
+
+        lines = open(os.path.join(self.directory, "event.log")).readlines()
+        merged = []
+        for line in lines:
+            t, host, test_name, channel, data = line.split("\t")
+            merged.append((host, utils.parseArgs(data, self.errors.append)[0]))
+        self.assertEqual(merged, expected, "unexpected order in event.log")
+
+        store = evstore.EventStore(os.path.join(self.directory, "event.db"))
+        stored = [(event[1], event[4]) for event in store.query()]
+        store.close()
+        self.assertEqual(stored, expected, "unexpected order in event.db")
+
+        # only the remote hosts' data is written to report files
+        self.assertEqual(open(os.path.join(self.directory,
+                                           "node2.out")).read(),
+                         "b1b2b3b4", "unexpected report file contents")
+        self.assertEqual(os.path.exists(os.path.join(self.directory,
+                                                     "local.out")),
+                         False, "demultiplexed log written to report files")
+
+
+class FileHandleCacheTest(test.BaseTest):
+
+    description = "LRU file handle cache for report outputs"
+
+    def run(self):
+        directory = os.path.join(self.runner.getTmpDir(), "fhcache_test")
+        os.makedirs(directory)
+
+        cache = utils.FileHandleCache(directory, maxOpen=2)
+        for i in range(3):
+            for name in ("a", "b", "c"):
+                cache.write(name, "%s%d\n" % (name, i))
+                self.assertEqual(len(cache.handles) <= 2, True,
+                                 "too many open files")
+        cache.close()
+        self.assertEqual(len(cache.handles), 0, "files left open")
+
+        for name in ("a", "b", "c"):
+            self.assertEqual(open(os.path.join(directory, name)).read(),
+                             "%s0\n%s1\n%s2\n" % (name, name, name),
+                             "unexpected contents of %s" % name)
+
+
+class ArgCodecTest(test.BaseTest):
+
+    description = "encoding and parsing of repr() encoded arguments"
+
+    def run(self):
+        errors = []
+        args = ["foo", "", 42, -7, 3.25, 1e-07, 10 ** 20, "it's",
+                'say "hi"', "both ' and \"", "\x00\xff\\x41\n\t\r\\"]
+        line = utils.formatArgs(args)
+        self.assertEqual(utils.parseArgs(line, errors.append), args,
+                         "arguments differ after parsing: %s" % line)
+        self.assertEqual(utils.parseArgs(" 'a'\t\"b\" 1 \n", errors.append),
+                         ["a", "b", 1], "whitespace not skipped")
+        self.assertEqual(errors, [], "unexpected errors: %s" % errors)
+
+        self.assertEqual(utils.parseArgs("'a' x 'unterminated",
+                                         errors.append),
+                         ["a", "unterminated"], "invalid input not recovered")
+        self.assertEqual(len(errors), 2, "expected two errors")
+
+
+class EventStoreTest(test.BaseTest):
+
+    description = "indexed event store queries"
+
+    def run(self):
+        path = os.path.join(self.runner.getTmpDir(), "evstore_test.db")
+        store = evstore.EventStore(path)
+        store.append(10.5, "localhost", "node1", "out", "a\n")
+        store.append(11.0, "remote", "node2.pg", "err", "\x00b\n")
+        store.append(11.0, "remote", "node2", "out", "c\n")
+        store.append(12.0, "remote", "node20", "out", "d\n")
+        store.flush()
+
+        def data(**kwargs):
+            return [event[4] for event in store.query(**kwargs)]
+
+        self.assertEqual(data(), ["a\n", "\x00b\n", "c\n", "d\n"],
+                         "unexpected order of events")
+        self.assertEqual(data(start=11.0, end=12.0), ["\x00b\n", "c\n"],
+                         "unexpected events in time range")
+        self.assertEqual(data(test_name="node2"), ["\x00b\n", "c\n"],
+                         "unexpected events for test")
+        self.assertEqual(data(host="remote", channel="out"), ["c\n", "d\n"],
+                         "unexpected events for host and channel")
+        store.close()
+
+
+class TailCollector(LineReceiver):
+
+    delimiter = "\n"
+
+    def connectionMade(self):
+        self.lines = []
+        self.closed = defer.Deferred()
+
+    def lineReceived(self, line):
+        self.lines.append(line.split("\t")[1:])
+
+    def connectionLost(self, reason):
+        self.closed.callback(self.lines)
+
+
+class PublishCollector:
+    """ Stands in for a L{TailServer}, collecting the published states.
+    """
+    def __init__(self):
+        self.published = []
+
+    def publish(self, kind, host, test_name, channel, data):
+        self.published.append((test_name, channel, data))
+
+
+class TailServerTest(test.BaseTest):
+
+    description = "filtered live event stream of the tail server"
+
+    def run(self):
+        path = os.path.join(self.runner.getTmpDir(), "tail_test.sock")
+        self.server = tailserver.TailServer(path)
+        self.server.start()
+        d = protocol.ClientCreator(reactor, TailCollector).connectUNIX(path)
+        d.addCallback(self.connected)
+        return d
+
+    def connected(self, client):
+        client.sendLine("kind=output test=node2")
+        # give the server a chance to process the filter
+        d = task.deferLater(reactor, 0.1, self.publish)
+        d.addCallback(lambda ignored: client.closed)
+        d.addCallback(self.checkLines)
+        return d
+
+    def publish(self):
+        self.server.publish('output', 'localhost', 'node2', 'out', "a\n")
+        self.server.publish('output', 'remote', 'node2.pg', 'err', "b\n")
+        self.server.publish('output', 'localhost', 'node20', 'out', "c\n")
+        self.server.publish('log', 'localhost', '', 'log', "d")
+        self.server.stop()
+
+    def checkLines(self, lines):
+        self.assertEqual(lines,
+                         [['output', 'localhost', 'node2', 'out', "'a\\n'"],
+                          ['output', 'remote', 'node2.pg', 'err', "'b\\n'"]],
+                         "unexpected lines received")
+        self.checkReporter()
+
+    def checkReporter(self):
+        # A suite failing to set up must not be left in the running state.
+        server = PublishCollector()
+        wrapped = reporter.StreamReporter(StringIO(), StringIO())
+        tailing = tailserver.TailingReporter(wrapped, server)
+        error = failure.Failure(Exception("no space left"))
+        tailing.stopSetUpSuite("node1", None)
+        tailing.suiteSetUpFailure("node1", error)
+        tailing.suiteTearDownFailure("node1", error)
+        self.assertEqual(server.published,
+                         [('node1', 'running', ''),
+                          ('node1', 'setup-failed', 'no space left'),
+                          ('node1', 'teardown-failed', 'no space left')],
+                         "unexpected state events")
+
+
+class FrameCodecTest(test.BaseTest):
+
+    description = "binary framing of the remote helper protocol"
+
+    def run(self):
+        frames = [("append", [2, "path", "\x00\n\xff" * 1000]),
+                  ("proc_rusage", [3, 0.25, 1.5, 8192, 0, -1]),
+                  ("done", [])]
+        data = "".join([utils.encodeFrame(cmd, args)
+                        for cmd, args in frames])
+
+        # feed the decoder in small pieces, splitting frames
+        decoder = utils.FrameDecoder()
+        decoded = []
+        for offset in range(0, len(data), 7):
+            decoded.extend(decoder.feed(data[offset:offset + 7]))
+        self.assertEqual(decoded, frames, "frames differ after decoding")
+        self.assertEqual(decoder.buffer, "", "data left in the decoder")
+
+
+class PipelineHelper:
+    """ Records the batches of commands a L{CommandPipeline} sends.
+    """
+    def __init__(self):
+        self.batchDepth = 0
+        self.batches = []
+
+    def beginBatch(self):
+        if self.batchDepth == 0:
+            self.batches.append([])
+        self.batchDepth += 1
+
+    def endBatch(self):
+        self.batchDepth -= 1
+
+
+class PipelineSuite:
+    """ Answers the commands dispatched by a L{CommandPipeline} only when
+        told to, like a remote helper would.
+    """
+    def __init__(self):
+        self.remote_helper = PipelineHelper()
+        self.pending = []
+
+    def dispatchCommand(self, cmd, *args):
+        self.remote_helper.batches[-1].append(cmd)
+        d = defer.Deferred()
+        self.pending.append((d, cmd))
+        return d, len(self.pending)
+
+    def replyToAll(self):
+        pending, self.pending = self.pending, []
+        self.remote_helper.beginBatch()
+        for d, cmd in pending:
+            if cmd == "fail":
+                d.errback(Exception(cmd))
+            else:
+                d.callback(cmd)
+        self.remote_helper.endBatch()
+
+
+class CommandPipelineTest(test.BaseTest):
+
+    description = "pipelined dispatching of remote helper commands"
+
+    def run(self):
+        from dtester.net.ssh import CommandPipeline
+
+        suite = PipelineSuite()
+        cmds = [("cmd%d" % i,) for i in range(5)] + [("fail",)]
+        ds = CommandPipeline(suite, cmds, 2).start()
+        results = []
+        for d in ds:
+            d.addErrback(lambda failure: "failed")
+            d.addCallback(results.append)
+
+        maxInFlight = 0
+        while len(suite.pending) > 0:
+            maxInFlight = max(maxInFlight, len(suite.pending))
+            suite.replyToAll()
+
+        self.assertEqual(maxInFlight, 2, "commands in flight differ")
+
+        batches = [batch for batch in suite.remote_helper.batches
+                   if len(batch) > 0]
+        self.assertEqual(batches,
+                         [["cmd0", "cmd1"], ["cmd2", "cmd3"],
+                          ["cmd4", "fail"]],
+                         "commands not sent in batches")
+        self.assertEqual(results,
+                         ["cmd0", "cmd1", "cmd2", "cmd3", "cmd4", "failed"],
+                         "results not delivered per command")
+
+
+class ChunkedFile:
+    """ An in-memory stand-in for an open SFTP file, answering read and
+        write requests only when told to. Requests for the given failure
+        offset fail.
+    """
+    def __init__(self, data="", failAt=None):
+        self.data = data
+        self.failAt = failAt
+        self.pending = []
+        self.outstanding = 0
+        self.maxOutstanding = 0
+
+    def request(self, *args):
+        d = defer.Deferred()
+        self.pending.append((d,) + args)
+        self.outstanding += 1
+        self.maxOutstanding = max(self.maxOutstanding, self.outstanding)
+        return d
+
+    def writeChunk(self, offset, data):
+        return self.request(self.doWrite, offset, data)
+
+    def readChunk(self, offset, length):
+        return self.request(self.doRead, offset, length)
+
+    def doWrite(self, offset, data):
+        self.data = self.data[:offset].ljust(offset, "\0") + data + \
+            self.data[offset + len(data):]
+
+    def doRead(self, offset, length):
+        if offset >= len(self.data):
+            raise EOFError()
+        return self.data[offset:offset + length]
+
+    def replyToAll(self):
+        """ Answers all pending requests, in reverse order.
+        """
+        pending, self.pending = self.pending, []
+        for d, fn, offset, arg in reversed(pending):
+            self.outstanding -= 1
+            if offset == self.failAt:
+                d.errback(IOError("failure at offset %d" % offset))
+            else:
+                try:
+                    result = fn(offset, arg)
+                except EOFError, e:
+                    d.errback(e)
+                else:
+                    d.callback(result)
+
+
+class ChunkedTransferTest(test.BaseTest):
+
+    description = "pipelined chunked SFTP transfers"
+
+    def run(self):
+        from dtester.net.ssh import ChunkedUpload, ChunkedDownload
+        self.ChunkedUpload = ChunkedUpload
+        self.ChunkedDownload = ChunkedDownload
+
+        # five chunks, the last one being a short one
+        self.source = "".join(chr(ord('a') + i) * 9 + "\n" for i in range(4))
+        self.source += "tail\n"
+
+        d = self.upload(ChunkedFile())
+        d.addCallback(self.checkUploaded)
+        d.addCallback(lambda result: self.upload(ChunkedFile(failAt=10)))
+        d.addCallbacks(self.unexpectedSuccess, self.checkFailed)
+        d.addCallback(lambda result: self.download(ChunkedFile(self.source)))
+        d.addCallback(self.checkDownloaded)
+        d.addCallback(lambda result: self.download(
+            ChunkedFile(self.source, failAt=10)))
+        d.addCallbacks(self.unexpectedSuccess, self.checkFailed)
+        return d
+
+    def upload(self, remote):
+        transfer = self.ChunkedUpload(remote, StringIO(self.source), 10, 3,
+                                      1000)
+        return self.transfer(transfer, remote)
+
+    def download(self, remote):
+        self.local = StringIO()
+        transfer = self.ChunkedDownload(remote, self.local, 10, 3)
+        return self.transfer(transfer, remote)
+
+    def transfer(self, transfer, remote):
+        d = transfer.start()
+        d.addBoth(self.checkIdle, remote)
+        self.replyWhenIdle(transfer, remote)
+        return d
+
+    def replyWhenIdle(self, transfer, remote):
+        """ Answers the pending requests as soon as the transfer doesn't
+            issue any more of them, until it completes. The upload reads
+            its local file from a thread.
+        """
+        if transfer.deferred.called:
+            return
+        if not getattr(transfer, 'reading', False):
+            remote.replyToAll()
+        reactor.callLater(0.001, self.replyWhenIdle, transfer, remote)
+
+    def checkIdle(self, result, remote):
+        # The result must only be delivered after all requests in flight
+        # completed, even after a failure.
+        self.assertEqual(remote.outstanding, 0,
+                         "transfer completed with requests in flight")
+        self.assertEqual(remote.maxOutstanding, 3,
+                         "requests in flight differ from the window")
+        return result
+
+    def checkUploaded(self, remote):
+        self.assertEqual(remote.data, self.source, "uploaded data differs")
+
+    def checkDownloaded(self, remote):
+        self.assertEqual(self.local.getvalue(), self.source,
+                         "downloaded data differs")
+
+    def unexpectedSuccess(self, result):
+        raise exceptions.TestFailure("transfer did not fail")
+
+    def checkFailed(self, failure):
+        failure.trap(IOError)
+
+
+class StreamingHelper:
+    """ Stands in for the remote helper's main object and its clock,
+        collecting the reports of an EventLogStreamer.
+    """
+    def __init__(self):
+        self.now = 1000.0
+        self.timers = []
+        self.reports = []
+
+    def time(self):
+        return self.now
+
+    def callLater(self, delay, callback, *args):
+        timer = (self.now + delay, callback, args)
+        self.timers.append(timer)
+        return timer
+
+    def cancelTimer(self, timer):
+        self.timers.remove(timer)
+
+    def runTimers(self):
+        self.now = min(timer[0] for timer in self.timers)
+        timers, self.timers = self.timers, []
+        for t, callback, args in timers:
+            callback(*args)
+
+    def report(self, cmd, *args):
+        self.reports.append((cmd,) + args)
+
+
+class EventLogStreamTest(test.BaseTest):
+
+    description = "streaming of remote event logs during the run"
+
+    def run(self):
+        self.checkRateLimit()
+
+        from dtester.net import ssh
+        directory = os.path.join(self.runner.getTmpDir(), "evlog_stream")
+        self.reportDir = os.path.join(directory, "report")
+        self.out = StringIO()
+        self.nested = runner.Runner(
+            reporter.StreamReporter(self.out, self.out),
+            controlReactor=False, tmpDir=os.path.join(directory, "tmp"),
+            reportDir=self.reportDir)
+
+        # a suite receiving the records, without any connection
+        suite = ssh.TestSSHSuite.__new__(ssh.TestSSHSuite)
+        suite.runner = self.nested
+        suite.test_name = "node1"
+        suite.completedProcs = {1: "node1.pg"}
+        suite.pendingProcs = {}
+        suite.streamedLog = open(suite.getEventLogPath(), 'w')
+        suite.removeRemoteWorkDir = lambda result: defer.succeed(None)
+        suite.tearDownConnection = lambda result: None
+
+        # records of the helper itself and of a process, split across
+        # two frames and fed in pieces
+        channel = ssh.RemoteHelperChannel(suite, "remhelper.py")
+        channel.decoder = utils.FrameDecoder()
+        data = utils.encodeFrame("evlog_records",
+                                 ["1.000000:1:out:'a\\n'\n" +
+                                  "1.500000:0:err:'b\\n'\n"]) + \
+               utils.encodeFrame("evlog_records",
+                                 ["2.000000:1:out:'c\\n'\n"])
+        channel.dataReceived(data[:7])
+        channel.dataReceived(data[7:])
+
+        # Written to the report files right away.
+        self.nested.reportFiles.close()
+        self.assertEqual(self.readReportFile("node1.pg.out"), "a\nc\n",
+                         "unexpected report file contents during the run")
+
+        suite.helperTornDown(None)
+        self.nested.t_start = time.time()
+        d = self.nested.processCmdListFinished(None)
+        d.addCallback(self.checkMerged)
+        return d
+
+    def checkRateLimit(self):
+        remhelper = imp.load_source("remhelper", "remhelper.py")
+        helper = StreamingHelper()
+        remhelper.time = helper
+
+        # 1050 bytes per second allow for sending 210 bytes per interval,
+        # plus the initial allowance of another interval. The last record
+        # sent may exceed the allowance, that's made up for next time.
+        streamer = remhelper.EventLogStreamer(helper, 1050)
+        records = ["%09d\n" % i * 10 for i in range(10)]
+        for record in records:
+            streamer.append(record)
+
+        sent = []
+        for i in range(2):
+            helper.runTimers()
+            sent.append("".join(report[1] for report in helper.reports))
+            helper.reports = []
+        streamer.finish()
+        sent.append("".join(report[1] for report in helper.reports))
+
+        self.assertEqual([len(data) for data in sent], [500, 200, 300],
+                         "rate limit not applied")
+        self.assertEqual("".join(sent), "".join(records),
+                         "records lost or reordered")
+        self.assertEqual(helper.timers, [], "timers left")
+
+    def readReportFile(self, name):
+        return open(os.path.join(self.reportDir, name)).read()
+
+    def checkMerged(self, result):
+        lines = open(os.path.join(self.reportDir, "event.log")).readlines()
+        self.assertEqual(lines,
+                         ["1.000000\tnode1\tnode1.pg\tout\t'a\\n'\n",
+                          "1.500000\tnode1\tnode1\terr\t'b\\n'\n",
+                          "2.000000\tnode1\tnode1.pg\tout\t'c\\n'\n"],
+                         "unexpected merged event log")
+
+        # The merge must not write the streamed data to the report files
+        # a second time.
+        self.assertEqual(self.readReportFile("node1.pg.out"), "a\nc\n",
+                         "unexpected report file contents")
+        self.assertEqual(self.readReportFile("node1.err"), "b\n",
+                         "unexpected report file contents")
+
+
+class IgnoreRulesTest(test.BaseTest):
+
+    description = "same ignore rules for archive and file transfers"
+
+    def run(self):
+        top = os.path.join(self.runner.getTmpDir(), "ignore_test")
+        for path in ("src/a.c", "src/a.c~", "src/b.bak", "src/.gitignore",
+                     ".gitignore", ".git/config", ".git/objects/ab",
+                     "_MTN/revision", "lib/_MTN/revision", "lib/x.h"):
+            path = os.path.join(top, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'w').close()
+
+        entries = []
+        for root, dirs, files in os.walk(top):
+            for name in dirs + files:
+                entries.append(os.path.join(root, name)[len(top) + 1:])
+
+        copy = compilation.RemoteWorkingTreeCopy.__new__(
+            compilation.RemoteWorkingTreeCopy)
+        copy.ignoredName = utils.ignoreNames(copy.ignorePattern)
+        transferred = sorted(path for path in entries
+                             if not copy.isIgnored(path))
+        packer = utils.TreePacker(top, copy.ignorePattern)
+        archived = sorted(name for name, path in packer.iterEntries())
+
+        self.assertEqual(transferred, ["lib", "lib/x.h", "src", "src/a.c"],
+                         "unexpected files transferred")
+        self.assertEqual(archived, transferred,
+                         "archive and file transfers differ")
+
+
+class ArchiveTreeCopy(compilation.RemoteWorkingTreeCopy):
+    """ Transfers the tree as a compressed archive.
+    """
+    useArchive = True
+    compressArchive = True
+
+
+class CachedTreeCopy(compilation.RemoteWorkingTreeCopy):
+    """ Transfers the tree via a cache, which may be left over from a
+        previous run.
+    """
+    useCache = True
+    cachePath = "tmp/tree-cache"
+
+
+class LockedCacheTreeCopy(CachedTreeCopy):
+    """ Transfers the tree while another run holds the lock on its cache,
+        which must be left alone.
+    """
+    cachePath = "tmp/locked-cache"
+
+    def setUp(self):
+        if not os.path.isdir(self.cachePath):
+            os.makedirs(self.cachePath)
+        self.lockFd = utils.lockDirectory(self.cachePath)
+        d = CachedTreeCopy.setUp(self)
+        d.addBoth(self.releaseLock)
+        return d
+
+    def releaseLock(self, result):
+        os.close(self.lockFd)
+        if len(os.listdir(self.cachePath)) > 0:
+            raise exceptions.TestFailure("locked cache modified")
+        return result
+
+
+class TreeTransferTest(test.BaseTest):
+
+    description = "transfer of a working tree"
+
+    needs = (('src', interfaces.IDirectory),
+             ('tree', interfaces.IDirectory))
+
+    def run(self):
+        src_path = self.src.getPath()
+        dest_path = self.tree.getPath()
+        for root, dirs, files in os.walk(src_path):
+            for name in files:
+                if name.endswith('~') or name.endswith('.bak'):
+                    continue
+                path = os.path.join(root, name)
+                copy = os.path.join(dest_path, path[len(src_path) + 1:])
+                self.assertEqual(open(copy).read(), open(path).read(),
+                                 "contents of %s differ" % copy)
+                self.assertEqual(int(os.stat(copy).st_mtime),
+                                 int(os.stat(path).st_mtime),
+                                 "mtime of %s differs" % copy)
@@ -10,18 +10,24 @@ definition of events, their sources and matchers as well as some event
 classes
 """
 
+import time
+
 from twisted.internet import defer, reactor
 
 class EventHook:
-    """ A hook on a certain event, which fires a callback.
+    """ A hook on a certain event, which fires a callback. Only droppable
+        hooks may miss events, see L{EventSource.setFlowControl}.
     """
-    def __init__(self, ev_source, matcher, cb):
+    def __init__(self, ev_source, matcher, cb, *args, **kwargs):
         self.ev_source = ev_source
         self.matcher = matcher
         self.cb = cb
+        self.args = args
+        self.kwargs = kwargs
+        self.droppable = False
 
     def fireCallback(self, event):
-        self.cb(event)
+        self.cb(event, *self.args, **self.kwargs)
 
 class EventSource:
     """ An abstract object representing any kind of process, workflow or
@@ -30,27 +36,110 @@ class EventSource:
     def __init__(self):
         self.hooks = set()
 
+        # flow control: number of events thrown, but not yet delivered to
+        # their hooks.
+        self.pendingEvents = 0
+        self.droppedEvents = 0
+        self.highWatermark = None
+        self.lowWatermark = None
+        self.overflowPolicy = 'pause'
+        self.producerPaused = False
+
+    def setFlowControl(self, highWatermark, lowWatermark=None,
+                       policy='pause'):
+        """ Limits the number of undelivered events. As soon as the given
+            high watermark is reached, the source either pauses producing
+            until the queue drains below the low watermark ('pause'), or
+            drops and counts further droppable events ('drop'). The latter
+            only applies to droppable hooks, i.e. log-only consumers added
+            via L{addDroppableHook}. All other hooks still get every
+            event, so the source pauses for them, regardless of the
+            policy.
+        """
+        assert policy in ('pause', 'drop'), "unknown policy: %s" % policy
+        if lowWatermark is None:
+            lowWatermark = highWatermark / 2
+        assert lowWatermark < highWatermark
+        self.highWatermark = highWatermark
+        self.lowWatermark = lowWatermark
+        self.overflowPolicy = policy
+
     def throwEvent(self, eventClass, *args, **kwargs):
         event = eventClass(self, *args, **kwargs)
+        overflow = self.highWatermark is not None and \
+            self.pendingEvents >= self.highWatermark
+        backPressure = self.overflowPolicy == 'pause'
         for hook in self.hooks:
             if hook.matcher.matches(event):
-                reactor.callLater(0.0, hook.fireCallback, event)
-
-    def addHook(self, matcher, callback):
+                if hook.droppable and self.overflowPolicy == 'drop' and \
+                        event.droppable:
+                    if overflow:
+                        self.droppedEvents += 1
+                        continue
+                else:
+                    backPressure = True
+                self.pendingEvents += 1
+                reactor.callLater(0.0, self.deliverEvent, hook, event)
+
+        if self.highWatermark is not None and not self.producerPaused and \
+                backPressure and self.pendingEvents >= self.highWatermark:
+            self.producerPaused = True
+            self.pauseProducing()
+
+    def deliverEvent(self, hook, event):
+        self.pendingEvents -= 1
+        if self.producerPaused and self.pendingEvents <= self.lowWatermark:
+            self.producerPaused = False
+            self.resumeProducing()
+        hook.fireCallback(event)
+
+    def pauseProducing(self):
+        """ Abstract method, called when too many events are pending.
+        """
+
+    def resumeProducing(self):
+        """ Abstract method, called when pending events have drained.
+        """
+
+    def addHook(self, matcher, callback, *args, **kwargs):
         assert callable(callback), "callback function must be callable"
-        newHook = EventHook(self, matcher, callback)
+        newHook = EventHook(self, matcher, callback, *args, **kwargs)
         self.hooks.add(newHook)
         return newHook
 
+    def addDroppableHook(self, matcher, callback, *args, **kwargs):
+        """ Adds a hook for a consumer that may miss events, i.e. one that
+            only logs them. Under the 'drop' policy, it doesn't get any
+            droppable events while the source is overloaded.
+        """
+        hook = self.addHook(matcher, callback, *args, **kwargs)
+        hook.droppable = True
+        return hook
+
     def removeHook(self, hook):
         assert hook in self.hooks
         self.hooks.remove(hook)
 
+    def hasHooksFor(self, eventClass):
+        """ Checks if any hook might be interested in events of the given
+            class, allowing sources to skip producing them otherwise.
+        """
+        for hook in self.hooks:
+            matcher = hook.matcher
+            if not isinstance(matcher, EventMatcher) or \
+                    issubclass(eventClass, matcher.eventClass):
+                return True
+        return False
+
 class Event:
     """ Base class for all events.
     """
+
+    # whether or not a source may drop this event under overload
+    droppable = False
     def __init__(self, source):
         self.source = source
+        self.time = time.time()
 
     def matches(self):
         return True
@@ -75,6 +164,171 @@ class EventMatcher(object):
             return event.matches(*self.args, **self.kwargs)
 
 
+class SourceDispatchMatcher(object):
+    """ The matcher a L{CompositeMatcher} installs on each of its event
+        sources: matches if any of the terms for that source matches.
+    """
+    def __init__(self, terms):
+        # a list of (term index, matcher) tuples
+        self.terms = terms
+
+    def getMatchers(self):
+        return [matcher for (idx, matcher) in self.terms]
+
+    def matchingTerms(self, event):
+        return [idx for (idx, matcher) in self.terms
+                if matcher.matches(event)]
+
+    def matches(self, event):
+        for (idx, matcher) in self.terms:
+            if matcher.matches(event):
+                return True
+        return False
+
+
+class CompositeMatcher(object):
+    """ Abstract base class for matchers spanning multiple L{event
+        sources<EventSource>}. Terms are given as (source, matcher) tuples.
+
+        Rather than chaining deferreds, a composite matcher installs a
+        single hook per source and feeds every matching event into a small
+        state machine implemented by L{feed}. As soon as that completes,
+        all hooks are removed and the callback fires with the result.
+    """
+    def __init__(self, *terms, **kwargs):
+        assert len(terms) > 0, "composite matcher requires terms"
+        for term in terms:
+            assert len(term) == 2, "terms must be (source, matcher) tuples"
+        self.terms = terms
+        self.within = kwargs.pop('within', None)
+        assert len(kwargs) == 0, "unknown arguments: %s" % kwargs.keys()
+
+        self.hooks = []
+        self.callback = None
+        self.done = False
+
+    def install(self, callback, *args, **kwargs):
+        """ Start watching the event sources, calling back with the result
+            of the composition once satisfied.
+        """
+        assert callable(callback), "callback function must be callable"
+        assert self.callback is None, "composite matcher already installed"
+        self.callback = (callback, args, kwargs)
+        self.reset()
+
+        bySource = {}
+        order = []
+        for idx, (source, matcher) in enumerate(self.terms):
+            if source not in bySource:
+                bySource[source] = []
+                order.append(source)
+            bySource[source].append((idx, matcher))
+
+        for source in order:
+            matcher = SourceDispatchMatcher(bySource[source])
+            hook = source.addHook(matcher, self._cbEvent)
+            self.hooks.append(hook)
+        return self
+
+    def uninstall(self):
+        hooks, self.hooks = self.hooks, []
+        for hook in hooks:
+            hook.ev_source.removeHook(hook)
+
+    def _cbEvent(self, event):
+        # Events are delivered asynchronously, so there may be some more
+        # arriving after we are done already.
+        if self.done:
+            return
+
+        hook = None
+        for h in self.hooks:
+            if h.ev_source is event.source:
+                hook = h
+                break
+        if hook is None:
+            return
+
+        for idx in hook.matcher.matchingTerms(event):
+            result = self.feed(idx, event)
+            if result is not None:
+                self.done = True
+                self.uninstall()
+                callback, args, kwargs = self.callback
+                callback(result, *args, **kwargs)
+                return
+
+    def reset(self):
+        """ Abstract method, (re-)initializes the state machine.
+        """
+
+    def feed(self, idx, event):
+        """ Abstract method, advances the state machine with an event
+            matching the term at index idx. Returns the result as soon as
+            the composition is satisfied, None otherwise.
+        """
+
+
+class AnyOfMatcher(CompositeMatcher):
+    """ Satisfied by the first event matching any of the terms, which is
+        also the result.
+    """
+    def feed(self, idx, event):
+        return event
+
+
+class AllOfMatcher(CompositeMatcher):
+    """ Satisfied as soon as every term matched at least once. If within
+        is given, the matching events must not be further apart than that
+        many seconds. The result is the list of events in term order.
+    """
+    def reset(self):
+        self.events = [None] * len(self.terms)
+
+    def feed(self, idx, event):
+        # keep the latest event per term, giving the best chance to fit
+        # all of them into the time window.
+        self.events[idx] = event
+        if None in self.events:
+            return None
+        if self.within is not None:
+            times = [ev.time for ev in self.events]
+            if max(times) - min(times) > self.within:
+                return None
+        return list(self.events)
+
+
+class SequenceMatcher(CompositeMatcher):
+    """ Satisfied by events matching the terms one after another, in the
+        given order. If within is given, the last event must occur at most
+        that many seconds after the first one, otherwise the sequence
+        starts over. The result is the list of events in term order.
+    """
+    def reset(self):
+        self.events = []
+
+    def feed(self, idx, event):
+        # a single event must not satisfy more than one step
+        if len(self.events) > 0 and self.events[-1] is event:
+            return None
+
+        if len(self.events) > 0 and self.within is not None:
+            if event.time - self.events[0].time > self.within:
+                self.events = []
+
+        if idx == len(self.events):
+            self.events.append(event)
+        elif idx == 0:
+            # restart the sequence with the more recent event
+            self.events = [event]
+        else:
+            return None
+
+        if len(self.events) == len(self.terms):
+            return self.events
+        return None
+
+
 class StreamDataEvent(Event):
     """ An abstract class for events thrown by L{SimpleProcess} for every kind
         of output to any channel.
@@ -82,6 +336,8 @@ class StreamDataEvent(Event):
 
     name = 'DataEvent'
 
+    droppable = True
+
     def __init__(self, source, data):
         Event.__init__(self, source)
         self.data = data
@@ -112,16 +368,71 @@ class ProcessErrStreamEvent(StreamDataEvent):
     name = 'err'
 
 
+class ProcessOutputFileEvent(StreamDataEvent):
+    """ The event thrown by L{SimpleProcess} for every line appended to its
+        output file, which receives both of its standard output and error
+        channels, see the output mode 'file'.
+    """
+
+    name = 'outfile'
+
+
+class ResourceUsage(object):
+    """ Resources consumed by a process, as reported by wait4(2). CPU times
+        are in seconds, the maximum resident set size in kilobytes.
+    """
+
+    fields = ('utime', 'stime', 'maxrss', 'nvcsw', 'nivcsw', 'inblock',
+              'oublock')
+
+    def __init__(self, utime=0.0, stime=0.0, maxrss=0, nvcsw=0, nivcsw=0,
+                 inblock=0, oublock=0):
+        self.utime = utime
+        self.stime = stime
+        self.maxrss = maxrss
+        self.nvcsw = nvcsw
+        self.nivcsw = nivcsw
+        self.inblock = inblock
+        self.oublock = oublock
+
+    @classmethod
+    def fromRusage(cls, ru):
+        return cls(ru.ru_utime, ru.ru_stime, ru.ru_maxrss, ru.ru_nvcsw,
+                   ru.ru_nivcsw, ru.ru_inblock, ru.ru_oublock)
+
+    def toTuple(self):
+        return tuple(getattr(self, f) for f in self.fields)
+
+    def __add__(self, other):
+        """ Aggregates the usage of two processes. CPU times, context
+            switches and block I/O add up, whereas the maximum RSS is the
+            larger one of the two.
+        """
+        return ResourceUsage(self.utime + other.utime,
+                             self.stime + other.stime,
+                             max(self.maxrss, other.maxrss),
+                             self.nvcsw + other.nvcsw,
+                             self.nivcsw + other.nivcsw,
+                             self.inblock + other.inblock,
+                             self.oublock + other.oublock)
+
+    def __repr__(self):
+        return "user %0.2fs sys %0.2fs maxrss %dkB csw %d/%d io %d/%d" % (
+            self.toTuple())
+
+
 class ProcessEndedEvent(Event):
     """ The event thrown by L{SimpleProcess} as soon as the controlled
-        process has terminated.
+        process has terminated. Carries the L{ResourceUsage} of the
+        process, if available.
     """
 
     name = 'terminated'
 
-    def __init__(self, source, exitCode):
+    def __init__(self, source, exitCode, rusage=None):
         Event.__init__(self, source)
         self.exitCode = exitCode
+        self.rusage = rusage
 
     def __repr__(self):
         return "[%s] terminated with error code %s" % (
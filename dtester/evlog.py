@@ -0,0 +1,330 @@
+# evlog.py
+#
+# Copyright (c) 2016 Markus Wanner
+#
+# Distributed under the Boost Software License, Version 1.0. (See
+# accompanying file LICENSE).
+
+"""
+a compact, length-prefixed binary event log format, a writer thread taking
+the formatting and writing off the reactor thread and a converter to the
+traditional text format. Event logs are zlib compressed, with a sync point
+after every batch of records, so a log remains readable up to its last
+sync point, even if the writer didn't finish. Another thread merges the
+event logs of all hosts as they get completed.
+"""
+
+import os, sys, zlib, heapq, struct, threading, Queue
+
+from twisted.internet import reactor, defer
+
+from dtester.utils import parseArgs
+from dtester.evstore import EventStore
+
+# record header: timestamp, length of test name, channel and data
+RECORD_HEADER = struct.Struct("!dHHI")
+
+# maximum number of records queued for the writer thread
+MAX_QUEUED = 4096
+
+# maximum number of records written at once
+BATCH_SIZE = 512
+
+# size of the compressed chunks to read at once
+READ_SIZE = 65536
+
+
+def packRecord(t, test_name, channel, data):
+    return RECORD_HEADER.pack(t, len(test_name), len(channel), len(data)) + \
+        test_name + channel + data
+
+def iterDecompressed(path):
+    """ Yields the decompressed contents of a zlib compressed file in
+        chunks, stopping at the last complete sync point of a truncated
+        file.
+    """
+    decompressor = zlib.decompressobj()
+    fd = open(path, 'rb')
+    try:
+        while True:
+            data = fd.read(READ_SIZE)
+            if len(data) == 0:
+                break
+            try:
+                data = decompressor.decompress(data)
+            except zlib.error:
+                # corrupt, i.e. partially written data
+                break
+            if len(data) > 0:
+                yield data
+    finally:
+        fd.close()
+
+def iterDecompressedLines(path):
+    """ Yields the lines of a zlib compressed text file.
+    """
+    rest = ""
+    for data in iterDecompressed(path):
+        lines = (rest + data).split("\n")
+        rest = lines.pop()
+        for line in lines:
+            yield line + "\n"
+    if len(rest) > 0:
+        yield rest
+
+def readEventLog(path):
+    """ Yields all records of a binary event log as (time, test_name,
+        channel, data) tuples.
+    """
+    buf = ""
+    for data in iterDecompressed(path):
+        buf += data
+        offset = 0
+        while len(buf) - offset >= RECORD_HEADER.size:
+            t, name_len, channel_len, data_len = \
+                RECORD_HEADER.unpack_from(buf, offset)
+            start = offset + RECORD_HEADER.size
+            end = start + name_len + channel_len + data_len
+            if end > len(buf):
+                break
+            yield (t, buf[start:start + name_len],
+                   buf[start + name_len:start + name_len + channel_len],
+                   buf[start + name_len + channel_len:end])
+            offset = end
+        buf = buf[offset:]
+
+def formatTextRecord(t, test_name, channel, data):
+    """ Formats a record in the traditional text format of event logs.
+    """
+    return "%.6f:%s:%s:%s\n" % (t, test_name, channel, repr(data))
+
+def iterTextLines(path):
+    """ Yields the records of a binary event log in the text format.
+    """
+    for record in readEventLog(path):
+        yield formatTextRecord(*record)
+
+def convertEventLog(path, out):
+    """ Converts a binary event log to the text format, writing to the
+        given file object.
+    """
+    for line in iterTextLines(path):
+        out.write(line)
+
+
+class EventLogWriter(threading.Thread):
+    """ Writes event log records and per test report output files from a
+        thread of its own. The latter go to the given L{FileHandleCache}.
+        Appending a record only queues it, the queue being bounded to
+        MAX_QUEUED records. The writer thread writes all queued records in
+        compressed batches, flushing after each batch.
+    """
+    def __init__(self, path, reportFiles=None, errorLog=None,
+                 maxQueued=MAX_QUEUED):
+        threading.Thread.__init__(self, name="event log writer")
+        self.daemon = True
+        self.path = path
+        self.reportFiles = reportFiles
+        self.errorLog = errorLog
+        self.queue = Queue.Queue(maxQueued)
+        self.fd = open(path, 'wb')
+        self.compressor = zlib.compressobj()
+        self.closed = False
+
+    def append(self, t, test_name, channel, data):
+        """ Queues a record, blocking if the writer thread lags behind.
+        """
+        assert not self.closed, "event log already closed"
+        self.queue.put((t, test_name, channel, data))
+
+    def close(self):
+        """ Waits for all queued records to be written and closes the log.
+        """
+        if not self.closed:
+            self.closed = True
+            self.queue.put(None)
+            self.join()
+
+    def run(self):
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < BATCH_SIZE:
+                    batch.append(self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+
+            if batch[-1] is None:
+                batch.pop()
+                running = False
+
+            self.writeBatch(batch)
+
+        try:
+            self.fd.write(self.compressor.flush(zlib.Z_FINISH))
+        except Exception, e:
+            self.logError("Unable to write to event log: %s" % str(e))
+        self.fd.close()
+        if self.reportFiles:
+            self.reportFiles.close()
+
+    def writeBatch(self, batch):
+        try:
+            data = "".join([packRecord(*record) for record in batch])
+            self.fd.write(self.compressor.compress(data) +
+                          self.compressor.flush(zlib.Z_SYNC_FLUSH))
+            self.fd.flush()
+        except Exception, e:
+            self.logError("Unable to write to event log: %s" % str(e))
+
+        # When running locally, we directly write to the reportDir, if
+        # required.
+        if self.reportFiles:
+            try:
+                for t, test_name, channel, data in batch:
+                    # No timestamps in the report outputs files.
+                    self.reportFiles.write(test_name + "." + channel, data)
+            except Exception, e:
+                self.logError("Unable to write to the report outputs: %s" %
+                              str(e))
+
+    def logError(self, msg):
+        if self.errorLog:
+            reactor.callFromThread(self.errorLog, msg)
+
+
+class EventLogMerger(threading.Thread):
+    """ Merges the event logs of all hosts into the text event.log and the
+        indexed event.db in the report directory, see L{dtester.evstore}.
+        Each host's log gets stored in the event.db from a thread of its
+        own as soon as it is added, i.e. while other hosts are still being
+        torn down. Unless demultiplexed already, the data of each entry
+        also gets written to the given L{FileHandleCache} of report output
+        files on the way.
+
+        The host logs are sorted runs, kept until all have been added.
+        These then get combined by a single k-way merge, writing the
+        event.log once. Entries with equal timestamps keep their order:
+        entries of the same host keep their order, those of hosts added
+        earlier come first. Queries of the event.db yield the same order.
+    """
+    def __init__(self, reportDir, reportFiles=None, errorLog=None):
+        threading.Thread.__init__(self, name="event log merger")
+        self.daemon = True
+        self.reportDir = reportDir
+        self.reportFiles = reportFiles
+        self.errorLog = errorLog
+        self.queue = Queue.Queue()
+        self.finished = defer.Deferred()
+        self.runs = []
+
+    def add(self, host, path, demultiplexed=False):
+        """ Queues the complete event log of a host for merging, either a
+            binary one or one in the text format.
+        """
+        self.queue.put((host, path, demultiplexed))
+
+    def finish(self):
+        """ Returns a deferred fired as soon as all of the queued logs
+            have been merged.
+        """
+        self.queue.put(None)
+        return self.finished
+
+    def run(self):
+        try:
+            self.mergeAll()
+        except Exception, e:
+            self.logError("Unable to merge event logs: %s" % str(e))
+        if self.reportFiles:
+            self.reportFiles.close()
+        reactor.callFromThread(self.finished.callback, None)
+
+    def mergeAll(self):
+        store = EventStore(os.path.join(self.reportDir, "event.db"))
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            host, path, demultiplexed = item
+            try:
+                invalid = self.storeHostLog(store, host, path, demultiplexed)
+            except Exception, e:
+                self.logError("Unable to merge the event log of %s: %s" %
+                              (host, str(e)))
+                continue
+            self.runs.append((host, path, invalid))
+        store.close()
+
+        out = open(os.path.join(self.reportDir, "event.log"), 'w')
+        runs = [self.iterRun(index, host, path, invalid)
+                for index, (host, path, invalid) in enumerate(self.runs)]
+        for t, index, seq, line in heapq.merge(*runs):
+            out.write(line)
+        out.close()
+
+    def openHostLog(self, path):
+        if path.endswith(".bin.z"):
+            return iterTextLines(path)
+        else:
+            return open(path, 'r')
+
+    def storeHostLog(self, store, host, path, demultiplexed):
+        """ Stores each entry of a host's log in the event.db and writes
+            its data to the report output files. Returns the set of
+            invalid entries, by their position in the log.
+        """
+        invalid = set()
+        lines = self.openHostLog(path)
+        for seq, line in enumerate(lines):
+            t, test_name, channel, data = line.split(':', 3)
+            args = parseArgs(data, self.logError)
+            if len(args) != 1:
+                self.logError("Invalid data in the event log of %s: %s" %
+                              (host, data.rstrip("\n")))
+                invalid.add(seq)
+                continue
+            store.append(float(t), host, test_name, channel, args[0])
+
+            # output to separate log files, unless already done during
+            # the run
+            if self.reportFiles and not demultiplexed:
+                self.reportFiles.write(test_name + "." + channel, args[0])
+        lines.close()
+        return invalid
+
+    def iterRun(self, index, host, path, invalid):
+        """ Yields the sort key and the event.log line of each valid entry
+            of a host's log, the sort key being its timestamp, the index
+            of the host and the position of the entry in the log.
+        """
+        lines = self.openHostLog(path)
+        for seq, line in enumerate(lines):
+            if seq in invalid:
+                continue
+            t, test_name, channel, data = line.split(':', 3)
+            yield float(t), index, seq, "%s\t%s\t%s\t%s\t%s" % (
+                t, host, test_name, channel, data)
+        lines.close()
+
+    def logError(self, msg):
+        if self.errorLog:
+            reactor.callFromThread(self.errorLog, msg)
+
+
+def main(args):
+    if len(args) < 1 or len(args) > 2:
+        sys.stderr.write("usage: evlog.py BINARY_LOG [TEXT_LOG]\n")
+        return 1
+
+    if len(args) == 2:
+        out = open(args[1], 'w')
+    else:
+        out = sys.stdout
+    convertEventLog(args[0], out)
+    out.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,186 @@
+# evstore.py
+#
+# Copyright (c) 2016 Markus Wanner
+#
+# Distributed under the Boost Software License, Version 1.0. (See
+# accompanying file LICENSE).
+
+"""
+an indexed store for merged event logs, based on SQLite, allowing queries
+by time range, host, test and channel without scanning the entire log.
+"""
+
+import sys, time, getopt, sqlite3
+
+# number of events inserted at once
+INSERT_BATCH_SIZE = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    time REAL NOT NULL,
+    host TEXT NOT NULL,
+    test_name TEXT NOT NULL,
+    channel TEXT NOT NULL,
+    data BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_time_idx ON events (time);
+CREATE INDEX IF NOT EXISTS events_host_idx ON events (host, time);
+CREATE INDEX IF NOT EXISTS events_test_idx ON events (test_name, time);
+"""
+
+
+class EventStore:
+    """ An SQLite database of events, each with a timestamp, host, test
+        name, channel and the raw data.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.text_factory = str
+        self.conn.executescript(SCHEMA)
+        self.pending = []
+
+    def append(self, t, host, test_name, channel, data):
+        """ Adds an event, which becomes visible after the next flush.
+        """
+        self.pending.append((t, host, test_name, channel, buffer(data)))
+        if len(self.pending) >= INSERT_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending) > 0:
+            self.conn.executemany("INSERT INTO events VALUES (?, ?, ?, ?, ?)",
+                                  self.pending)
+            self.pending = []
+        self.conn.commit()
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+    def query(self, start=None, end=None, host=None, test_name=None,
+              channel=None):
+        """ Yields (time, host, test_name, channel, data) tuples of all
+            matching events in chronological order. The time range
+            includes start, but excludes end. A test_name also matches
+            all of its sub-tests, i.e. 'node2' matches 'node2.postmaster'.
+        """
+        conditions = []
+        params = []
+        if start is not None:
+            conditions.append("time >= ?")
+            params.append(start)
+        if end is not None:
+            conditions.append("time < ?")
+            params.append(end)
+        if host is not None:
+            conditions.append("host = ?")
+            params.append(host)
+        if test_name is not None:
+            # a range rather than LIKE, so the index gets used
+            conditions.append("(test_name = ? OR " +
+                              "(test_name > ? AND test_name < ?))")
+            params.extend([test_name, test_name + ".", test_name + "/"])
+        if channel is not None:
+            conditions.append("channel = ?")
+            params.append(channel)
+
+        sql = "SELECT time, host, test_name, channel, data FROM events"
+        if len(conditions) > 0:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY time, rowid"
+
+        for t, host, test_name, channel, data in \
+                self.conn.execute(sql, params):
+            yield (t, host, test_name, channel, str(data))
+
+    def getTimeRange(self):
+        """ Returns the timestamps of the first and last event.
+        """
+        return self.conn.execute(
+            "SELECT min(time), max(time) FROM events").fetchone()
+
+
+def parseTime(value, reference):
+    """ Parses either seconds since the epoch or a local time of day as
+        HH:MM[:SS[.ffffff]], the latter on the day of the reference
+        timestamp.
+    """
+    if not ":" in value:
+        return float(value)
+
+    parts = value.split(":")
+    seconds = 0.0
+    if len(parts) == 3:
+        seconds = float(parts[2])
+    day = time.localtime(reference)
+    midnight = time.mktime((day.tm_year, day.tm_mon, day.tm_mday,
+                            0, 0, 0, 0, 0, -1))
+    return midnight + int(parts[0]) * 3600 + int(parts[1]) * 60 + seconds
+
+
+def usage():
+    sys.stderr.write("""usage: evstore.py [OPTIONS] EVENT_DB
+
+Prints matching events of an event store in the text format of event.log.
+
+Options:
+    -s, --start=TIME      only events at or after TIME
+    -e, --end=TIME        only events before TIME
+    -H, --host=HOST       only events of the given host
+    -t, --test=NAME       only events of the given test and its sub-tests
+    -c, --channel=NAME    only events on the given channel, i.e. 'out'
+    -r, --raw             print just the data, like the report files
+
+TIME is either given in seconds since the epoch or as HH:MM[:SS[.ffffff]]
+on the day of the first event.
+""")
+
+
+def main(args):
+    try:
+        opts, args = getopt.getopt(args, "s:e:H:t:c:rh",
+            ["start=", "end=", "host=", "test=", "channel=", "raw", "help"])
+    except getopt.GetoptError, e:
+        sys.stderr.write("%s\n" % e)
+        usage()
+        return 1
+
+    if len(args) != 1:
+        usage()
+        return 1
+
+    store = EventStore(args[0])
+    first, last = store.getTimeRange()
+    if first is None:
+        return 0
+
+    kwargs = {}
+    raw = False
+    for opt, value in opts:
+        if opt in ("-s", "--start"):
+            kwargs['start'] = parseTime(value, first)
+        elif opt in ("-e", "--end"):
+            kwargs['end'] = parseTime(value, first)
+        elif opt in ("-H", "--host"):
+            kwargs['host'] = value
+        elif opt in ("-t", "--test"):
+            kwargs['test_name'] = value
+        elif opt in ("-c", "--channel"):
+            kwargs['channel'] = value
+        elif opt in ("-r", "--raw"):
+            raw = True
+        elif opt in ("-h", "--help"):
+            usage()
+            return 0
+
+    for t, host, test_name, channel, data in store.query(**kwargs):
+        if raw:
+            sys.stdout.write(data)
+        else:
+            sys.stdout.write("%.6f\t%s\t%s\t%s\t%s\n" % (
+                t, host, test_name, channel, repr(data)))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -48,7 +48,9 @@ class IControlledHost(Interface):
         """
 
     def recursiveList(path):
-        """ Recursively list all contents of a directory.
+        """ Recursively list all contents of a directory, as (type, path,
+            atime, mtime, ctime, size) tuples with the type being either
+            'dir' or 'file' and the path relative to the given one.
         """
 
     def recursiveRemove(path):
@@ -72,12 +74,80 @@ class IControlledHost(Interface):
         """ Adjusts a file's access and modification time.
         """
 
+    def makeDirectories(paths):
+        """ Create a number of directories at once, in the given order, so
+            parents need to precede their sub-directories. Remote hosts
+            pipeline the requests rather than waiting for each one.
+        """
+
+    def utimes(entries):
+        """ Adjusts access and modification times of a number of files,
+            given as (path, atime, mtime) tuples.
+        """
+
+    def getCacheDir():
+        """ Returns the directory for data kept across runs, i.e. cached
+            copies of source trees.
+        """
+
+    def linkTree(srcPath, destPath):
+        """ Recreates the directory tree at srcPath in the existing
+            directory destPath, hard linking the files where possible and
+            copying them otherwise.
+        """
+
+    def lockDirectory(path):
+        """ Takes an exclusive lock on a directory, shared with other runs
+            on the same host, until unlockDirectory gets called. Fails
+            rather than waiting, if the lock is held already.
+        """
+
+    def unlockDirectory(path):
+        """ Releases a lock taken by lockDirectory.
+        """
+
+    def sendTree(path, sink, ignore=None, compress=False):
+        """ Streams a tar archive of the directory tree at path to the
+            sink, as returned by receiveTree of this or another host.
+            Entries matching any of the semicolon separated ignore
+            patterns are skipped. Returns a deferred fired after having
+            written the entire archive to the sink.
+        """
+
+    def receiveTree(path, compress=False):
+        """ Returns a sink for a tar archive to be unpacked into the
+            existing directory path on the fly, preserving modification
+            times. Its write(data) and close() methods may return
+            deferreds, the latter firing when done unpacking.
+        """
+
     def dispatchCommand(cmd, *args):
         """ Dispatch a shell command to the host.
         """
 
-    def prepareProcess(name, cmdline, cwd=None, lineBasedOutput=True, ignoreOutput=False):
-        """ Prepare a process to be run, returns a Process object.
+    def prepareProcess(name, cmdline, cwd=None, lineBasedOutput=True,
+                       ignoreOutput=False, usePTY=False, outputMode=None,
+                       stopSchedule=None):
+        """ Prepare a process to be run, returns a Process object. Unless
+            usePTY is set, the process' stdout and stderr are connected via
+            separate pipes. The outputMode 'discard' redirects all output
+            to /dev/null. The stopSchedule defines the escalation of
+            signals sent to the process group when stopping the process.
+        """
+
+    def prepareProcesses(specs):
+        """ Prepare a group of processes to be run at once, for example
+            the nodes of a cluster. Each spec is a dict with the keys
+            'name' and 'cmdline', an optional 'env' dict of environment
+            variables to add and any other keyword argument accepted by
+            prepareProcess. Returns the list of Process objects and a
+            deferred fired with the list of their exit codes as soon as
+            all of them terminated.
+        """
+
+    def startAll(procs):
+        """ Start all of the given processes, as prepared by
+            prepareProcesses, in one go.
         """
 
     def uploadFile(srcPath, destPath):
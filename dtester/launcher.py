@@ -0,0 +1,274 @@
+# launcher.py
+#
+# Copyright (c) 2016 Markus Wanner
+#
+# Distributed under the Boost Software License, Version 1.0. (See
+# accompanying file LICENSE).
+
+"""
+an optional pre-forked process launcher, spawning processes from a small
+helper process instead of forking the test harness itself.
+"""
+
+import os, sys, signal, marshal
+
+from twisted.internet import protocol, reactor, defer, error
+from twisted.python import failure
+
+from dtester import launchhelper
+from dtester.events import ResourceUsage
+from dtester.launchhelper import HEADER, MSG_SPAWN, MSG_WRITE, \
+    MSG_CLOSE_STDIN, MSG_SIGNAL, MSG_SIGNAL_GROUP, MSG_PAUSE, MSG_RESUME, \
+    MSG_STARTED, MSG_FAILED, MSG_OUT, MSG_ERR, MSG_EXITED, MSG_DRAINED
+
+
+class LauncherProtocol(protocol.ProcessProtocol):
+    """ Protocol for the communication with the launch helper process.
+    """
+    def __init__(self, launcher):
+        self.launcher = launcher
+        self.buffer = ""
+
+    def outReceived(self, data):
+        buf = self.buffer + data
+        offset = 0
+        while len(buf) - offset >= HEADER.size:
+            msgtype, jobid, length = HEADER.unpack_from(buf, offset)
+            end = offset + HEADER.size + length
+            if end > len(buf):
+                break
+            self.launcher.processMessage(msgtype, jobid,
+                                         buf[offset + HEADER.size:end])
+            offset = end
+        self.buffer = buf[offset:]
+
+    def errReceived(self, data):
+        self.launcher.helperErrReceived(data)
+
+    def processEnded(self, status):
+        self.launcher.helperEnded(status)
+
+
+class LaunchedProcess:
+    """ The transport of a process spawned via the L{ProcessLauncher},
+        mimicking the relevant parts of twisted's process transports.
+    """
+    def __init__(self, launcher, jobid, proto, args, usePTY):
+        self.launcher = launcher
+        self.jobid = jobid
+        self.proto = proto
+        self.args = args
+        self.usePTY = usePTY
+        self.pid = None
+        self.rusage = None
+        self.producer = None
+        self.streamingProducer = False
+
+    def write(self, data):
+        self.launcher.sendMessage(MSG_WRITE, self.jobid, data)
+        if self.producer is not None and self.streamingProducer:
+            self.producer.pauseProducing()
+
+    def registerProducer(self, producer, streaming):
+        """ Registers a producer for the process' input. It gets resumed
+            whenever the launch helper reports having written all of the
+            input sent so far.
+        """
+        assert self.producer is None, "producer already registered"
+        self.producer = producer
+        self.streamingProducer = streaming
+        if not streaming:
+            producer.resumeProducing()
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def inputDrained(self):
+        if self.producer is not None:
+            self.producer.resumeProducing()
+
+    def connectionLost(self):
+        if self.producer is not None:
+            producer, self.producer = self.producer, None
+            producer.stopProducing()
+
+    def writeSequence(self, seq):
+        self.write("".join(seq))
+
+    def closeStdin(self):
+        # Just like with twisted's PTYProcess, closing stdin is a no-op
+        # for processes running in a pty.
+        if not self.usePTY:
+            self.launcher.sendMessage(MSG_CLOSE_STDIN, self.jobid)
+
+    def loseConnection(self):
+        self.closeStdin()
+
+    def signalProcess(self, sig):
+        if isinstance(sig, str):
+            sig = getattr(signal, 'SIG' + sig)
+        self.launcher.sendMessage(MSG_SIGNAL, self.jobid, str(sig))
+
+    def signalProcessGroup(self, sig):
+        if isinstance(sig, str):
+            sig = getattr(signal, 'SIG' + sig)
+        self.launcher.sendMessage(MSG_SIGNAL_GROUP, self.jobid, str(sig))
+
+    def pauseProducing(self):
+        self.launcher.sendMessage(MSG_PAUSE, self.jobid)
+
+    def resumeProducing(self):
+        self.launcher.sendMessage(MSG_RESUME, self.jobid)
+
+
+class ProcessLauncher:
+    """ Controls a single launch helper process, which forks and execs
+        processes on request. Started once per run, this saves forking
+        the (large) harness process and allocating a pty for short-lived
+        commands. Processes spawned this way are driven by the usual
+        process protocols, see L{spawnProcess}.
+
+        Upon stopping, the helper terminates processes still running and
+        kills them after killTimeout seconds. If the helper doesn't
+        terminate within stopTimeout seconds, it gets killed itself.
+    """
+    def __init__(self, executable=sys.executable, killTimeout=5.0,
+                 stopTimeout=10.0):
+        self.executable = executable
+        self.helperPath = os.path.splitext(launchhelper.__file__)[0] + ".py"
+        self.killTimeout = killTimeout
+        self.stopTimeout = stopTimeout
+        self.transport = None
+        self.jobs = {}
+        self.job_counter = 1
+        self.stopDeferred = None
+        self.stopTimer = None
+        self.log = None
+
+    def start(self, log=None):
+        self.log = log
+        self.transport = reactor.spawnProcess(LauncherProtocol(self),
+            self.executable, args=[self.executable, '-S', self.helperPath,
+                                   str(self.killTimeout)],
+            env=dict(os.environ), usePTY=False)
+
+    def stop(self):
+        """ Closes the launch helper's command channel, it then terminates
+            the processes still running. Returns a deferred fired upon
+            its termination.
+        """
+        if self.transport is None:
+            return defer.succeed(None)
+        if self.stopDeferred is None:
+            self.stopDeferred = defer.Deferred()
+            self.stopTimer = reactor.callLater(self.stopTimeout,
+                                               self.stopTimedOut)
+            self.transport.closeStdin()
+        return self.stopDeferred
+
+    def stopTimedOut(self):
+        self.stopTimer = None
+        if self.transport is None:
+            return
+        for jobid, transport in sorted(self.jobs.iteritems()):
+            self.logMessage("launcher: job %d (pid %s) still alive: %s" % (
+                jobid, transport.pid, " ".join(transport.args)))
+        self.logMessage("launcher did not terminate, killing it")
+        try:
+            self.transport.signalProcess('KILL')
+        except error.ProcessExitedAlready:
+            pass
+
+    def isRunning(self):
+        return self.transport is not None
+
+    def spawnProcess(self, processProtocol, executable, args=(), env={},
+                     path=None, usePTY=False, outputPath=None):
+        """ Spawns a process via the launch helper, with the same
+            semantics as reactor.spawnProcess. Instead of childFDs, it
+            allows redirecting stdout and stderr to the file at outputPath.
+        """
+        assert self.transport is not None, "launcher not running"
+
+        jobid = self.job_counter
+        self.job_counter += 1
+
+        transport = LaunchedProcess(self, jobid, processProtocol,
+                                    list(args), usePTY)
+        self.jobs[jobid] = transport
+        self.sendMessage(MSG_SPAWN, jobid, marshal.dumps(
+            (executable, list(args), path, dict(env), bool(usePTY),
+             outputPath)))
+        processProtocol.makeConnection(transport)
+        return transport
+
+    def sendMessage(self, msgtype, jobid, payload=""):
+        if self.transport is not None:
+            self.transport.write(HEADER.pack(msgtype, jobid, len(payload)) +
+                                 payload)
+
+    def processMessage(self, msgtype, jobid, payload):
+        if not jobid in self.jobs:
+            self.logMessage("launcher sent message for unknown job %d" %
+                            jobid)
+            return
+        transport = self.jobs[jobid]
+
+        if msgtype == MSG_STARTED:
+            transport.pid = int(payload)
+        elif msgtype == MSG_FAILED:
+            transport.proto.childDataReceived(2,
+                "failed to launch process: %s\n" % payload)
+        elif msgtype == MSG_OUT:
+            transport.proto.childDataReceived(1, payload)
+        elif msgtype == MSG_ERR:
+            transport.proto.childDataReceived(2, payload)
+        elif msgtype == MSG_DRAINED:
+            transport.inputDrained()
+        elif msgtype == MSG_EXITED:
+            del self.jobs[jobid]
+            transport.connectionLost()
+            status, rusage = marshal.loads(payload)
+            if rusage is not None:
+                transport.rusage = ResourceUsage(*rusage)
+            if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+                reason = failure.Failure(error.ProcessDone(status))
+            elif os.WIFEXITED(status):
+                reason = failure.Failure(error.ProcessTerminated(
+                    exitCode=os.WEXITSTATUS(status), status=status))
+            else:
+                reason = failure.Failure(error.ProcessTerminated(
+                    signal=os.WTERMSIG(status), status=status))
+            transport.pid = None
+            transport.proto.processExited(reason)
+            transport.proto.processEnded(reason)
+        else:
+            self.logMessage("launcher sent unknown message type %d" %
+                            msgtype)
+
+    def helperErrReceived(self, data):
+        self.logMessage("launcher: %s" % data.rstrip())
+
+    def helperEnded(self, status):
+        self.transport = None
+        if self.stopTimer is not None:
+            self.stopTimer.cancel()
+            self.stopTimer = None
+
+        # Terminate all processes that the helper failed to report on.
+        jobs, self.jobs = self.jobs, {}
+        if len(jobs) > 0:
+            self.logMessage("launcher terminated with %d processes left" %
+                            len(jobs))
+        for jobid, transport in jobs.iteritems():
+            transport.connectionLost()
+            reason = failure.Failure(error.ProcessTerminated(exitCode=255))
+            transport.proto.processEnded(reason)
+
+        if self.stopDeferred is not None:
+            d, self.stopDeferred = self.stopDeferred, None
+            d.callback(None)
+
+    def logMessage(self, msg):
+        if self.log:
+            self.log(msg)
@@ -0,0 +1,417 @@
+#!/usr/bin/env python
+
+"""
+launchhelper.py
+
+A tiny process launcher, started once per run by L{dtester.launcher}. It
+receives spawn requests over its standard input and forks and execs
+processes from its own small address space, rather than from the much
+larger test harness. Output and termination of these processes is
+streamed back over its standard output. Once its standard input is
+closed, remaining processes are terminated and, after the given number of
+seconds, killed.
+
+Deliberately restricted to the standard library, as it's meant to be run
+with 'python -S'.
+
+Copyright (c) 2016 Markus Wanner
+
+Distributed under the Boost Software License, Version 1.0. (See
+accompanying file LICENSE).
+"""
+
+import os, sys, pty, time, errno, fcntl, select, signal, struct, marshal, \
+    termios
+
+# frame header: message type, job id, payload length
+HEADER = struct.Struct("!BII")
+
+# requests from the controller
+MSG_SPAWN = 1
+MSG_WRITE = 2
+MSG_CLOSE_STDIN = 3
+MSG_SIGNAL = 4
+MSG_PAUSE = 5
+MSG_RESUME = 6
+MSG_SIGNAL_GROUP = 7
+
+# replies to the controller
+MSG_STARTED = 11
+MSG_FAILED = 12
+MSG_OUT = 13
+MSG_ERR = 14
+MSG_EXITED = 15
+MSG_DRAINED = 16
+
+READ_SIZE = 65536
+
+# seconds between terminating and killing the remaining processes
+KILL_TIMEOUT = 5.0
+
+
+def setCloseOnExec(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+def setNonBlocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+class Child:
+
+    def __init__(self, jobid, pid, in_fd, out_fds, use_pty):
+        self.jobid = jobid
+        self.pid = pid
+        self.in_fd = in_fd
+        # maps file descriptors to the message type to use for output
+        self.out_fds = out_fds
+        self.use_pty = use_pty
+        self.in_buffer = ""
+        self.close_stdin_pending = False
+        self.paused = False
+        self.status = None
+        self.rusage = None
+
+
+class Launcher:
+
+    def __init__(self, cmdfd, outfd, killTimeout=KILL_TIMEOUT):
+        self.cmdfd = cmdfd
+        self.outfd = outfd
+        self.cmdBuffer = ""
+        self.cmdClosed = False
+        self.killTimeout = killTimeout
+        self.killDeadline = None
+
+        self.children = {}
+        self.childrenByPid = {}
+        self.readers = {}
+
+        # SIGCHLD wakes up the select loop via a self-pipe
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        for fd in (self.wakeup_r, self.wakeup_w):
+            setCloseOnExec(fd)
+            setNonBlocking(fd)
+        signal.set_wakeup_fd(self.wakeup_w)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+    def send(self, msgtype, jobid, payload=""):
+        data = HEADER.pack(msgtype, jobid, len(payload)) + payload
+        while len(data) > 0:
+            try:
+                written = os.write(self.outfd, data)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            data = data[written:]
+
+    def run(self):
+        while not self.cmdClosed or len(self.children) > 0:
+            rlist = [self.wakeup_r]
+            if not self.cmdClosed:
+                rlist.append(self.cmdfd)
+            wlist = []
+            for child in self.children.itervalues():
+                if not child.paused:
+                    rlist.extend(child.out_fds.keys())
+                if child.in_fd is not None and len(child.in_buffer) > 0:
+                    wlist.append(child.in_fd)
+
+            timeout = None
+            if self.killDeadline is not None:
+                timeout = max(0.0, self.killDeadline - time.time())
+
+            try:
+                readable, writable, ignored = select.select(rlist, wlist, [],
+                                                            timeout)
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            if self.killDeadline is not None and \
+                    time.time() >= self.killDeadline:
+                self.killDeadline = None
+                self.signalChildren(signal.SIGKILL)
+
+            if self.wakeup_r in readable:
+                self.drainWakeupPipe()
+                self.reapChildren()
+
+            if self.cmdfd in readable:
+                self.readCommands()
+
+            for fd in readable:
+                if fd in self.readers:
+                    self.readChildOutput(fd)
+
+            for fd in writable:
+                self.writeChildInput(fd)
+
+            self.reapChildren()
+
+    def drainWakeupPipe(self):
+        try:
+            while os.read(self.wakeup_r, 4096):
+                pass
+        except OSError, e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def readCommands(self):
+        data = os.read(self.cmdfd, READ_SIZE)
+        if len(data) == 0:
+            # The controller is done, don't let left-over processes keep
+            # the launcher running.
+            self.cmdClosed = True
+            if len(self.children) > 0:
+                self.signalChildren(signal.SIGTERM)
+                self.killDeadline = time.time() + self.killTimeout
+            return
+
+        buf = self.cmdBuffer + data
+        offset = 0
+        while len(buf) - offset >= HEADER.size:
+            msgtype, jobid, length = HEADER.unpack_from(buf, offset)
+            end = offset + HEADER.size + length
+            if end > len(buf):
+                break
+            self.processCommand(msgtype, jobid,
+                                buf[offset + HEADER.size:end])
+            offset = end
+        self.cmdBuffer = buf[offset:]
+
+    def processCommand(self, msgtype, jobid, payload):
+        if msgtype == MSG_SPAWN:
+            self.spawn(jobid, *marshal.loads(payload))
+            return
+
+        child = self.children.get(jobid)
+        if child is None:
+            # the process may well have terminated in the meantime
+            return
+
+        if msgtype == MSG_WRITE:
+            if child.in_fd is not None:
+                child.in_buffer += payload
+        elif msgtype == MSG_CLOSE_STDIN:
+            if len(child.in_buffer) > 0:
+                child.close_stdin_pending = True
+            else:
+                self.closeStdin(child)
+        elif msgtype == MSG_SIGNAL:
+            try:
+                os.kill(child.pid, int(payload))
+            except OSError:
+                pass
+        elif msgtype == MSG_SIGNAL_GROUP:
+            try:
+                os.killpg(child.pid, int(payload))
+            except OSError:
+                pass
+        elif msgtype == MSG_PAUSE:
+            child.paused = True
+        elif msgtype == MSG_RESUME:
+            child.paused = False
+
+    def signalChildren(self, sig):
+        # Each process leads a process group of its own, including its
+        # children.
+        for child in self.children.itervalues():
+            if child.status is None:
+                try:
+                    os.killpg(child.pid, sig)
+                except OSError:
+                    pass
+
+    def spawn(self, jobid, executable, args, cwd, env, use_pty,
+              out_path=None):
+        # Open the output file first, failing early.
+        out_fd = None
+        if out_path and not use_pty:
+            try:
+                out_fd = os.open(out_path,
+                                 os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+            except OSError, e:
+                self.send(MSG_FAILED, jobid,
+                          "%s: %s" % (os.strerror(e.errno), out_path))
+                self.send(MSG_EXITED, jobid, marshal.dumps((127 << 8, None)))
+                return
+
+        # The error pipe is closed by a successful exec. Otherwise, the
+        # child reports the errno before exiting.
+        err_r, err_w = os.pipe()
+        setCloseOnExec(err_w)
+
+        if use_pty:
+            master, slave = pty.openpty()
+            setCloseOnExec(master)
+            child_fds = (slave, slave, slave)
+        elif out_fd is not None:
+            in_r, in_w = os.pipe()
+            setCloseOnExec(in_w)
+            child_fds = (in_r, out_fd, out_fd)
+        else:
+            in_r, in_w = os.pipe()
+            out_r, out_w = os.pipe()
+            errout_r, errout_w = os.pipe()
+            for fd in (in_w, out_r, errout_r):
+                setCloseOnExec(fd)
+            child_fds = (in_r, out_w, errout_w)
+
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(err_r)
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                # either way, the process leads a process group of its own
+                if use_pty:
+                    os.setsid()
+                    fcntl.ioctl(slave, termios.TIOCSCTTY, 0)
+                else:
+                    os.setpgid(0, 0)
+                for target, fd in enumerate(child_fds):
+                    os.dup2(fd, target)
+                for fd in set(child_fds):
+                    if fd > 2:
+                        os.close(fd)
+                if cwd:
+                    os.chdir(cwd)
+                os.execve(executable, args, env)
+            except OSError, e:
+                os.write(err_w, str(e.errno))
+            except Exception, e:
+                os.write(err_w, "0")
+            os._exit(127)
+
+        # parent
+        os.close(err_w)
+        for fd in set(child_fds):
+            os.close(fd)
+
+        result = ""
+        while True:
+            try:
+                data = os.read(err_r, 64)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if len(data) == 0:
+                break
+            result += data
+        os.close(err_r)
+
+        if use_pty:
+            setNonBlocking(master)
+            child = Child(jobid, pid, master, {master: MSG_OUT}, True)
+        elif out_fd is not None:
+            setNonBlocking(in_w)
+            child = Child(jobid, pid, in_w, {}, False)
+        else:
+            setNonBlocking(in_w)
+            child = Child(jobid, pid, in_w,
+                          {out_r: MSG_OUT, errout_r: MSG_ERR}, False)
+
+        self.children[jobid] = child
+        self.childrenByPid[pid] = child
+        for fd in child.out_fds:
+            self.readers[fd] = child
+
+        if len(result) > 0:
+            code = int(result)
+            self.send(MSG_FAILED, jobid,
+                      "%s: %s" % (os.strerror(code), executable))
+        else:
+            self.send(MSG_STARTED, jobid, str(pid))
+
+    def writeChildInput(self, fd):
+        for child in self.children.values():
+            if child.in_fd == fd and len(child.in_buffer) > 0:
+                try:
+                    written = os.write(fd, child.in_buffer)
+                except OSError, e:
+                    if e.errno in (errno.EINTR, errno.EAGAIN):
+                        return
+                    # the child closed its end, discard the input
+                    child.in_buffer = ""
+                    return
+                child.in_buffer = child.in_buffer[written:]
+                if len(child.in_buffer) == 0:
+                    # lets the controller send more input
+                    self.send(MSG_DRAINED, child.jobid)
+                    if child.close_stdin_pending:
+                        self.closeStdin(child)
+
+    def closeStdin(self, child):
+        if child.in_fd is None:
+            return
+        if child.use_pty:
+            # cannot close just one direction of a pty, send an EOT
+            # instead.
+            try:
+                os.write(child.in_fd, "\x04")
+            except OSError:
+                pass
+        else:
+            os.close(child.in_fd)
+            child.in_fd = None
+
+    def readChildOutput(self, fd):
+        child = self.readers[fd]
+        try:
+            data = os.read(fd, READ_SIZE)
+        except OSError, e:
+            if e.errno in (errno.EINTR, errno.EAGAIN):
+                return
+            # EIO signals the end of a pty's output
+            data = ""
+
+        if len(data) > 0:
+            self.send(child.out_fds[fd], child.jobid, data)
+        else:
+            del self.readers[fd]
+            del child.out_fds[fd]
+            if child.use_pty:
+                child.in_fd = None
+            os.close(fd)
+
+    def reapChildren(self):
+        while len(self.childrenByPid) > 0:
+            try:
+                pid, status, ru = os.wait4(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                elif e.errno == errno.ECHILD:
+                    break
+                raise
+            if pid == 0:
+                break
+            if pid in self.childrenByPid:
+                child = self.childrenByPid[pid]
+                child.status = status
+                child.rusage = (ru.ru_utime, ru.ru_stime, ru.ru_maxrss,
+                                ru.ru_nvcsw, ru.ru_nivcsw, ru.ru_inblock,
+                                ru.ru_oublock)
+
+        # Only report termination after having forwarded all of the
+        # output.
+        for jobid, child in self.children.items():
+            if child.status is not None and len(child.out_fds) == 0:
+                if child.in_fd is not None:
+                    os.close(child.in_fd)
+                del self.children[jobid]
+                del self.childrenByPid[child.pid]
+                self.send(MSG_EXITED, jobid,
+                          marshal.dumps((child.status, child.rusage)))
+
+
+if __name__ == "__main__":
+    killTimeout = KILL_TIMEOUT
+    if len(sys.argv) > 1:
+        killTimeout = float(sys.argv[1])
+    launcher = Launcher(sys.stdin.fileno(), sys.stdout.fileno(), killTimeout)
+    launcher.run()
@@ -9,21 +9,27 @@ Distributed under the Boost Software License, Version 1.0. (See
 accompanying file LICENSE).
 """
 
-import os, struct, shlex, exceptions
+import os, struct, shlex, exceptions, collections
 
 from zope.interface import implements
 
 from twisted.python import failure
-from twisted.internet import protocol, reactor, defer, endpoints
+from twisted.internet import protocol, reactor, defer, endpoints, threads
 from twisted.conch.ssh import common, channel, connection, filetransfer, \
                               userauth, session, transport, keys
 from twisted.conch.client import default, direct, options
 
 from dtester import utils
+from dtester.evlog import iterDecompressedLines
+from dtester.processes import StdinFeedMixin, DEFAULT_STOP_SCHEDULE, \
+                              stopScheduleFrom, formatStopSchedule
 from dtester.test import TestSuite
+from dtester.basics import ProcessGroupMixin
 from dtester.interfaces import IControllableHost, IControlledHost
 from dtester.events import EventSource, EventMatcher, \
-                           ProcessOutStreamEvent,  ProcessErrStreamEvent
+                           SourceDispatchMatcher, ResourceUsage, \
+                           ProcessOutStreamEvent,  ProcessErrStreamEvent, \
+                           ProcessEndedEvent
 
 class RemoteShellChannel(channel.SSHChannel):
     name = 'session'
@@ -123,6 +129,14 @@ class RemoteHelperChannel(channel.SSHChannel, CommandProcessor):
         self.outBuffer = ""
         self.exitCode = None
 
+        # set once switched to the binary protocol, see useProtocol
+        self.binary = False
+        self.decoder = None
+
+        # requests collected to be sent in a single write
+        self.batchDepth = 0
+        self.batch = []
+
     def request_exit_signal(self, data):
         print "exit_signal: '%s'" % repr(data)
 
@@ -145,6 +159,10 @@ class RemoteHelperChannel(channel.SSHChannel, CommandProcessor):
         self.parent.remoteHelperFailed(failure)
 
     def dataReceived(self, data):
+        if self.decoder:
+            self.processFrames(data)
+            return
+
         buf = self.outBuffer + data
         idx = buf.find("\n")
         while idx >= 0:
@@ -160,14 +178,40 @@ class RemoteHelperChannel(channel.SSHChannel, CommandProcessor):
 
             self.parseCommand(line)
             buf = buf[idx+1:]
+
+            if self.decoder:
+                # the helper switched to the binary protocol
+                self.outBuffer = ""
+                self.processFrames(buf)
+                return
             idx = buf.find("\n")
 
         self.outBuffer = buf
 
+    def processFrames(self, data):
+        try:
+            frames = self.decoder.feed(data)
+        except (ValueError, struct.error), e:
+            self.logParserError(str(e))
+            return
+        for cmd, args in frames:
+            self.parent.processCommand(cmd, args)
+
+    def useProtocol(self, protocol):
+        """ Switches to the binary protocol, which the helper acknowledges
+            with a final 'protocol' reply in text form.
+        """
+        assert protocol == utils.BINARY_PROTOCOL
+        self.write("use_protocol 0 %s\n" % repr(protocol))
+        self.binary = True
+
     # CommandProcessor method overrides
     def processCommand(self, cmd, args):
         # self.parent.runner.log("DEBUG: cmd: %s, args: %s" % (cmd, repr(args)))
-        self.parent.processCommand(cmd, args)
+        if cmd == "protocol":
+            self.decoder = utils.FrameDecoder()
+        else:
+            self.parent.processCommand(cmd, args)
 
     def logParserError(self, msg):
         self.parent.runner.log("WARNING: " + msg)
@@ -188,13 +232,36 @@ class RemoteHelperChannel(channel.SSHChannel, CommandProcessor):
 
     # called from the suite
     def custom_request(self, cmd, jobid, *args):
-        msg = "%s %d" % (cmd, jobid)
         while len(args) > 0 and args[-1] is None:
             args = args[:-1]
-        for arg in args:
-            assert arg is not None
-            msg += " %s" % repr(arg)
-        self.write(msg + "\n")
+        assert not None in args
+        if self.binary:
+            msg = utils.encodeFrame(cmd, (jobid,) + args)
+        elif len(args) > 0:
+            msg = "%s %d %s\n" % (cmd, jobid, utils.formatArgs(args))
+        else:
+            msg = "%s %d\n" % (cmd, jobid)
+        if self.batchDepth > 0:
+            self.batch.append(msg)
+        else:
+            self.write(msg)
+
+    def beginBatch(self):
+        """ Starts collecting requests, rather than sending them one by
+            one. Batches may be nested.
+        """
+        self.batchDepth += 1
+
+    def endBatch(self):
+        """ Sends all of the requests collected in a single write, once
+            the outermost batch ends.
+        """
+        assert self.batchDepth > 0
+        self.batchDepth -= 1
+        if self.batchDepth == 0 and len(self.batch) > 0:
+            data = "".join(self.batch)
+            self.batch = []
+            self.write(data)
 
 
 class RemoteProcessExecutionChannel(channel.SSHChannel):
@@ -265,6 +332,9 @@ class SftpChannel(channel.SSHChannel):
         self.sftpCallback = sftpCallback
 
     def channelOpen(self, ignoredData):
+        # the window granted by the server, limiting the amount of data
+        # worth sending ahead
+        self.initialRemoteWindow = self.remoteWindowLeft
         d = self.conn.sendRequest(
             self, 'subsystem', common.NS('sftp'), wantReply=True)
         d.addCallback(self.openSftpClient)
@@ -276,6 +346,156 @@ class SftpChannel(channel.SSHChannel):
         self.sftpCallback(client)
 
 
+class ChunkedUpload:
+    """ Writes a local file to an open remote file, keeping up to window
+        write requests in flight, rather than waiting for each one to
+        complete. Further limited to maxBytes of data in flight, as data
+        exceeding the channel's window only piles up in its buffer. The
+        local file is read from a thread, so as not to block the reactor.
+    """
+    def __init__(self, remoteFd, localFd, chunkSize, window, maxBytes):
+        self.remoteFd = remoteFd
+        self.localFd = localFd
+        self.chunkSize = chunkSize
+        self.window = window
+        self.maxBytes = maxBytes
+        self.offset = 0
+        self.inFlight = 0
+        self.bytesInFlight = 0
+        self.reading = False
+        self.eof = False
+        self.failure = None
+        self.deferred = defer.Deferred()
+
+    def start(self):
+        """ Returns a deferred fired with the remote file, as soon as all
+            of the data has been written.
+        """
+        self.readMore()
+        return self.deferred
+
+    def readMore(self):
+        if self.reading or self.eof or self.failure is not None or \
+                self.inFlight >= self.window:
+            return
+        if self.inFlight > 0 and \
+                self.bytesInFlight + self.chunkSize > self.maxBytes:
+            return
+        self.reading = True
+        d = threads.deferToThread(self.localFd.read, self.chunkSize)
+        d.addCallbacks(self.gotData, self.readFailed)
+
+    def gotData(self, data):
+        self.reading = False
+        if len(data) < self.chunkSize:
+            self.eof = True
+        if len(data) > 0:
+            self.inFlight += 1
+            self.bytesInFlight += len(data)
+            d = self.remoteFd.writeChunk(self.offset, data)
+            d.addCallbacks(self.chunkWritten, self.writeFailed,
+                           callbackArgs=(len(data),),
+                           errbackArgs=(len(data),))
+            self.offset += len(data)
+        self.readMore()
+        self.checkDone()
+
+    def readFailed(self, failure):
+        self.reading = False
+        self.failed(failure)
+
+    def chunkWritten(self, result, length):
+        self.inFlight -= 1
+        self.bytesInFlight -= length
+        self.readMore()
+        self.checkDone()
+
+    def writeFailed(self, failure, length):
+        self.inFlight -= 1
+        self.bytesInFlight -= length
+        self.failed(failure)
+
+    def failed(self, failure):
+        if self.failure is None:
+            self.failure = failure
+        self.checkDone()
+
+    def checkDone(self):
+        # Waits for all requests to complete, even after a failure.
+        if self.reading or self.inFlight > 0 or self.deferred.called:
+            return
+        if self.failure is not None:
+            self.deferred.errback(self.failure)
+        elif self.eof:
+            self.deferred.callback(self.remoteFd)
+
+
+class ChunkedDownload:
+    """ Reads an open remote file into a local one, keeping up to window
+        read requests in flight. A short read indicates a limit of the
+        server, so the missing part gets requested separately and the
+        chunk size is adapted for further requests.
+    """
+    def __init__(self, remoteFd, localFd, chunkSize, window):
+        self.remoteFd = remoteFd
+        self.localFd = localFd
+        self.chunkSize = chunkSize
+        self.window = window
+        self.offset = 0
+        self.inFlight = 0
+        self.eof = False
+        self.failure = None
+        self.deferred = defer.Deferred()
+
+    def start(self):
+        """ Returns a deferred fired with the remote file, as soon as all
+            of its data has been written to the local file.
+        """
+        self.requestMore()
+        return self.deferred
+
+    def requestMore(self):
+        while not self.eof and self.failure is None and \
+                self.inFlight < self.window:
+            self.requestChunk(self.offset, self.chunkSize)
+            self.offset += self.chunkSize
+
+    def requestChunk(self, offset, length):
+        self.inFlight += 1
+        d = self.remoteFd.readChunk(offset, length)
+        d.addCallbacks(self.gotChunk, self.readFailed,
+                       callbackArgs=(offset, length))
+
+    def gotChunk(self, data, offset, length):
+        self.inFlight -= 1
+        if len(data) == 0:
+            self.eof = True
+        else:
+            self.localFd.seek(offset)
+            self.localFd.write(data)
+            if len(data) < length:
+                self.chunkSize = min(self.chunkSize, len(data))
+                self.requestChunk(offset + len(data), length - len(data))
+        self.requestMore()
+        self.checkDone()
+
+    def readFailed(self, failure):
+        self.inFlight -= 1
+        if failure.check(EOFError):
+            self.eof = True
+        elif self.failure is None:
+            self.failure = failure
+        self.checkDone()
+
+    def checkDone(self):
+        if self.inFlight > 0 or self.deferred.called:
+            return
+        if self.failure is not None:
+            self.deferred.errback(self.failure)
+        elif self.eof:
+            self.deferred.callback(self.remoteFd)
+
+
 class SimpleSSHConnection(connection.SSHConnection):
 
     def __init__(self, parent):
@@ -373,6 +593,11 @@ class SimpleSSHTransport(transport.SSHClientTransport):
         self.maxSftpClients = 4
         self.sftpQueue = []
 
+        # size of the chunks read or written per SFTP request and the
+        # maximum number of requests in flight per file
+        self.sftpChunkSize = 65536
+        self.sftpWindow = 16
+
     def passwordErrorFor(self, user, host):
         if (user, host) not in self.passwordErrors:
             self.passwordErrors.append((user, host))
@@ -563,47 +788,15 @@ class SimpleSSHTransport(transport.SSHClientTransport):
         return d
 
     def triggerDataUpload(self, remoteFd, localFd):
-        return self.uploadFileChunk(None, remoteFd, localFd, 0)
+        channel = remoteFd.parent.transport
+        upload = ChunkedUpload(remoteFd, localFd, self.sftpChunkSize,
+                               self.sftpWindow, channel.initialRemoteWindow)
+        return upload.start()
 
     def triggerDataDownload(self, remoteFd, localFd):
-        return self.downloadFileChunk(remoteFd, localFd, 0)
-
-    def uploadFileChunk(self, ignoredResult, remoteFd, localFd, offset):
-        #self.factory.runner.log("uploadFileChunk (offset: %d, result: %s)" % (offset, repr(ignoredResult)))
-
-        # synchronous read from local file
-        CHUNK_SIZE = 8192
-        data = localFd.read(CHUNK_SIZE)
-
-        d = remoteFd.writeChunk(offset, data)
-        if len(data) == CHUNK_SIZE:
-            d.addCallback(self.uploadFileChunk, remoteFd, localFd, offset + len(data))
-            return d
-        else:
-            #self.factory.runner.log("wrote %d bytes in total." % (offset + len(data)))
-            return remoteFd
-
-    def downloadFileChunk(self, remoteFd, localFd, offset=0):
-        #self.factory.runner.log("downloadFileChunk (offset: %d)" % offset)
-
-        # synchronous read from local file
-        CHUNK_SIZE = 8192
-        d = remoteFd.readChunk(offset, CHUNK_SIZE)
-        d.addCallback(self.writeDownloadedData, remoteFd, localFd, offset)
-        d.addErrback(self.handleEOF, remoteFd, localFd)
-        return d
-
-    def writeDownloadedData(self, data, remoteFd, localFd, offset):
-        if len(data) > 0:
-            localFd.write(data)
-            return self.downloadFileChunk(remoteFd, localFd, offset + len(data))
-        else:
-            return remoteFd
-
-    def handleEOF(self, failure, remoteFd, localFd):
-        failure.trap(exceptions.EOFError)
-        #self.factory.runner.log("download completed")
-        return remoteFd
+        download = ChunkedDownload(remoteFd, localFd, self.sftpChunkSize,
+                                   self.sftpWindow)
+        return download.start()
 
     def openFileToUpload(self, client, path):
         # self.factory.runner.log("openFileToUpload")
@@ -657,63 +850,134 @@ class SSHClientFactory(protocol.ClientFactory):
         protocol.ClientFactory.clientConnectionFailed(self, connector, reason)
 
 
-class RemoteProcess(EventSource):
+class RemoteProcess(EventSource, StdinFeedMixin):
 
-    def __init__(self, parent, name, td, jobid):
+    # number of chunks fed, but not acknowledged by the remote helper
+    FEED_WINDOW = 4
+
+    def __init__(self, parent, name, td, jobid, usePTY=False,
+                 stopSchedule=None):
         EventSource.__init__(self)
         self.parent = parent
         self.name = name
         self.terminationDeferred = td
         self.jobid = jobid
+        self.usePTY = usePTY
+        self.stopSchedule = stopSchedule or DEFAULT_STOP_SCHEDULE
         self.pid = None
+        self.rusage = None
         self.hooksByRemoteId = {}
+        # the last event delivered per hook with several remote hooks, and
+        # the remote hooks that reported its line
+        self.lastMatches = {}
+        self.producer = None
+        self.unackedChunks = 0
 
     def addEnvVar(self, name, value):
         self.parent.addProcessEnv(self.jobid, name, value)
 
-    def start(self, use_pty=False):
+    def start(self, use_pty=None):
+        if use_pty is None:
+            use_pty = self.usePTY
         self.parent.startProcess(self.jobid, use_pty)
 
-    def stop(self):
+    def stop(self, sig=None):
+        """ Stops the process by signalling its process group according to
+            the stop schedule, which the remote helper escalates on its
+            own. Returns the termination deferred.
+        """
         if self.terminationDeferred.called:
             raise Exception("process already terminated")
 
-        self.parent.stopProcess(self.jobid)
+        schedule = stopScheduleFrom(self.stopSchedule, sig)
+        self.parent.stopProcess(self.jobid, formatStopSchedule(schedule))
         return self.terminationDeferred
 
     def write(self, data):
-        self.parent.writeProcess(self.jobid, data)
+        if self.producer is not None:
+            self.unackedChunks += 1
+            self.parent.feedProcess(self.jobid, data)
+        else:
+            self.parent.writeProcess(self.jobid, data)
 
     def closeStdin(self):
         self.parent.closeProcessStdin(self.jobid)
 
+    def getStdinConsumer(self):
+        return self
+
+    def registerProducer(self, producer, streaming):
+        """ Registers a pull producer for the process' input. Its chunks
+            are acknowledged by the remote helper, keeping at most
+            FEED_WINDOW of them in flight.
+        """
+        assert not streaming, "only pull producers are supported"
+        assert self.producer is None, "producer already registered"
+        self.producer = producer
+        self.produceInput()
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def produceInput(self):
+        while self.producer is not None and \
+                self.unackedChunks < self.FEED_WINDOW:
+            unacked = self.unackedChunks
+            self.producer.resumeProducing()
+            if self.unackedChunks == unacked:
+                # the producer didn't write anything
+                break
+
+    def inputAcknowledged(self):
+        self.unackedChunks -= 1
+        self.produceInput()
+
+    def terminated(self):
+        if self.producer is not None:
+            producer, self.producer = self.producer, None
+            producer.stopProducing()
+
     def gotPid(self, pid):
         self.pid = pid
 
-    def addHook(self, matcher, callback):
-        hook = EventSource.addHook(self, matcher, callback)
+    def gotResourceUsage(self, rusage):
+        self.rusage = rusage
+
+    def addHook(self, matcher, callback, *args, **kwargs):
+        hook = EventSource.addHook(self, matcher, callback, *args, **kwargs)
+
+        # Composite matchers install a single hook per source, which
+        # dispatches to several matchers. Each of these needs its own
+        # hook on the remote side, though.
+        if isinstance(matcher, SourceDispatchMatcher):
+            matchers = matcher.getMatchers()
+        else:
+            matchers = [matcher]
 
         # Install the hook on the remote node, so it pings us back for
         # every match.
-        if matcher.eventClass == ProcessOutStreamEvent:
-            stream = "out"
-        elif matcher.eventClass == ProcessErrStreamEvent:
-            stream = "err"
-        else:
-            raise Exception("unknown event type")
-        pattern = matcher.kwargs['pattern']
+        hook.remote_hook_ids = []
+        for m in matchers:
+            if m.eventClass == ProcessOutStreamEvent:
+                stream = "out"
+            elif m.eventClass == ProcessErrStreamEvent:
+                stream = "err"
+            else:
+                raise Exception("unknown event type")
+            pattern = m.kwargs['pattern']
 
-        hook_id = self.parent.addProcessHook(self.jobid, stream, pattern)
-        hook.remote_hook_id = hook_id
-        self.hooksByRemoteId[hook_id] = hook
+            hook_id = self.parent.addProcessHook(self.jobid, stream, pattern)
+            hook.remote_hook_ids.append(hook_id)
+            self.hooksByRemoteId[hook_id] = (hook, m.eventClass)
         return hook
 
     def removeHook(self, hook):
-        hook_id = hook.remote_hook_id
-        self.parent.dropProcessHook(self.jobid, hook_id)
         EventSource.removeHook(self, hook)
-        assert hook.remote_hook_id in self.hooksByRemoteId
-        del self.hooksByRemoteId[hook.remote_hook_id]
+        self.lastMatches.pop(hook, None)
+        for hook_id in hook.remote_hook_ids:
+            self.parent.dropProcessHook(self.jobid, hook_id)
+            assert hook_id in self.hooksByRemoteId
+            del self.hooksByRemoteId[hook_id]
 
     def triggerHookCallback(self, hook_id, ev_data):
         """ Called from the TestSSHSuite, not public API! Also note that
@@ -722,11 +986,127 @@ class RemoteProcess(EventSource):
             ignored.
         """
         if hook_id in self.hooksByRemoteId:
-            hook = self.hooksByRemoteId[hook_id]
-            event = hook.matcher.eventClass(self, ev_data)
+            hook, eventClass = self.hooksByRemoteId[hook_id]
+
+            # A line matching several terms of a composite matcher is
+            # reported by each of their remote hooks, one after another.
+            # It must still be delivered as a single event, which the
+            # composite matcher tests against all of its terms.
+            if len(hook.remote_hook_ids) > 1:
+                last = self.lastMatches.get(hook)
+                if last is not None and hook_id not in last[1] and \
+                        last[0].__class__ is eventClass and \
+                        last[0].data == ev_data:
+                    last[1].add(hook_id)
+                    return
+
+            event = eventClass(self, ev_data)
+            if len(hook.remote_hook_ids) > 1:
+                self.lastMatches[hook] = (event, set([hook_id]))
             hook.fireCallback(event)
 
-class TestSSHSuite(TestSuite):
+class CommandPipeline:
+    """ Dispatches a sequence of commands to the remote helper, keeping up
+        to window of them in flight, rather than waiting for each reply
+        before sending the next command. Results are delivered to one
+        deferred per command, in the order given.
+    """
+    def __init__(self, suite, cmds, window):
+        assert window > 0
+        self.suite = suite
+        self.queue = collections.deque()
+        self.results = []
+        for cmd in cmds:
+            d = defer.Deferred()
+            self.queue.append((cmd, d))
+            self.results.append(d)
+        self.window = window
+        self.inFlight = 0
+
+    def start(self):
+        self.sendMore()
+        return self.results
+
+    def sendMore(self):
+        # All of the commands that fit the window go out in a single write.
+        self.suite.remote_helper.beginBatch()
+        try:
+            while self.inFlight < self.window and len(self.queue) > 0:
+                cmd, result = self.queue.popleft()
+                self.inFlight += 1
+                d, jobid = self.suite.dispatchCommand(*cmd)
+                d.addBoth(self.jobCompleted, result)
+        finally:
+            self.suite.remote_helper.endBatch()
+
+    def jobCompleted(self, outcome, result):
+        self.inFlight -= 1
+        self.sendMore()
+        if isinstance(outcome, failure.Failure):
+            result.errback(outcome)
+        else:
+            result.callback(outcome)
+
+
+class RemoteTreeSink:
+    """ Receives an archive of a directory tree, which the remote helper
+        unpacks on the fly, see L{TestSSHSuite.receiveTree}.
+    """
+    def __init__(self, suite, path, compress):
+        self.suite = suite
+        self.pendingWrites = collections.deque()
+        self.finished = False
+        self.result = None
+        self.closeDeferred = None
+        d, self.jobid = suite.dispatchCommand("tar_unpack", path,
+                                              int(compress))
+        d.addBoth(self.unpackFinished)
+
+    def write(self, data):
+        """ Sends a chunk of the archive, returns a deferred fired as soon
+            as the remote helper has unpacked it.
+        """
+        if self.finished:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self.pendingWrites.append(d)
+        self.suite.remote_helper.custom_request("tar_feed", self.jobid, data)
+        return d
+
+    def written(self):
+        if len(self.pendingWrites) > 0:
+            self.pendingWrites.popleft().callback(None)
+
+    def close(self):
+        """ Returns a deferred fired when the archive has been unpacked
+            completely.
+        """
+        if self.finished and isinstance(self.result, failure.Failure):
+            return defer.fail(self.result)
+        elif self.finished:
+            return defer.succeed(None)
+        self.closeDeferred = defer.Deferred()
+        self.suite.remote_helper.custom_request("tar_end", self.jobid)
+        return self.closeDeferred
+
+    def unpackFinished(self, result):
+        # Failures are reported when closing, while further writes get
+        # dropped.
+        self.finished = True
+        self.result = result
+        self.suite.treeSinks.pop(self.jobid, None)
+        writes, self.pendingWrites = self.pendingWrites, collections.deque()
+        for d in writes:
+            d.callback(None)
+        if self.closeDeferred is not None:
+            d, self.closeDeferred = self.closeDeferred, None
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(None)
+
+
+class TestSSHSuite(TestSuite, ProcessGroupMixin):
 
     implements(IControlledHost)
 
@@ -735,6 +1115,24 @@ class TestSSHSuite(TestSuite):
     args = (('user', str),
             ('workdir', str) )
 
+    # Whether the remote helper should stream its event log records back
+    # during the run, rather than having the event log downloaded after
+    # tearing down, and the maximum bandwidth to use for that, in bytes
+    # per second. Zero means unlimited.
+    streamEventLog = False
+    streamEventLogRate = 0
+
+    # Whether to use the binary protocol with the remote helper, if it
+    # supports that, rather than the text protocol.
+    binaryProtocol = True
+
+    # Maximum number of commands in flight for L{dispatchCommands}.
+    commandWindow = 64
+
+    # Directory for data kept across runs, relative to the home directory
+    # unless absolute.
+    cacheDir = ".dtester_cache"
+
     def setUpDescription(self):
         return "connecting to %s:%d" % (
             self.host.getHost(), self.host.getPort())
@@ -754,11 +1152,17 @@ class TestSSHSuite(TestSuite):
         self.pendingLists = {}
         self.completedProcs = {} # only holds a jobid -> name map
 
+        # archives sent, as [sink, failure] lists, and received by job id
+        self.treeSources = {}
+        self.treeSinks = {}
+
         # assign temporary ports starting from 32768
         # FIXME: should be configurable!
         self.temp_port = 32768
 
         self.absWorkdir = None
+        self.absCacheDir = None
+        self.streamedLog = None
 
         self.tearingDown = False
         self.tearDownDeferred = None
@@ -798,6 +1202,11 @@ class TestSSHSuite(TestSuite):
         else:
             self.absWorkdir = joinPath(result, self.workdir)
 
+        if self.cacheDir[0] == '/':
+            self.absCacheDir = self.cacheDir
+        else:
+            self.absCacheDir = joinPath(result, self.cacheDir)
+
         self.helperTargetPath = joinPath(self.homeDirectory,
                                          ".dtester_helper.py")
 
@@ -863,12 +1272,27 @@ class TestSSHSuite(TestSuite):
         d.addCallback(self.helperTornDown)
         return d
 
+    def getEventLogPath(self):
+        return os.path.join(self.runner.getTmpDir(),
+                            self.test_name + "-event.log")
+
     def helperTornDown(self, result):
-        tmpDir = self.runner.getTmpDir()
-        tmpPath = os.path.join(tmpDir, self.test_name + "-event.log")
+        tmpPath = self.getEventLogPath()
+
+        if self.streamedLog is not None:
+            # All of the event log has been streamed already.
+            self.streamedLog.close()
+            self.streamedLog = None
+            self.runner.registerHostEventLog(self.test_name, tmpPath,
+                                             demultiplexed=True)
+            d = self.removeRemoteWorkDir(None)
+            d.addCallback(self.tearDownConnection)
+            return d
 
-        d = self.transport.downloadFile(self.joinPath(self.absWorkdir, "event.log"),
-                                        tmpPath + ".raw")
+        # The event log is compressed by the helper and gets downloaded
+        # as such.
+        d = self.transport.downloadFile(
+            self.joinPath(self.absWorkdir, "event.log.z"), tmpPath + ".raw.z")
         d.addCallback(self.gotEventLog, tmpPath)
         d.addCallback(self.removeRemoteWorkDir)
         d.addCallback(self.tearDownConnection)
@@ -877,26 +1301,25 @@ class TestSSHSuite(TestSuite):
     def gotEventLog(self, result, tmpPath):
         # Decode event log... a bit... dirty stuff!
         outfd = open(tmpPath, 'w')
-        for line in open(tmpPath + ".raw",'r'):
+        for line in iterDecompressedLines(tmpPath + ".raw.z"):
             t, jobid, channel, data = line.split(':', 3)
-            jobid = int(jobid)
-            if jobid == 0:
-                jobName = self.test_name
-            elif jobid in self.completedProcs:
-                jobName = self.completedProcs[jobid]
-            elif jobid in self.pendingProcs:
-                jobName = self.pendingProcs[jobid].name
-                #self.runner.log("Warning: proc still pending: %s" % jobName)
-            else:
-                #self.runner.log("No proc name for %d" % jobid)
-                jobName = "(unknown)"
             outfd.write("%s:%s:%s:%s" % (
-                t, jobName, channel, data))
+                t, self.getJobName(int(jobid)), channel, data))
         outfd.close()
-        os.unlink(tmpPath + ".raw")
+        os.unlink(tmpPath + ".raw.z")
 
         self.runner.registerHostEventLog(self.test_name, tmpPath)
 
+    def getJobName(self, jobid):
+        if jobid == 0:
+            return self.test_name
+        elif jobid in self.completedProcs:
+            return self.completedProcs[jobid]
+        elif jobid in self.pendingProcs:
+            return self.pendingProcs[jobid].name
+        else:
+            return "(unknown)"
+
     def removeRemoteWorkDir(self, result):
         # If we are still connected, command the helper to remove its
         # working directory. If the connection closes already when failing
@@ -920,18 +1343,30 @@ class TestSSHSuite(TestSuite):
             self.processHello(*args)
         elif cmd == "done":
             self.processRemoteJobDone(*args)
+        elif cmd == "done_jobs":
+            self.processRemoteJobsDone(*args)
         elif cmd == "failed":
             self.processRemoteJobFailed(*args)
         elif cmd == "cmd_error":
             self.processCmdError(*args)
         elif cmd == "proc_pid":
             self.processProcPid(*args)
+        elif cmd == "proc_rusage":
+            self.processProcRusage(*args)
+        elif cmd == "proc_fed":
+            self.processProcFed(*args)
         elif cmd == "hook_added":
             self.processHookAdded(*args)
         elif cmd == "hook_dropped":
             self.processHookDropped(*args)
         elif cmd == "hook_matched":
             self.processHookMatched(*args)
+        elif cmd == "evlog_records":
+            self.processEvlogRecords(*args)
+        elif cmd == "tar_data":
+            self.processTarData(*args)
+        elif cmd == "tar_fed":
+            self.processTarFed(*args)
         elif cmd == "list_file":
             self.processListEntry('file', *args)
         elif cmd == "list_dir":
@@ -940,7 +1375,7 @@ class TestSSHSuite(TestSuite):
             self.processUnknownCommand(cmd, *args)
 
     def processHello(self, hostname, system, release, version, machine,
-                         separator):
+                         separator, *protocols):
         self.remoteInfo = {
             'hostname': hostname,
             'system': system,
@@ -950,10 +1385,22 @@ class TestSSHSuite(TestSuite):
             'separator': separator
         }
 
+        if self.binaryProtocol and utils.BINARY_PROTOCOL in protocols:
+            self.remote_helper.useProtocol(utils.BINARY_PROTOCOL)
+
         d, jobid = self.dispatchCommand("set_work_dir", self.absWorkdir)
         d.addCallbacks(self.remoteHelperInitialized, self.remoteHelperFailed)
 
     def remoteHelperInitialized(self, result):
+        if self.streamEventLog:
+            self.streamedLog = open(self.getEventLogPath(), 'w')
+            d, jobid = self.dispatchCommand("evlog_stream",
+                                            self.streamEventLogRate)
+            d.addCallbacks(self.remoteHelperReady, self.remoteHelperFailed)
+        else:
+            self.remoteHelperReady(None)
+
+    def remoteHelperReady(self, result):
         d, self.setupDeferred = self.setupDeferred, None
         d.callback(True)
 
@@ -973,6 +1420,10 @@ class TestSSHSuite(TestSuite):
             proc = self.pendingProcs[jobid]
             self.completedProcs[jobid] = proc.name
             del self.pendingProcs[jobid]
+            proc.terminated()
+            proc.throwEvent(ProcessEndedEvent, retcode, proc.rusage)
+            if proc.rusage is not None:
+                self.runner.recordResourceUsage(proc.name, proc.rusage)
             d.callback(retcode)
         elif jobid in self.pendingLists:
             result = self.pendingLists[jobid]
@@ -982,6 +1433,15 @@ class TestSSHSuite(TestSuite):
             #self.runner.log("remote job terminated (success)")
             d.callback(None)
 
+    def processRemoteJobsDone(self, *jobids):
+        # Commands dispatched from the callbacks are sent together.
+        self.remote_helper.beginBatch()
+        try:
+            for jobid in jobids:
+                self.processRemoteJobDone(jobid)
+        finally:
+            self.remote_helper.endBatch()
+
     def processRemoteJobFailed(self, jobid, *args):
         if jobid not in self.pendingJobs:
             raise Exception("remote helper sent 'failed' for unknown job %d" % jobid)
@@ -1008,11 +1468,38 @@ class TestSSHSuite(TestSuite):
             if jobid in self.pendingLists:
                 del self.pendingLists[jobid]
 
-    def processListEntry(self, etype, jobid, path, atime, mtime, ctime):
+    def processTarData(self, jobid, data):
+        if jobid not in self.treeSources:
+            self.runner.log("remote helper sent 'tar_data' for unknown job %d" % jobid)
+            return
+
+        state = self.treeSources[jobid]
+        if state[1] is None:
+            d = defer.maybeDeferred(state[0].write, data)
+            d.addErrback(self.treeSinkFailed, state)
+        else:
+            d = defer.succeed(None)
+        # acknowledged even if the sink failed, to let the helper finish
+        d.addCallback(self.ackTreeData, jobid)
+
+    def treeSinkFailed(self, failure, state):
+        if state[1] is None:
+            state[1] = failure
+
+    def ackTreeData(self, result, jobid):
+        self.remote_helper.custom_request("tar_ack", jobid)
+
+    def processTarFed(self, jobid):
+        if jobid in self.treeSinks:
+            self.treeSinks[jobid].written()
+
+    def processListEntry(self, etype, jobid, path, atime, mtime, ctime,
+                         size):
         if jobid not in self.pendingJobs:
             raise Exception("remote helper sent 'list_file' for unknown job id %d" % jobid)
 
-        self.pendingLists[jobid].append((etype, path, atime, mtime, ctime))
+        self.pendingLists[jobid].append((etype, path, atime, mtime, ctime,
+                                         size))
 
     def processUnknownCommand(self, cmd, *args):
         raise Exception("remote helper sent unknown command %s" % repr(cmd))
@@ -1029,6 +1516,21 @@ class TestSSHSuite(TestSuite):
         proc = self.pendingProcs[jobid]
         proc.gotPid(pid)
 
+    def processProcRusage(self, jobid, *values):
+        if jobid not in self.pendingProcs:
+            self.runner.log("remote helper sent 'proc_rusage' for unknown process %d" % jobid)
+            return
+
+        proc = self.pendingProcs[jobid]
+        proc.gotResourceUsage(ResourceUsage(*values))
+
+    def processProcFed(self, jobid):
+        if jobid not in self.pendingProcs:
+            # the process may well have terminated in the meantime
+            return
+
+        self.pendingProcs[jobid].inputAcknowledged()
+
     def processHookAdded(self, jobid, hookid):
         if jobid not in self.pendingProcs:
             self.runner.log("remote helper sent 'hook_added' confirmation for unknown process %d" % jobid)
@@ -1053,6 +1555,18 @@ class TestSSHSuite(TestSuite):
         proc = self.pendingProcs[jobid]
         proc.triggerHookCallback(hookid, line)
 
+    def processEvlogRecords(self, records):
+        if self.streamedLog is None:
+            self.runner.log("remote helper sent unrequested event log records")
+            return
+
+        for line in records.splitlines(True):
+            t, jobid, channel, data = line.split(':', 3)
+            jobName = self.getJobName(int(jobid))
+            self.streamedLog.write("%s:%s:%s:%s" % (t, jobName, channel, data))
+            self.runner.remoteEvlogAppend(self.test_name, float(t), jobName,
+                                          channel, data)
+
 
 
 
@@ -1074,6 +1588,16 @@ class TestSSHSuite(TestSuite):
         self.pendingJobs[jobid] = (d, cmd, args)
         return d, jobid
 
+    def dispatchCommands(self, cmds, window=None):
+        """ Dispatches a sequence of commands, each given as a tuple of the
+            command and its arguments, pipelining up to window of them
+            (commandWindow by default). Returns a list of deferreds, one
+            per command.
+        """
+        if window is None:
+            window = self.commandWindow
+        return CommandPipeline(self, cmds, window).start()
+
     def recursiveList(self, path):
         d, jobid = self.dispatchCommand("list", path)
         self.pendingLists[jobid] = []
@@ -1099,13 +1623,60 @@ class TestSSHSuite(TestSuite):
         d, jobid = self.dispatchCommand("utime", path, atime, mtime)
         return d
 
+    def makeDirectories(self, paths):
+        ds = self.dispatchCommands([("makedirs", path) for path in paths])
+        return defer.gatherResults(ds, consumeErrors=True)
+
+    def utimes(self, entries):
+        ds = self.dispatchCommands([("utime", path, atime, mtime)
+                                    for path, atime, mtime in entries])
+        return defer.gatherResults(ds, consumeErrors=True)
+
+    def getCacheDir(self):
+        return self.absCacheDir
+
+    def linkTree(self, srcPath, destPath):
+        d, jobid = self.dispatchCommand("link_tree", srcPath, destPath)
+        return d
+
+    def lockDirectory(self, path):
+        d, jobid = self.dispatchCommand("lock_dir", path)
+        return d
+
+    def unlockDirectory(self, path):
+        d, jobid = self.dispatchCommand("unlock_dir", path)
+        return d
+
+    def sendTree(self, path, sink, ignore=None, compress=False):
+        d, jobid = self.dispatchCommand("tar_pack", path, int(compress),
+                                        ignore)
+        self.treeSources[jobid] = [sink, None]
+        d.addBoth(self.treeSent, jobid)
+        return d
+
+    def treeSent(self, result, jobid):
+        sink, sinkFailure = self.treeSources.pop(jobid)
+        if sinkFailure is not None and \
+                not isinstance(result, failure.Failure):
+            return sinkFailure
+        return result
+
+    def receiveTree(self, path, compress=False):
+        sink = RemoteTreeSink(self, path, compress)
+        self.treeSinks[sink.jobid] = sink
+        return sink
+
     def prepareProcess(self, name, cmdline, cwd=None,
-                       lineBasedOutput=True, ignoreOutput=False):
+                       lineBasedOutput=True, ignoreOutput=False,
+                       usePTY=False, outputMode=None, stopSchedule=None):
         if isinstance(cmdline, str):
             cmdline = shlex.split(cmdline)
 
+        assert outputMode in (None, 'events', 'discard'), \
+            "output mode %s not supported for remote processes" % outputMode
+
         output_type = 'binary'
-        if ignoreOutput:
+        if ignoreOutput or outputMode == 'discard':
             output_type = 'ignore'
         elif lineBasedOutput:
             output_type = 'lines'
@@ -1117,10 +1688,31 @@ class TestSSHSuite(TestSuite):
         if cwd:
             self.remote_helper.custom_request("proc_cwd", jobid, cwd)
 
-        proc = RemoteProcess(self, name, d, jobid)
+        proc = RemoteProcess(self, name, d, jobid, usePTY, stopSchedule)
         self.pendingProcs[jobid] = proc
         return proc, d
 
+    def prepareProcesses(self, specs):
+        """ Prepares a group of processes in a single request to the
+            remote helper, see L{IControlledHost.prepareProcesses}.
+        """
+        self.remote_helper.beginBatch()
+        try:
+            return ProcessGroupMixin.prepareProcesses(self, specs)
+        finally:
+            self.remote_helper.endBatch()
+
+    def startAll(self, procs):
+        """ Starts all of the given processes in a single request to the
+            remote helper.
+        """
+        self.remote_helper.beginBatch()
+        try:
+            for proc in procs:
+                proc.start()
+        finally:
+            self.remote_helper.endBatch()
+
     def getHostName(self):
         return self.remoteInfo['hostname']
 
@@ -1145,8 +1737,8 @@ class TestSSHSuite(TestSuite):
     def startProcess(self, jobid, use_pty=False, use_shell=False):
         self.remote_helper.custom_request("proc_start", jobid, int(use_pty), int(use_shell))
 
-    def stopProcess(self, jobid):
-        self.remote_helper.custom_request("proc_stop", jobid)
+    def stopProcess(self, jobid, schedule=None):
+        self.remote_helper.custom_request("proc_stop", jobid, schedule)
 
     def addProcessEnv(self, jobid, name, value):
         self.remote_helper.custom_request("proc_env", jobid, name, value)
@@ -1164,6 +1756,9 @@ class TestSSHSuite(TestSuite):
     def writeProcess(self, jobid, data):
         self.remote_helper.custom_request("proc_write", jobid, data)
 
+    def feedProcess(self, jobid, data):
+        self.remote_helper.custom_request("proc_feed", jobid, data)
+
     def closeProcessStdin(self, jobid):
         self.remote_helper.custom_request("proc_close_stdin", jobid)
 
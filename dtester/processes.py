@@ -10,10 +10,13 @@ definition of events, their sources and matchers as well as some event
 classes
 """
 
-import os, signal
-from twisted.internet import protocol, reactor, defer
-from dtester.events import EventSource, ProcessEndedEvent, \
-                           ProcessOutStreamEvent, ProcessErrStreamEvent
+import os, re, sys, errno, signal
+from twisted.internet import protocol, reactor, defer, task, error
+from twisted.internet import process as twisted_process
+from twisted.python import log, failure
+from dtester.events import EventSource, ProcessEndedEvent, ResourceUsage, \
+                           ProcessOutStreamEvent, ProcessErrStreamEvent, \
+                           ProcessOutputFileEvent
 
 class ProcessEndedProtocol(protocol.ProcessProtocol):
     """ A simple protocol helper for L{SimpleProcess}, generating only a
@@ -22,12 +25,18 @@ class ProcessEndedProtocol(protocol.ProcessProtocol):
     def __init__(self, evSource):
         self.eventSource = evSource
 
-    def connectionMade(self):
-        self.transport.closeStdin()
-
     def processEnded(self, status):
         self.eventSource.processEnded(status.value.exitCode)
 
+class SwallowProcessProtocol(ProcessEndedProtocol):
+    """ A protocol helper for L{SimpleProcess}, discarding any output.
+    """
+    def outReceived(self, data):
+        pass
+
+    def errReceived(self, data):
+        pass
+
 class SimpleProcessProtocol(ProcessEndedProtocol):
     """ A simple protocol helper for L{SimpleProcess}, generating events
         for every single piece of data received.
@@ -38,39 +47,557 @@ class SimpleProcessProtocol(ProcessEndedProtocol):
     def errReceived(self, data):
         self.eventSource.throwEvent(ProcessErrStreamEvent, data)
 
+class LineSplitter:
+    """ Incrementally splits a stream of data into lines, calling emit for
+        every complete line (including its newline character). Only newly
+        received data is scanned, a partial line is kept as a list of
+        chunks until its end arrives. If maxLineLength is given, a partial
+        line exceeding that length is flushed without a newline.
+    """
+    def __init__(self, emit, maxLineLength=None):
+        self.emit = emit
+        self.maxLineLength = maxLineLength
+        self.chunks = []
+        self.pendingLength = 0
+
+    def feed(self, data):
+        end = data.rfind("\n") + 1
+        if end == 0:
+            # fast path: no newline in this chunk at all
+            if len(data) > 0:
+                self.chunks.append(data)
+                self.pendingLength += len(data)
+                if self.maxLineLength is not None and \
+                        self.pendingLength >= self.maxLineLength:
+                    self.flush()
+            return
+
+        start = 0
+        if len(self.chunks) > 0:
+            # complete the pending line
+            start = data.find("\n") + 1
+            self.chunks.append(data[:start])
+            line = "".join(self.chunks)
+            self.chunks = []
+            self.pendingLength = 0
+            self.emit(line)
+
+        if start < end:
+            lines = data[start:end].split("\n")
+            # the last element is the empty string after the last newline
+            for line in lines[:-1]:
+                self.emit(line + "\n")
+
+        if end < len(data):
+            self.chunks.append(data[end:])
+            self.pendingLength = len(data) - end
+            if self.maxLineLength is not None and \
+                    self.pendingLength >= self.maxLineLength:
+                self.flush()
+
+    def flush(self):
+        """ Emits the pending partial line, if any.
+        """
+        if len(self.chunks) > 0:
+            line = "".join(self.chunks)
+            self.chunks = []
+            self.pendingLength = 0
+            self.emit(line)
+
 class SimpleProcessLineBasedProtocol(ProcessEndedProtocol):
     """ A line based protocol helper for L{SimpleProcess}, generating events
         only for complete lines of data. Useful for processes with line based
         console UIs.
     """
-    def __init__(self, evSource):
+
+    # partial lines longer than this get emitted anyways
+    MAX_LINE_LENGTH = 1024 * 1024
+
+    def __init__(self, evSource, maxLineLength=MAX_LINE_LENGTH):
         ProcessEndedProtocol.__init__(self, evSource)
-        self.outBuffer = ""
-        self.errBuffer = ""
+        self.outSplitter = LineSplitter(self.outLineReceived, maxLineLength)
+        self.errSplitter = LineSplitter(self.errLineReceived, maxLineLength)
 
     def outReceived(self, data):
-        self.outBuffer += data
-        lines = self.outBuffer.split("\n")
-        for line in lines[:-1]:
-            self.eventSource.throwEvent(ProcessOutStreamEvent, line + "\n")
-        self.outBuffer = lines[-1]
+        self.outSplitter.feed(data)
 
     def errReceived(self, data):
-        self.errBuffer += data
-        lines = self.errBuffer.split("\n")
-        for line in lines[:-1]:
-            self.eventSource.throwEvent(ProcessErrStreamEvent, line + "\n")
-        self.errBuffer = lines[-1]
+        self.errSplitter.feed(data)
+
+    def outLineReceived(self, line):
+        self.eventSource.throwEvent(ProcessOutStreamEvent, line)
+
+    def errLineReceived(self, line):
+        self.eventSource.throwEvent(ProcessErrStreamEvent, line)
+
+    def processEnded(self, status):
+        # emit trailing output not terminated by a newline
+        self.outSplitter.flush()
+        self.errSplitter.flush()
+        ProcessEndedProtocol.processEnded(self, status)
+
+class OutputTailer:
+    """ Follows the output file of a L{SimpleProcess} running with output
+        mode 'file', polling for newly appended data and emitting it as
+        L{ProcessOutputFileEvent}s per line. Data is only read while the
+        process has hooks interested in such events, everything else is
+        skipped.
+    """
+    def __init__(self, eventSource, path, interval=0.1,
+                 maxLineLength=SimpleProcessLineBasedProtocol.MAX_LINE_LENGTH):
+        self.eventSource = eventSource
+        self.path = path
+        self.interval = interval
+        self.splitter = LineSplitter(self.lineReceived, maxLineLength)
+        self.fd = None
+        self.call = task.LoopingCall(self.poll)
+
+    def start(self):
+        self.call.start(self.interval, now=False)
+
+    def stop(self):
+        """ Stops polling, after emitting any remaining output.
+        """
+        if self.call.running:
+            self.call.stop()
+        self.poll()
+        self.splitter.flush()
+        if self.fd is not None:
+            self.fd.close()
+            self.fd = None
+
+    def poll(self):
+        if self.fd is None:
+            try:
+                self.fd = open(self.path, 'rb')
+            except IOError, e:
+                # the process may not have created it, yet
+                return
+
+        if self.eventSource.hasHooksFor(ProcessOutputFileEvent):
+            while True:
+                data = self.fd.read(65536)
+                if len(data) == 0:
+                    break
+                self.splitter.feed(data)
+        else:
+            self.splitter.flush()
+            self.fd.seek(0, os.SEEK_END)
+
+    def lineReceived(self, line):
+        self.eventSource.throwEvent(ProcessOutputFileEvent, line)
+
+class StdinFeeder:
+    """ A pull producer writing the chunks provided by an iterator to the
+        standard input of a process. The consumer requests another chunk
+        only after having written the previous one, so neither side needs
+        to hold more than a chunk in memory. Optionally closes stdin as
+        soon as the iterator is exhausted.
+    """
+    def __init__(self, consumer, iterator, closeStdin=True):
+        self.consumer = consumer
+        self.iterator = iterator
+        self.closeStdin = closeStdin
+        self.deferred = defer.Deferred()
+        self.finished = False
+
+    def start(self):
+        """ Registers with the consumer, returns a deferred fired when all
+            data has been written.
+        """
+        self.consumer.registerProducer(self, False)
+        return self.deferred
+
+    def resumeProducing(self):
+        if self.finished:
+            return
+        try:
+            chunk = self.iterator.next()
+        except StopIteration:
+            self.finish()
+            return
+        except Exception, e:
+            self.finish(failure.Failure())
+            return
+        self.consumer.write(chunk)
+
+    def stopProducing(self):
+        # The consumer went away, i.e. the process terminated or closed
+        # its stdin before consuming all of the input.
+        if not self.finished:
+            self.finished = True
+            self.deferred.errback(IOError(
+                "process stopped reading its input"))
+
+    def finish(self, result=None):
+        self.finished = True
+        self.consumer.unregisterProducer()
+        if self.closeStdin:
+            self.consumer.closeStdin()
+        self.deferred.callback(result)
+
+class StdinFeedMixin:
+    """ A mixin for processes, providing methods to stream input into
+        their standard input. Requires a getStdinConsumer method.
+    """
+
+    # size of the chunks read from files
+    FEED_CHUNK_SIZE = 65536
+
+    def feedFromIterator(self, iterator, closeStdin=True):
+        """ Writes all strings yielded by the given iterator to the
+            process' standard input, with flow control. Returns a deferred
+            fired when done.
+        """
+        feeder = StdinFeeder(self.getStdinConsumer(), iter(iterator),
+                             closeStdin)
+        return feeder.start()
+
+    def feedFromFile(self, path, closeStdin=True):
+        """ Streams the contents of the given file to the process'
+            standard input. Returns a deferred fired when done.
+        """
+        f = open(path, 'rb')
+        chunks = iter(lambda: f.read(self.FEED_CHUNK_SIZE), "")
+        d = self.feedFromIterator(chunks, closeStdin)
+        def closeFile(result):
+            f.close()
+            return result
+        d.addBoth(closeFile)
+        return d
+
+class RusageReaper:
+    """ A mixin for twisted's process transports, reaping the process via
+        wait4, which additionally provides its resource usage. It's stored
+        as the rusage attribute.
+
+        Twisted itself tries to reap a process via waitpid right after
+        spawning it, losing the resource usage of a process that exited
+        already. Therefore, the child waits for the parent to close the
+        given gate pipe before it exec's, which happens only after the
+        process has been registered for reaping, see L{spawnProcessGroup}.
+    """
+    rusage = None
+
+    def __init__(self, gate):
+        self.gate = gate
+
+    def waitForGate(self):
+        """ Called in the child process, blocks until the parent closed its
+            end of the gate pipe.
+        """
+        gate_r, gate_w = self.gate
+        os.close(gate_w)
+        while True:
+            try:
+                os.read(gate_r, 1)
+                break
+            except OSError, e:
+                if e.errno != errno.EINTR:
+                    raise
+        os.close(gate_r)
+
+    def reapProcess(self):
+        try:
+            try:
+                pid, status, ru = os.wait4(self.pid, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.ECHILD:
+                    # no child process
+                    pid = None
+                else:
+                    raise
+        except:
+            log.msg('Failed to reap %d:' % self.pid)
+            log.err()
+            pid = None
+        if pid:
+            self.rusage = ResourceUsage.fromRusage(ru)
+            self.processEnded(status)
+            twisted_process.unregisterReapProcessHandler(pid, self)
+
+class ProcessGroupProcess(RusageReaper, twisted_process.Process):
+    """ A twisted process placed in a process group of its own, so that it
+        can be signalled together with all of its children.
+    """
+    def __init__(self, gate, *args, **kwargs):
+        RusageReaper.__init__(self, gate)
+        twisted_process.Process.__init__(self, *args, **kwargs)
+
+    def _setupChild(self, *args, **kwargs):
+        os.setpgid(0, 0)
+        self.waitForGate()
+        return twisted_process.Process._setupChild(self, *args, **kwargs)
+
+class RusagePTYProcess(RusageReaper, twisted_process.PTYProcess):
+    """ A twisted process in a pty, which already gets a session and
+        process group of its own.
+    """
+    def __init__(self, gate, *args, **kwargs):
+        RusageReaper.__init__(self, gate)
+        twisted_process.PTYProcess.__init__(self, *args, **kwargs)
+
+    def _setupChild(self, *args, **kwargs):
+        self.waitForGate()
+        return twisted_process.PTYProcess._setupChild(self, *args, **kwargs)
+
+def checkProcessArg(value, errmsg):
+    """ Returns the given argument or environment entry as a string,
+        encoding unicode with the file system encoding, just like
+        reactor.spawnProcess does. Raises a TypeError with the given
+        message otherwise.
+    """
+    if isinstance(value, unicode):
+        try:
+            value = value.encode(sys.getfilesystemencoding())
+        except UnicodeEncodeError:
+            value = None
+    if not isinstance(value, str) or "\0" in value:
+        raise TypeError(errmsg)
+    return value
+
+def checkProcessArgs(args, env):
+    """ Validates the arguments and environment of a process to spawn,
+        returning them as a list and a dict of strings.
+    """
+    if not isinstance(args, (tuple, list)):
+        raise TypeError("Arguments must be a tuple or list")
+    errmsg = "Arguments contain a non-string value"
+    args = [checkProcessArg(arg, errmsg) for arg in args]
+    if env is not None:
+        errmsg = "Environment contains a non-string value"
+        env = dict((checkProcessArg(key, errmsg),
+                    checkProcessArg(value, errmsg))
+                   for key, value in env.iteritems())
+    return args, env
+
+def spawnProcessGroup(processProtocol, executable, args=(), env={},
+                      path=None, usePTY=False, childFDs=None):
+    """ Equivalent to reactor.spawnProcess, but starts the process in a
+        new process group and records its resource usage, see
+        L{RusageReaper}.
+    """
+    args, env = checkProcessArgs(args, env)
+    gate = os.pipe()
+    try:
+        if usePTY:
+            return RusagePTYProcess(gate, reactor, executable, args, env,
+                                    path, processProtocol, usePTY=True)
+        return ProcessGroupProcess(gate, reactor, executable, args, env,
+                                   path, processProtocol, None, None,
+                                   childFDs)
+    finally:
+        # registered for reaping by now, let the child exec
+        os.close(gate[0])
+        os.close(gate[1])
+
+def formatStopSchedule(schedule):
+    """ Formats a stop schedule as a string for the remote helper, i.e.
+        '2:10.0,15:10.0,9'.
+    """
+    steps = []
+    for sig, timeout in schedule:
+        if timeout is None:
+            steps.append("%d" % sig)
+        else:
+            steps.append("%d:%0.3f" % (sig, timeout))
+    return ",".join(steps)
+
+ENV_VAR_RE = re.compile(
+    r"\$\{([A-Za-z_][A-Za-z0-9_]*)\}|\$([A-Za-z_][A-Za-z0-9_]*)")
+
+def substituteEnvVars(value, env):
+    """ Expands $VAR and ${VAR} references in value from env in a single
+        pass. References to undefined variables are left untouched.
+    """
+    if not "$" in value:
+        return value
+
+    def replace(match):
+        name = match.group(1) or match.group(2)
+        if name in env:
+            return env[name]
+        else:
+            return match.group(0)
+
+    return ENV_VAR_RE.sub(replace, value)
+
+class EnvironmentLayer(object):
+    """ A copy-on-write layer of environment variables. Lookups fall
+        through to the parent, which is either another layer or a plain
+        dict that's assumed not to change anymore. Modifications only ever
+        affect the layer itself, so a base environment can be shared by
+        many processes.
+    """
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.local = {}
+        self.version = 0
+        self.flattened = None
+        self.flattenedVersion = None
+
+    def derive(self):
+        """ Returns a new, empty layer on top of this one.
+        """
+        return EnvironmentLayer(self)
+
+    def getVersion(self):
+        if isinstance(self.parent, EnvironmentLayer):
+            return self.version + self.parent.getVersion()
+        else:
+            return self.version
+
+    def __getitem__(self, key):
+        if key in self.local:
+            return self.local[key]
+        elif self.parent is None:
+            raise KeyError(key)
+        else:
+            return self.parent[key]
+
+    def __contains__(self, key):
+        return key in self.local or \
+            (self.parent is not None and key in self.parent)
 
-class SimpleProcess(EventSource):
+    def __setitem__(self, key, value):
+        self.local[key] = value
+        self.version += 1
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        else:
+            return default
+
+    def iteritems(self):
+        return self.flatten().iteritems()
+
+    def flatten(self):
+        """ Returns a plain dict of all variables, as required for spawning
+            a process. Cached until this or any parent layer changes, so
+            the caller must not modify it.
+        """
+        version = self.getVersion()
+        if self.flattened is None or self.flattenedVersion != version:
+            if self.parent is None:
+                env = {}
+            elif isinstance(self.parent, EnvironmentLayer):
+                env = dict(self.parent.flatten())
+            else:
+                env = dict(self.parent)
+            env.update(self.local)
+            self.flattened = env
+            self.flattenedVersion = version
+        return self.flattened
+
+class ExecutableCache:
+    """ Caches the resolution of executable names via PATH. Entries are
+        kept per value of PATH, so changing PATH invalidates them. Cached
+        hits are verified with a single stat.
+    """
+    def __init__(self):
+        self.entries = {}
+
+    def lookup(self, exec_name, path):
+        if not path in self.entries:
+            self.entries[path] = {}
+        entries = self.entries[path]
+
+        fn = entries.get(exec_name)
+        if fn is not None and os.path.exists(fn):
+            return fn
+
+        for directory in path.split(':'):
+            fn = os.path.join(directory, exec_name)
+            if os.path.exists(fn):
+                entries[exec_name] = fn
+                return fn
+
+        # intentionally not caching misses, the executable might well get
+        # installed later on.
+        if exec_name in entries:
+            del entries[exec_name]
+        return None
+
+# the default for processes spawned on the local host
+localExecutableCache = ExecutableCache()
+
+# output modes supported by SimpleProcess
+OUTPUT_MODES = ('events', 'discard', 'file')
+
+# The default escalation for stopping processes: signals to send and the
+# time to wait for the process to terminate before escalating.
+DEFAULT_STOP_SCHEDULE = ((signal.SIGINT, 10.0),
+                         (signal.SIGTERM, 10.0),
+                         (signal.SIGKILL, None))
+
+def stopScheduleFrom(schedule, sig):
+    """ Returns the part of the stop schedule starting with the given
+        signal, or the schedule with the signal prepended, if it's not
+        part of the schedule.
+    """
+    if sig is None:
+        return tuple(schedule)
+    for i, (s, timeout) in enumerate(schedule):
+        if s == sig:
+            return tuple(schedule[i:])
+    return ((sig, schedule[0][1]),) + tuple(schedule)
+
+class SimpleProcess(EventSource, StdinFeedMixin):
     """ Sentinel object for external processes. Takes care of starting the
         process, generating events for outputs to standard output and error
         channels as well as process termination.
     """
     def __init__(self, test_name, proc_name, executable, cwd, args=None,
-                 env=None, lineBasedOutput=True, ignoreOutput=False):
+                 env=None, lineBasedOutput=True, ignoreOutput=False,
+                 highWatermark=None, lowWatermark=None,
+                 overflowPolicy='pause', executableCache=None,
+                 launcher=None, usePTY=False, outputMode=None,
+                 outputFile=None, tailOutput=False, stopSchedule=None,
+                 killProcessGroup=True):
+        """ @param usePTY: whether to run the process in a pseudo terminal,
+                           merging its stdout and stderr, rather than
+                           connecting it via plain pipes. Only needed for
+                           interactive programs.
+            @type  usePTY: bool
+            @param outputMode: 'events' to emit events for the output,
+                               'discard' to redirect it to /dev/null or
+                               'file' to redirect it to outputFile. The
+                               latter two don't involve the reactor at
+                               all. Defaults to 'discard' for ignoreOutput,
+                               'events' otherwise.
+            @type  outputMode: str
+            @param tailOutput: whether to follow the output file and emit
+                               L{ProcessOutputFileEvent}s for its lines, as
+                               long as there are hooks interested in them
+            @type  tailOutput: bool
+            @param stopSchedule: signals to send for stopping the process
+                                 and how long to wait for it to terminate
+                                 before escalating to the next one, see
+                                 L{DEFAULT_STOP_SCHEDULE}
+            @type  stopSchedule: sequence of (signal, timeout) tuples
+            @param killProcessGroup: whether to signal the process' entire
+                                     process group, rather than just the
+                                     process itself
+            @type  killProcessGroup: bool
+        """
         EventSource.__init__(self)
 
+        if outputMode is None:
+            if ignoreOutput:
+                outputMode = 'discard'
+            else:
+                outputMode = 'events'
+        assert outputMode in OUTPUT_MODES, \
+            "unknown output mode: %s" % outputMode
+        assert outputMode != 'file' or outputFile, \
+            "output mode 'file' requires an outputFile"
+        assert outputMode != 'file' or not usePTY, \
+            "cannot redirect the output of a process in a pty"
+
+        if highWatermark is not None:
+            self.setFlowControl(highWatermark, lowWatermark, overflowPolicy)
+
         self.test_name = test_name
 
         # FIXME: better argumnt checking required here:
@@ -78,7 +605,7 @@ class SimpleProcess(EventSource):
             if not isinstance(x, str):
                 print "argument for %s is not a string: '%s'\n\n\n\n" % (proc_name, x)
 
-        if ignoreOutput:
+        if outputMode != 'events':
             self.protocol = SwallowProcessProtocol(self)
         elif lineBasedOutput:
             self.protocol = SimpleProcessLineBasedProtocol(self)
@@ -92,12 +619,29 @@ class SimpleProcess(EventSource):
             raise IOError("Work directory %s for process %s does not exist" % (
                 repr(cwd), repr(proc_name)))
 
-        if env:
+        # Never modify the given environment (or even os.environ), but
+        # only a layer on top of it.
+        if env is None:
+            self.env = EnvironmentLayer(dict(os.environ))
+        elif isinstance(env, EnvironmentLayer):
             self.env = env
         else:
-            self.env = os.environ
+            self.env = EnvironmentLayer(env)
+
+        self.executableCache = executableCache or localExecutableCache
+        self.launcher = launcher
+        self.usePTY = usePTY
+        self.outputMode = outputMode
+        self.stopSchedule = stopSchedule or DEFAULT_STOP_SCHEDULE
+        self.killProcessGroup = killProcessGroup
+        self.stopCall = None
+        self.outputFile = outputFile
+        self.tailer = None
+        if outputMode == 'file' and tailOutput:
+            self.tailer = OutputTailer(self, outputFile)
 
         self.running = False
+        self.rusage = None
 
         if args:
             self.args = args
@@ -110,12 +654,7 @@ class SimpleProcess(EventSource):
         return self.tdeferred
 
     def addEnvVar(self, key, value):
-        # perform substitution
-        for k, v in self.env.iteritems():
-            value = value.replace("$" + k, v)
-            value = value.replace("${" + k + "}", v)
-
-        self.env[key] = value
+        self.env[key] = substituteEnvVars(value, self.env)
 
     def start(self):
         exec_name = self.args[0]
@@ -129,59 +668,123 @@ class SimpleProcess(EventSource):
         elif exec_name[0] == '.':
             executable = exec_name
             executable_exists = os.path.exists(os.path.join(self.cwd, exec_name))
-        else:
-            if 'PATH' in self.env:
-                for path in self.env['PATH'].split(':'):
-                    fn = os.path.join(path, exec_name)
-                    if os.path.exists(fn):
-                        executable = fn
-                        executable_exists = True
-                        break
+        elif 'PATH' in self.env:
+            executable = self.executableCache.lookup(exec_name,
+                                                     self.env['PATH'])
+            executable_exists = executable is not None
 
         if not executable_exists:
             raise IOError("No such executable file: %s" % exec_name)
 
-        reactor.spawnProcess(self.protocol, executable,
-                             args=self.args, path=self.cwd, env=self.env,
-                             usePTY=True)
+        # Prefer the pre-forked launcher, if available. It offers the
+        # same interface as the reactor. Both place the process in a
+        # process group of its own.
+        if self.launcher and self.launcher.isRunning():
+            spawner = self.launcher
+            spawnProcess = self.launcher.spawnProcess
+        else:
+            spawner = reactor
+            spawnProcess = spawnProcessGroup
+
+        # Output redirection happens at the file descriptor level, so the
+        # output doesn't ever pass the reactor. With a pty, discarding is
+        # left to the protocol.
+        outputPath = None
+        if self.outputMode == 'file':
+            outputPath = self.outputFile
+        elif self.outputMode == 'discard' and not self.usePTY:
+            outputPath = os.devnull
+
+        kwargs = {}
+        fd = None
+        if outputPath and spawner is reactor:
+            fd = os.open(outputPath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         0644)
+            kwargs['childFDs'] = {0: 'w', 1: fd, 2: fd}
+        elif outputPath:
+            kwargs['outputPath'] = outputPath
+
+        try:
+            transport = spawnProcess(self.protocol, executable,
+                                     args=self.args, path=self.cwd,
+                                     env=self.env.flatten(),
+                                     usePTY=self.usePTY, **kwargs)
+        finally:
+            if fd is not None:
+                os.close(fd)
         self.running = True
 
+        if self.tailer:
+            self.tailer.start()
+
     # called by the protocol
     def processEnded(self, exitCode):
         if not exitCode:
             exitCode = 0
         assert isinstance(exitCode, int)
-        self.throwEvent(ProcessEndedEvent, exitCode)
+        self.rusage = getattr(self.protocol.transport, 'rusage', None)
+        if self.tailer:
+            self.tailer.stop()
+        if self.stopCall is not None:
+            # terminated, no need to escalate
+            self.stopCall.cancel()
+            self.stopCall = None
+        self.throwEvent(ProcessEndedEvent, exitCode, self.rusage)
 
         assert(not self.tdeferred.called)
         reactor.callLater(0.0, self.tdeferred.callback, exitCode)
 
         self.running = False
 
-    def stop(self, sig=signal.SIGINT):
-        self._stop(sig)
+    def stop(self, sig=None):
+        """ Stops the process by sending signals according to the stop
+            schedule, optionally starting with the given signal. Returns
+            the termination deferred, fired as soon as the process exited.
+        """
+        if self.running and self.stopCall is None:
+            self._stop(stopScheduleFrom(self.stopSchedule, sig))
         return self.tdeferred
 
-    def _stop(self, sig=signal.SIGINT):
-        if self.running:
-            try:
-                pid = int(self.protocol.transport.pid)
-                os.kill(pid, sig)
-                if sig == signal.SIGINT:
-                    next_sig = signal.SIGTERM
-                else:
-                    next_sig = signal.SIGKILL
-                reactor.callLater(10, self._stop, next_sig)
-            except TypeError, e:
-                # sometimes, self.protocol.transport.pid is not an
-                # integer. We assume the process has ended in the
-                # mean time, so we simply skip sending a signal
-                pass
-            except OSError, e:
-                if e.errno == 3:  # no such process
-                    pass
-                else:
-                    print "Exception while killing: %s" % e
+    def _stop(self, schedule):
+        self.stopCall = None
+        if not self.running:
+            return
+
+        sig, timeout = schedule[0]
+        try:
+            self.signal(sig)
+        except (error.ProcessExitedAlready, TypeError), e:
+            # The process has ended in the mean time (twisted resets the
+            # pid to None), so we simply skip sending a signal.
+            return
+        except OSError, e:
+            if e.errno != errno.ESRCH:
+                print "Exception while killing: %s" % e
+            return
+
+        if timeout is not None and len(schedule) > 1:
+            self.stopCall = reactor.callLater(timeout, self._stop,
+                                              schedule[1:])
+
+    def signal(self, sig):
+        """ Sends a signal to the process or its entire process group.
+        """
+        transport = self.protocol.transport
+        if not self.killProcessGroup:
+            transport.signalProcess(sig)
+        elif hasattr(transport, 'signalProcessGroup'):
+            transport.signalProcessGroup(sig)
+        else:
+            os.killpg(int(transport.pid), sig)
+
+    # flow control, called from the EventSource
+    def pauseProducing(self):
+        if self.running and self.protocol.transport:
+            self.protocol.transport.pauseProducing()
+
+    def resumeProducing(self):
+        if self.running and self.protocol.transport:
+            self.protocol.transport.resumeProducing()
 
     def write(self, *args, **kwargs):
         self.protocol.transport.write(*args, **kwargs)
@@ -189,6 +792,10 @@ class SimpleProcess(EventSource):
     def closeStdin(self):
         self.protocol.transport.closeStdin()
 
+    def getStdinConsumer(self):
+        assert self.running, "process not running"
+        return self.protocol.transport
+
     def __repr__(self):
         return "%s" % self.proc_name
 
@@ -21,17 +21,25 @@ class Reporter:
     """ An abstract base class for all reporters.
     """
 
+    # prepended to lines not part of the actual result reporting
+    commentPrefix = ""
+
     def __init__(self, outs=sys.stdout, errs=sys.stderr,
-                 showTimingInfo=True, showLineNumbers=True):
+                 showTimingInfo=True, showLineNumbers=True,
+                 showResourceUsage=False):
         """ @param outs: output stream for progress and result information
             @type  outs: file handle
             @param errs: error stream for reporting errors
             @type  errs: file handle
+            @param showResourceUsage: whether or not to print a summary of
+                                      the resources used by processes
+            @type  showResourceUsage: bool
         """
         self.outs = outs
         self.errs = errs
         self.showTimingInfo = showTimingInfo
         self.showLineNumbers = showLineNumbers
+        self.showResourceUsage = showResourceUsage
 
     def getDescription(self, suite, attname=None):
         """ @return: the test's description or that of one of its methods,
@@ -66,6 +74,12 @@ class Reporter:
                 desc = "EXCEPTION in description of %s: %s" % (suite, e)
             return desc
 
+    def updateSetUpSuite(self, tname, suite):
+        """ Called whenever the setUpDescription of a suite changes while
+            setting it up, i.e. to show its progress. Ignored by default.
+        """
+        pass
+
     def getInnerError(self, error):
         tb = None
         tbo = None
@@ -218,6 +232,29 @@ class Reporter:
         self.outs.write(msg)
         self.outs.flush()
 
+    def resourceSummary(self, usage):
+        """ Prints the aggregated resource usage of all processes per test,
+            if enabled.
+
+            @param usage: resource usage by test name
+            @type  usage: dict of L{ResourceUsage}
+        """
+        if not self.showResourceUsage or len(usage) == 0:
+            return
+
+        width = max([len("test")] + [len(tname) for tname in usage])
+        fmt = "%s%-" + str(width) + "s %9s %9s %10s %8s %8s %9s %9s\n"
+        msg = fmt % (self.commentPrefix, "test", "user", "sys", "maxrss",
+                     "vcsw", "ivcsw", "inblock", "oublock")
+        for tname in sorted(usage.keys()):
+            u = usage[tname]
+            msg += fmt % (self.commentPrefix, tname,
+                          "%0.2fs" % u.utime, "%0.2fs" % u.stime,
+                          "%dkB" % u.maxrss, u.nvcsw, u.nivcsw,
+                          u.inblock, u.oublock)
+        self.outs.write(msg)
+        self.outs.flush()
+
 class StreamReporter(Reporter):
     """ A simple, human readable stream reporter without any bells and
         whistles. Can get confusing to read as it dumps a lot of output.
@@ -308,6 +345,8 @@ class TapReporter(Reporter):
         @note: compatibility with other TAP tools is untested.
     """
 
+    commentPrefix = "# "
+
     def begin(self, tdefs):
         # map test names to TAP numbers
         self.numberMapping = {}
@@ -493,6 +532,16 @@ class CursesReporter(Reporter):
         self.outs.write(out)
         self.outs.flush()
 
+    def updateStatusLine(self, tname, str):
+        self.lines[tname] = str
+
+        idx = self.statusLines.index(tname)
+        offset = self.count_status_lines - idx
+        out = self.CURSOR_UP * offset + self.CURSOR_BOL
+        out += self.getStatusLines(idx)
+        self.outs.write(out)
+        self.outs.flush()
+
     def hasStatusLine(self, tname):
         return tname in self.lines
 
@@ -636,6 +685,11 @@ class CursesReporter(Reporter):
         self.addStatusLine("setup__" + tname, msg)
         self.outs.flush()
 
+    def updateSetUpSuite(self, tname, suite):
+        if self.hasStatusLine("setup__" + tname):
+            msg = "%s: %s" % (tname, self.getDescription(suite, "setUp"))
+            self.updateStatusLine("setup__" + tname, msg)
+
     def stopSetUpSuite(self, tname, suite):
         if self.hasStatusLine("setup__" + tname):
             self.dropStatusLine("setup__" + tname)
@@ -10,18 +10,23 @@ scheduling of tests and test suites, running them in parallel based on an
 asynchronous event loop using twisted.
 """
 
-import os, copy, time, shlex, shutil, operator
+import os, copy, time, errno, shlex, shutil, collections
 
 from zope.interface import implements
 
 from twisted.python import failure
-from twisted.internet import defer, reactor
+from twisted.internet import defer, reactor, task
 
 from dtester import utils
 from dtester.test import BaseTest, TestSuite, Timeout
+from dtester.basics import ProcessGroupMixin
 from dtester.events import EventMatcher, StreamDataEvent
 from dtester.interfaces import IControlledHost
-from dtester.processes import SimpleProcess
+from dtester.processes import SimpleProcess, EnvironmentLayer, \
+    ExecutableCache
+from dtester.launcher import ProcessLauncher
+from dtester.evlog import EventLogWriter, EventLogMerger
+from dtester.tailserver import TailServer, TailingReporter
 from dtester.exceptions import DefinitionError, TestSkipped, TimeoutError, \
     TestSkipped, UnableToRun, FailedDependencies
 from dtester.reporter import reporterFactory
@@ -59,7 +64,7 @@ class TestState:
         return self.suite
 
 
-class Localhost(TestSuite):
+class Localhost(TestSuite, ProcessGroupMixin):
     """ The local host as an IControlledHost object.
     """
 
@@ -70,10 +75,20 @@ class Localhost(TestSuite):
     setUpDescription = None
     tearDownDescription = None
 
+    # Directory for data kept across runs, defaults to ~/.dtester_cache.
+    cacheDir = None
+
     def postInit(self):
         self.temp_dir_counter = 1
         self.temp_port = 32768
 
+        # shared by all processes started on this host
+        self.environment = EnvironmentLayer(dict(os.environ))
+        self.executableCache = ExecutableCache()
+
+        # file descriptors holding directory locks, by path
+        self.dirLocks = {}
+
     def setUp(self):
         if os.path.exists(self.wd):
             raise Exception("Given working directory %s exists, not overriding." % self.wd)
@@ -107,11 +122,53 @@ class Localhost(TestSuite):
     def utime(self, path, atime, utime):
         os.utime(path, (atime, utime))
 
+    def getCacheDir(self):
+        if self.cacheDir is None:
+            return os.path.join(os.path.expanduser("~"), ".dtester_cache")
+        return self.cacheDir
+
+    def linkTree(self, srcPath, destPath):
+        utils.linkTree(srcPath, destPath)
+
+    def lockDirectory(self, path):
+        if path in self.dirLocks:
+            raise IOError(errno.EAGAIN, "Directory locked: %s" % path)
+        self.dirLocks[path] = utils.lockDirectory(path)
+
+    def unlockDirectory(self, path):
+        os.close(self.dirLocks.pop(path))
+
+    def sendTree(self, path, sink, ignore=None, compress=False):
+        packer = utils.TreePacker(path, ignore, compress)
+        return task.cooperate(self.writeTreeChunks(packer, sink)).whenDone()
+
+    def writeTreeChunks(self, packer, sink):
+        # Packs cooperatively with other reactor work, keeping up to
+        # TAR_WINDOW chunks in flight.
+        pending = collections.deque()
+        for data in packer.chunks():
+            pending.append(defer.maybeDeferred(sink.write, data))
+            if len(pending) >= utils.TAR_WINDOW:
+                yield pending.popleft()
+        yield defer.gatherResults(list(pending), consumeErrors=True)
+
+    def receiveTree(self, path, compress=False):
+        return utils.TreeUnpacker(path, compress)
+
+    def makeDirectories(self, paths):
+        for path in paths:
+            os.makedirs(path)
+
+    def utimes(self, entries):
+        for path, atime, mtime in entries:
+            os.utime(path, (atime, mtime))
+
     def recursiveList(self, top):
         def y(etype, abs_path):
             st = os.stat(abs_path)
             ppath = abs_path[len(top)+1:]
-            return (etype, ppath, st.st_atime, st.st_mtime, st.st_ctime)
+            return (etype, ppath, st.st_atime, st.st_mtime, st.st_ctime,
+                    st.st_size)
 
         for root, dirs, files in os.walk(top):
             for path in dirs:
@@ -152,22 +209,61 @@ class Localhost(TestSuite):
         self.temp_port += 1
         return result
 
-    def prepareProcess(self, name, cmdline, cwd=None, lineBasedOutput=True, ignoreOutput=False):
+    def prepareProcess(self, name, cmdline, cwd=None, lineBasedOutput=True,
+                       ignoreOutput=False, usePTY=False, outputMode=None,
+                       outputFile=None, tailOutput=False, stopSchedule=None,
+                       highWatermark=None, lowWatermark=None,
+                       overflowPolicy='pause'):
         if isinstance(cmdline, str):
             cmdline = shlex.split(cmdline)
 
         if cwd is None:
             cwd = self.runner.getTmpDir()
 
+        # distinct from the report files named after the event channels
+        if outputMode == 'file' and outputFile is None:
+            outputFile = self.runner.getOutputPath(name + ".output")
+
         proc = SimpleProcess(name, cmdline[0], cmdline[0], cwd,
-                             args=cmdline, lineBasedOutput=lineBasedOutput,
-                             ignoreOutput=ignoreOutput)
-        proc.addHook(EventMatcher(StreamDataEvent), self.logData)
-        return proc, proc.getTerminationDeferred()
+                             args=cmdline, env=self.environment.derive(),
+                             lineBasedOutput=lineBasedOutput,
+                             ignoreOutput=ignoreOutput,
+                             executableCache=self.executableCache,
+                             launcher=self.runner.getLauncher(),
+                             usePTY=usePTY, outputMode=outputMode,
+                             outputFile=outputFile, tailOutput=tailOutput,
+                             stopSchedule=stopSchedule,
+                             highWatermark=highWatermark,
+                             lowWatermark=lowWatermark,
+                             overflowPolicy=overflowPolicy)
+        # Redirected output is not logged, as it's either unwanted or
+        # already kept in a file. Logging may lose output under the
+        # 'drop' policy.
+        if proc.outputMode == 'events':
+            proc.addDroppableHook(EventMatcher(StreamDataEvent), self.logData)
+        d = proc.getTerminationDeferred()
+        d.addBoth(self.checkDroppedEvents, proc)
+        d.addBoth(self.recordResourceUsage, proc)
+        return proc, d
+
+    def startAll(self, procs):
+        for proc in procs:
+            proc.start()
 
     def logData(self, event):
         self.runner.evlogAppend(event.source.test_name, event.name, event.data)
 
+    def checkDroppedEvents(self, result, proc):
+        if proc.droppedEvents > 0:
+            self.runner.log("WARNING: dropped %d output events of %s" % (
+                proc.droppedEvents, proc.test_name))
+        return result
+
+    def recordResourceUsage(self, result, proc):
+        if proc.rusage is not None:
+            self.runner.recordResourceUsage(proc.test_name, proc.rusage)
+        return result
+
 
 class InitialSuite(TestSuite):
     """ The initial suite providing an initial base environment for all
@@ -190,7 +286,9 @@ class Runner:
         and test suites.
     """
     def __init__(self, reporter=None, testTimeout=15, suiteTimeout=60,
-                 controlReactor=True, tmpDir="tmp", reportDir=None):
+                 controlReactor=True, tmpDir="tmp", reportDir=None,
+                 useLauncher=False, maxOpenReportFiles=64,
+                 tailAddress=None):
         self.reporter = reporter or reporterFactory()
         self.test_states = {}
         self.testTimeout = testTimeout
@@ -198,7 +296,17 @@ class Runner:
         self.controlReactor = controlReactor
         self.tmpDir = tmpDir
         self.reportDir = reportDir
-        self.reportFiles = {}
+        self.resourceUsage = {}
+        self.launcher = None
+        if useLauncher:
+            self.launcher = ProcessLauncher()
+
+        # Optionally publish events to subscribers following the run, see
+        # L{dtester.tailserver}.
+        self.tailServer = None
+        if tailAddress is not None:
+            self.tailServer = TailServer(tailAddress)
+            self.reporter = TailingReporter(self.reporter, self.tailServer)
 
         self.tmpDir = os.path.abspath(tmpDir)
         if os.path.exists(self.tmpDir):
@@ -213,87 +321,87 @@ class Runner:
         if reportDir:
             os.makedirs(self.reportDir)
 
-        self.evlog = open(os.path.join(self.tmpDir, "localhost-event.log"), 'w')
-        self.hostEventLogs = {
-            'localhost': os.path.join(self.tmpDir, "localhost-event.log")
-            }
+        # The local event log is binary and written by a separate thread,
+        # see L{dtester.evlog}.
+        evlogPath = os.path.join(self.tmpDir, "localhost-event.bin.z")
+        self.reportFiles = None
+        if self.reportDir:
+            self.reportFiles = utils.FileHandleCache(self.reportDir,
+                                                     maxOpenReportFiles)
+        self.evlog = EventLogWriter(evlogPath, self.reportFiles,
+                                    self.reporter.log)
+        self.evlog.start()
+        self.evlogPath = evlogPath
+        self.hostEventLogs = {}
+
+        # The event logs of all hosts get merged as they are completed,
+        # if there's a report directory to merge into.
+        self.merger = None
+        if self.reportDir:
+            self.merger = EventLogMerger(self.reportDir, self.reportFiles,
+                                         self.reporter.log)
+            self.merger.start()
 
     def getTmpDir(self):
         return self.tmpDir
 
-    def evlogAppend(self, test_name, channel, data):
-        t = time.time()
+    def getOutputPath(self, filename):
+        """ Returns the path for an output file, placed in the report
+            directory, if any, or the temp directory otherwise.
+        """
+        return os.path.join(self.reportDir or self.tmpDir, filename)
 
-        try:
-            self.evlog.write("%d:%s:%s:%s\n" % (t, test_name, channel, repr(data)))
-        except Exception, e:
-            self.reporter.log("Unable to write to event log: %s" % str(e))
+    def getLauncher(self):
+        return self.launcher
 
-        # When running locally, we directly write to the reportDir, if
-        # required.
-        if self.reportDir:
-            try:
-                filename = test_name + "." + channel
-                if not filename in self.reportFiles:
-                    path = os.path.join(self.reportDir, filename)
-                    rf = open(path, 'w')
-                    self.reportFiles[filename] = rf
-                else:
-                    rf = self.reportFiles[filename]
-
-                # No timestamps in the report outputs files.
-                rf.write(data)
-            except Exception, e:
-                self.reporter.log("Unable to write to the report outputs: %s" % str(e))
+    def evlogAppend(self, test_name, channel, data):
+        self.evlog.append(time.time(), test_name, channel, data)
+        if self.tailServer:
+            self.tailServer.publish('output', 'localhost', test_name,
+                                    channel, data)
+
+    def recordResourceUsage(self, proc_name, rusage):
+        """ Adds the resources used by a process to the summary of the test
+            it belongs to, as determined by the process name.
+        """
+        tname = proc_name
+        parts = proc_name.split('.')
+        for i in range(len(parts) - 1, 0, -1):
+            candidate = '.'.join(parts[:i])
+            if candidate in self.test_states:
+                tname = candidate
+                break
+
+        if tname in self.resourceUsage:
+            self.resourceUsage[tname] += rusage
+        else:
+            self.resourceUsage[tname] = rusage
 
-    def registerHostEventLog(self, test_name, logFile):
+    def remoteEvlogAppend(self, host, t, test_name, channel, data):
+        """ Called for event log records streamed from remote hosts during
+            the run, with the data still in its repr() representation.
+            Writes the record's data to the report output files right away
+            and publishes it to subscribers of the tail server.
+        """
+        if self.reportFiles or self.tailServer:
+            args = utils.parseArgs(data, self.reporter.log)
+            assert len(args) == 1
+            if self.reportFiles:
+                self.reportFiles.write(test_name + "." + channel, args[0])
+            if self.tailServer:
+                self.tailServer.publish('output', host, test_name, channel,
+                                        args[0])
+
+    def registerHostEventLog(self, test_name, logFile, demultiplexed=False):
+        """ Registers the complete event log of a remote host, which gets
+            stored in the event.db right away and merged into the event.log
+            at the end of the run. If demultiplexed, its data has already been
+            written to the report output files via L{remoteEvlogAppend}.
+        """
         assert not test_name in self.hostEventLogs
         self.hostEventLogs[test_name] = logFile
-
-    def mergeEventLogs(self):
-        stack = []
-        for test_name, logFile in self.hostEventLogs.iteritems():
-            fd = open(logFile, 'r')
-            try:
-                line = fd.next()
-                t, test_name, channel, data = line.split(':', 3)
-                clf = {'host': test_name,
-                       'fd': fd,
-                       'time': t,
-                       'rest': (test_name, channel, data)}
-                stack.append(clf)
-            except StopIteration:
-                pass
-
-        fullEventLog = open(os.path.join(self.reportDir, "event.log"), 'w')
-        while len(stack) > 0:
-            stack = sorted(stack, key=operator.itemgetter('time'))
-
-            t = stack[0]['time']
-            host = stack[0]['host']
-            test_name, channel, data = stack[0]['rest']
-
-            fullEventLog.write("%s\t%s\t%s\t%s\t%s" % (
-                t, host, test_name, channel, data))
-
-            # output to separate log files, in case of non-local stuff
-            if host != 'localhost':
-                args = utils.parseArgs(data, self.reporter.log)
-                assert len(args) == 1
-                filename = test_name + "." + channel
-                fd = open(os.path.join(self.reportDir, filename), 'a')
-                fd.write(args[0])
-                fd.close()
-
-            # iterate
-            try:
-                line = stack[0]['fd'].next()
-                t, test_name, channel, data = line.split(':', 3)
-
-                stack[0]['time'] = t
-                stack[0]['rest'] = (test_name, channel, data)
-            except StopIteration:
-                stack = stack[1:]
+        if self.merger:
+            self.merger.add(test_name, logFile, demultiplexed)
 
     def processCmdListFinished(self, result):
         try:
@@ -301,6 +409,15 @@ class Runner:
         except Exception, e:
             self.reporter.log("Unable to close event log.")
 
+        # Only the local event log remains to be stored, before the final
+        # merge, while shutting down the launcher.
+        ds = []
+        if self.merger:
+            self.merger.add('localhost', self.evlogPath, demultiplexed=True)
+            ds.append(self.merger.finish())
+        if self.launcher:
+            ds.append(self.launcher.stop())
+
         count_total = 0
         count_succ = 0
         count_skipped = 0
@@ -345,19 +462,32 @@ class Runner:
                 count_total += 1
 
         t_diff = time.time() - self.t_start
+
+        # Report the results only after merging, so any error of the
+        # merger still gets reported.
+        d = defer.DeferredList(ds)
+        d.addCallback(self.reportResults, t_diff, count_total, count_succ,
+                      count_skipped, count_xfail, errors)
+        d.addCallback(self.removeTmpDir)
+        d.addCallback(self.stopReactor)
+        return d
+
+    def reportResults(self, result, t_diff, count_total, count_succ,
+                      count_skipped, count_xfail, errors):
+        self.reporter.resourceSummary(self.resourceUsage)
         self.reporter.end(t_diff, count_total, count_succ, count_skipped,
                           count_xfail, errors)
 
-        try:
-            # process and merge event logs
-            if self.reportDir:
-                self.mergeEventLogs()
+        if self.tailServer:
+            self.tailServer.stop()
 
+    def removeTmpDir(self, result):
+        try:
             shutil.rmtree(self.tmpDir)
-
         except Exception, e:
             pass
 
+    def stopReactor(self, result):
         if self.controlReactor:
             reactor.stop()
 
@@ -692,6 +822,11 @@ class Runner:
         self.t_start = time.time()
         self.reporter.begin(tdef)
 
+        if self.launcher:
+            self.launcher.start(self.log)
+        if self.tailServer:
+            self.tailServer.start()
+
         # initialize the initial system suite
         state = TestState(system.__class__, '__initial')
         state.running = True
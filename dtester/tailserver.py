@@ -0,0 +1,219 @@
+# tailserver.py
+#
+# Copyright (c) 2016 Markus Wanner
+#
+# Distributed under the Boost Software License, Version 1.0. (See
+# accompanying file LICENSE).
+
+"""
+a server streaming the events of a running test to any number of
+subscribers, i.e. for following a long run from a second terminal.
+"""
+
+import os, stat, time, collections
+
+from zope.interface import implements
+
+from twisted.internet import reactor, interfaces
+from twisted.internet.protocol import Factory
+from twisted.protocols.basic import LineReceiver
+from twisted.python import threadable
+
+# maximum number of lines buffered per subscriber, before dropping the
+# oldest ones
+MAX_BUFFERED = 1000
+
+
+class TailProtocol(LineReceiver):
+    """ A single subscriber. It receives all events, one per line, as tab
+        separated fields: time, kind, host, test name, channel and the
+        repr() of the data. Lines sent by the subscriber replace its
+        filter, given as space separated 'key=value' pairs, with keys
+        kind, host, test and channel. For example 'test=node2 kind=output'
+        selects only output of node2 and its sub-tests.
+
+        Lines are buffered while the connection cannot keep up, but only
+        up to MAX_BUFFERED ones. Older ones get dropped and the number of
+        dropped lines is sent as a 'dropped' event.
+    """
+    implements(interfaces.IPushProducer)
+
+    delimiter = "\n"
+
+    def __init__(self):
+        self.filter = {}
+        self.buffer = collections.deque()
+        self.paused = False
+        self.dropped = 0
+
+    def connectionMade(self):
+        self.transport.registerProducer(self, True)
+        self.factory.subscribers.append(self)
+
+    def connectionLost(self, reason):
+        if self in self.factory.subscribers:
+            self.factory.subscribers.remove(self)
+
+    def lineReceived(self, line):
+        newFilter = {}
+        for item in line.split():
+            if not "=" in item:
+                self.sendLine("error\tinvalid filter item: %s" % item)
+                return
+            key, value = item.split("=", 1)
+            if not key in ('kind', 'host', 'test', 'channel'):
+                self.sendLine("error\tunknown filter key: %s" % key)
+                return
+            newFilter[key] = value
+        self.filter = newFilter
+
+    def matches(self, kind, host, test_name, channel):
+        for key, value in (('kind', kind), ('host', host),
+                           ('channel', channel)):
+            if key in self.filter and self.filter[key] != value:
+                return False
+        if 'test' in self.filter:
+            prefix = self.filter['test']
+            if test_name != prefix and not test_name.startswith(prefix + "."):
+                return False
+        return True
+
+    def publish(self, line):
+        if self.paused:
+            if len(self.buffer) >= MAX_BUFFERED:
+                self.buffer.popleft()
+                self.dropped += 1
+            self.buffer.append(line)
+        else:
+            self.transport.write(line)
+
+    # IPushProducer methods
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        if self.dropped > 0:
+            self.transport.write("%.6f\tdropped\t\t\t\t%d\n" %
+                                 (time.time(), self.dropped))
+            self.dropped = 0
+        while len(self.buffer) > 0 and not self.paused:
+            self.transport.write(self.buffer.popleft())
+
+    def stopProducing(self):
+        self.buffer.clear()
+
+
+class TailServer(Factory):
+    """ Publishes events to all subscribed L{TailProtocol}s, listening on
+        a TCP port of the loopback interface, if given an integer, or on a
+        Unix socket at the given path, otherwise.
+    """
+    protocol = TailProtocol
+
+    def __init__(self, address):
+        self.address = address
+        self.subscribers = []
+        self.port = None
+
+    def start(self):
+        if isinstance(self.address, int):
+            self.port = reactor.listenTCP(self.address, self,
+                                          interface="127.0.0.1")
+        else:
+            self.removeStaleSocket()
+            self.port = reactor.listenUNIX(self.address, self)
+
+    def removeStaleSocket(self):
+        # A socket left over from a previous run would prevent listening.
+        try:
+            if stat.S_ISSOCK(os.stat(self.address).st_mode):
+                os.unlink(self.address)
+        except OSError:
+            pass
+
+    def stop(self):
+        """ Stops listening and disconnects all subscribers.
+        """
+        if self.port is not None:
+            # twisted removes the Unix socket itself
+            self.port.stopListening()
+            self.port = None
+        for subscriber in self.subscribers[:]:
+            subscriber.transport.loseConnection()
+
+    def publish(self, kind, host, test_name, channel, data):
+        """ Sends an event to all interested subscribers, may be called
+            from any thread.
+        """
+        if len(self.subscribers) == 0:
+            return
+        if not threadable.isInIOThread():
+            reactor.callFromThread(self.publish, kind, host, test_name,
+                                   channel, data)
+            return
+
+        line = None
+        for subscriber in self.subscribers:
+            if subscriber.matches(kind, host, test_name, channel):
+                if line is None:
+                    line = "%.6f\t%s\t%s\t%s\t%s\t%s\n" % (
+                        time.time(), kind, host, test_name, channel,
+                        repr(data))
+                subscriber.publish(line)
+
+
+class TailingReporter:
+    """ Wraps a reporter, publishing state transitions of tests and suites
+        as well as log messages to a L{TailServer}.
+    """
+    def __init__(self, reporter, server):
+        self.reporter = reporter
+        self.server = server
+
+    def __getattr__(self, name):
+        return getattr(self.reporter, name)
+
+    def publishState(self, tname, state, result=""):
+        self.server.publish('state', 'localhost', tname, state, result)
+
+    def startTest(self, tname, test):
+        self.publishState(tname, 'start')
+        return self.reporter.startTest(tname, test)
+
+    def stopTest(self, tname, test, result, error):
+        self.publishState(tname, 'stop', result)
+        return self.reporter.stopTest(tname, test, result, error)
+
+    def startSetUpSuite(self, tname, suite):
+        self.publishState(tname, 'setup')
+        return self.reporter.startSetUpSuite(tname, suite)
+
+    def updateSetUpSuite(self, tname, suite):
+        self.publishState(tname, 'progress',
+                          self.reporter.getDescription(suite, "setUp"))
+        return self.reporter.updateSetUpSuite(tname, suite)
+
+    def stopSetUpSuite(self, tname, suite):
+        self.publishState(tname, 'running')
+        return self.reporter.stopSetUpSuite(tname, suite)
+
+    def startTearDownSuite(self, tname, suite):
+        self.publishState(tname, 'teardown')
+        return self.reporter.startTearDownSuite(tname, suite)
+
+    def stopTearDownSuite(self, tname, suite):
+        self.publishState(tname, 'done')
+        return self.reporter.stopTearDownSuite(tname, suite)
+
+    def suiteSetUpFailure(self, tname, error):
+        self.publishState(tname, 'setup-failed', error.getErrorMessage())
+        return self.reporter.suiteSetUpFailure(tname, error)
+
+    def suiteTearDownFailure(self, tname, error):
+        self.publishState(tname, 'teardown-failed', error.getErrorMessage())
+        return self.reporter.suiteTearDownFailure(tname, error)
+
+    def log(self, msg):
+        self.server.publish('log', 'localhost', '', 'log', msg)
+        return self.reporter.log(msg)
@@ -65,6 +65,21 @@ class BaseTest(object):
         self.wait_deferred = None
         return result
 
+    def waitForComposite(self, matcher):
+        """ Waits for a L{CompositeMatcher} spanning one or more event
+            sources to be satisfied.
+        """
+        d = defer.Deferred()
+        matcher.install(self._cbWaitFor, d)
+        d.addBoth(self.cleanupCompositeWaitHook, matcher)
+        self.wait_deferred = d
+        return d
+
+    def cleanupCompositeWaitHook(self, result, matcher):
+        matcher.uninstall()
+        self.wait_deferred = None
+        return result
+
     def _setUp(self):
         self.running = True
         return self.setUp()
@@ -209,7 +224,7 @@ class SyncTest(BaseTest):
 
     def _startAndWaitFor(self, source, matcher, timeout):
         md = defer.Deferred()
-        self.wait_hook = source.addHook(matcher, self._cbWaitFor, source, md)
+        self.wait_hook = source.addHook(matcher, self._cbWaitFor, md)
         source.start()
 
         td = Timeout("Test: _startAndWaitFor", timeout, md)
@@ -245,6 +260,12 @@ class TestSuite(BaseTest):
         BaseTest.__init__(self, runner, test_name, *args, **kwargs)
         self.children = []
 
+    def reportSetUpProgress(self):
+        """ Lets the reporter know that the setUpDescription changed, i.e.
+            to show the progress of a lengthy setUp.
+        """
+        self.runner.reporter.updateSetUpSuite(self.test_name, self)
+
     def setUpFailure(self, result):
         print "failure in setUp: %s, skipping contained tests" % result
         return False
@@ -5,98 +5,480 @@
 # Distributed under the Boost Software License, Version 1.0. (See
 # accompanying file LICENSE).
 
+import os, re, stat, zlib, errno, fcntl, shutil, struct, fnmatch, \
+    tarfile, threading, collections
+
+# A single argument in its repr() representation: a string in single or
+# double quotes or a decimal number.
+ARG_RE = re.compile(r"""[ \t\r\n]*(?:
+      '([^'\\]*(?:\\.[^'\\]*)*)'
+    | "([^"\\]*(?:\\.[^"\\]*)*)"
+    | ([-+]?[0-9.][0-9.eE+-]*)
+    )""", re.VERBOSE | re.DOTALL)
+
+TRAILING_SPACE_RE = re.compile(r"[ \t\r\n]*$")
+
 def parseArgs(rest, errLogFunc):
-    """ Parse python args in their repr() representation, supporting mainly
-        strings and decimal numbers.
+    """ Parse python args in their repr() representation, supporting
+        strings and decimal numbers. The inverse of L{formatArgs}. Note
+        that remhelper.py carries a copy, as it cannot import dtester.
     """
-    in_single_string = False
-    in_double_string = False
-    in_number = False
-    in_backslash = False
-    in_bl_hex_char = False
-    hex_char = ""
-    token = ""
     args = []
-    for char in rest:
-        if in_bl_hex_char:
-            assert char in "0123456789" or char in "abcdef"
-            hex_char += char
-            if len(hex_char) == 2:
-                token += "\\x" + hex_char
-                hex_char = ""
-                in_bl_hex_char = False
-        elif char == "'" and not in_double_string and not in_number:
-            if not in_single_string:
-                in_single_string = True
-            elif in_backslash:
-                token += "'"
-                in_backslash = False
-            else:
-                args.append(token)
-                in_single_string = False
-                token = ""
-        elif char == '"' and not in_single_string and not in_number:
-            if not in_double_string:
-                in_double_string = True
-            elif in_backslash:
-                token += '"'
-                in_backslash = False
-            else:
-                args.append(token)
-                in_double_string = False
-                token = ""
-        elif char == "\\" and not in_backslash:
-            if in_single_string or in_double_string:
-                in_backslash = True
+    pos = 0
+    end = len(rest)
+    while pos < end:
+        m = ARG_RE.match(rest, pos)
+        if m is None:
+            if TRAILING_SPACE_RE.match(rest, pos):
+                break
+            token = rest[pos:].lstrip()
+            if token[0] in "'\"":
+                errLogFunc("unterminated string at end of line: %s" %
+                           repr(token))
+                try:
+                    args.append(token[1:].decode('string_escape'))
+                except ValueError:
+                    args.append(token[1:])
+                break
+            errLogFunc("invalid char outside of token: '%s' in: %s" %
+                       (repr(token[0]), rest))
+            pos = end - len(token) + 1
+            continue
+
+        single, double, number = m.groups()
+        if single is not None:
+            args.append(single.decode('string_escape'))
+        elif double is not None:
+            args.append(double.decode('string_escape'))
+        else:
+            try:
+                if "." in number or "e" in number or "E" in number:
+                    args.append(float(number))
+                else:
+                    args.append(int(number))
+            except ValueError:
+                errLogFunc("invalid number: '%s' in: %s" % (number, rest))
+        pos = m.end()
+
+    return args
+
+def formatArgs(args):
+    """ Formats arguments for L{parseArgs}.
+    """
+    result = []
+    for arg in args:
+        if isinstance(arg, (int, long)):
+            # avoids the 'L' suffix of longs
+            result.append("%d" % arg)
+        else:
+            result.append(repr(arg))
+    return " ".join(result)
+
+
+# The binary framing of the remote helper protocol, as negotiated in the
+# 'hello' handshake. Each frame consists of the length of its body followed
+# by typed fields, the first one being the command name. Strings are
+# length-prefixed raw bytes, integers and floats have a fixed size.
+BINARY_PROTOCOL = "binary1"
+FRAME_HEADER = struct.Struct("!I")
+FIELD_LENGTH = struct.Struct("!cI")
+FIELD_INT = struct.Struct("!cq")
+FIELD_FLOAT = struct.Struct("!cd")
+
+def encodeFrame(cmd, args):
+    """ Encodes a command and its arguments, which may be strings,
+        integers or floats, as a single frame.
+    """
+    fields = [FIELD_LENGTH.pack('s', len(cmd)), cmd]
+    for arg in args:
+        if isinstance(arg, str):
+            fields.append(FIELD_LENGTH.pack('s', len(arg)))
+            fields.append(arg)
+        elif isinstance(arg, (int, long)):
+            fields.append(FIELD_INT.pack('i', arg))
+        elif isinstance(arg, float):
+            fields.append(FIELD_FLOAT.pack('f', arg))
+        else:
+            raise TypeError("cannot encode %s" % repr(arg))
+    body = "".join(fields)
+    return FRAME_HEADER.pack(len(body)) + body
+
+
+class FrameDecoder:
+    """ Decodes a stream of frames, see L{encodeFrame}.
+    """
+    def __init__(self):
+        self.buffer = ""
+
+    def feed(self, data):
+        """ Returns a list of (cmd, args) tuples for all frames completed
+            by the given data.
+        """
+        buf = self.buffer + data
+        offset = 0
+        frames = []
+        while len(buf) - offset >= FRAME_HEADER.size:
+            length, = FRAME_HEADER.unpack_from(buf, offset)
+            end = offset + FRAME_HEADER.size + length
+            if end > len(buf):
+                break
+            fields = self.decodeFields(buf, offset + FRAME_HEADER.size, end)
+            frames.append((fields[0], fields[1:]))
+            offset = end
+        self.buffer = buf[offset:]
+        return frames
+
+    def decodeFields(self, buf, offset, end):
+        fields = []
+        while offset < end:
+            ftype = buf[offset]
+            if ftype == 's':
+                ftype, length = FIELD_LENGTH.unpack_from(buf, offset)
+                offset += FIELD_LENGTH.size
+                fields.append(buf[offset:offset + length])
+                offset += length
+            elif ftype == 'i':
+                fields.append(FIELD_INT.unpack_from(buf, offset)[1])
+                offset += FIELD_INT.size
+            elif ftype == 'f':
+                fields.append(FIELD_FLOAT.unpack_from(buf, offset)[1])
+                offset += FIELD_FLOAT.size
             else:
-                errLogFunc("WARNING: invalid position for backslash, ignored!")
-        elif char in "-.0123456789" and not in_backslash:
-            if in_number or in_single_string or in_double_string:
-                token += char
+                raise ValueError("invalid field type %s" % repr(ftype))
+        return fields
+
+
+# size of the chunks of a tree archive to send at once and the maximum
+# number of chunks in flight
+TAR_CHUNK_SIZE = 65536
+TAR_WINDOW = 16
+
+def ignoreNames(ignore):
+    """ Returns a predicate for names matching any of the semicolon
+        separated shell patterns given.
+    """
+    patterns = []
+    if ignore:
+        patterns = ignore.split(';')
+    def ignored(name):
+        for pattern in patterns:
+            if fnmatch.fnmatch(name, pattern):
+                return True
+        return False
+    return ignored
+
+class TreePacker:
+    """ Produces a tar archive of a directory tree in PAX format, gzip
+        compressed if requested, in chunks of about TAR_CHUNK_SIZE bytes.
+        Files are read piecewise, so even large files need not fit into
+        memory. Entries with a name matching the ignore patterns are
+        skipped, including all contents of such directories.
+    """
+    def __init__(self, top, ignore=None, compress=False):
+        self.top = top
+        self.ignored = ignoreNames(ignore)
+        if compress:
+            self.compressor = zlib.compressobj(6, zlib.DEFLATED,
+                                               16 + zlib.MAX_WBITS)
+        else:
+            self.compressor = None
+        self.buffer = []
+        self.size = 0
+        self.written = 0
+
+    def iterEntries(self):
+        for root, dirs, files in os.walk(self.top):
+            dirs[:] = [d for d in sorted(dirs) if not self.ignored(d)]
+            rel = root[len(self.top) + 1:].split(os.sep)
+            if rel == ['']:
+                rel = []
+            for name in dirs:
+                yield '/'.join(rel + [name]), os.path.join(root, name)
+            for name in sorted(files):
+                if not self.ignored(name):
+                    yield '/'.join(rel + [name]), os.path.join(root, name)
+
+    def chunks(self):
+        """ Yields the chunks of the archive.
+        """
+        for name, path in self.iterEntries():
+            st = os.stat(path)
+            info = tarfile.TarInfo(name)
+            # the sub-second part only fits into a PAX header
+            info.mtime = int(st.st_mtime)
+            info.pax_headers['mtime'] = u"%.6f" % st.st_mtime
+            info.mode = stat.S_IMODE(st.st_mode)
+            if stat.S_ISDIR(st.st_mode):
+                info.type = tarfile.DIRTYPE
+            elif stat.S_ISREG(st.st_mode):
+                info.size = st.st_size
             else:
-                token += char
-                in_number = True
+                continue
+            self.write(info.tobuf(tarfile.PAX_FORMAT, "utf-8"))
+
+            if info.isreg():
+                fd = open(path, 'rb')
+                try:
+                    remaining = info.size
+                    while remaining > 0:
+                        data = fd.read(min(remaining, TAR_CHUNK_SIZE))
+                        if len(data) == 0:
+                            raise IOError("%s: file shrunk while reading" %
+                                          path)
+                        remaining -= len(data)
+                        self.write(data)
+                        if self.size >= TAR_CHUNK_SIZE:
+                            yield self.flush()
+                finally:
+                    fd.close()
+                blocks, rest = divmod(info.size, tarfile.BLOCKSIZE)
+                if rest > 0:
+                    self.write(tarfile.NUL * (tarfile.BLOCKSIZE - rest))
+
+            if self.size >= TAR_CHUNK_SIZE:
+                yield self.flush()
+
+        # end of archive marker, padded to a full record
+        self.write(tarfile.NUL * (2 * tarfile.BLOCKSIZE))
+        blocks, rest = divmod(self.written, tarfile.RECORDSIZE)
+        if rest > 0:
+            self.write(tarfile.NUL * (tarfile.RECORDSIZE - rest))
+        data = self.flush()
+        if self.compressor:
+            data += self.compressor.flush(zlib.Z_FINISH)
+        if len(data) > 0:
+            yield data
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.size += len(data)
+        self.written += len(data)
+
+    def flush(self):
+        data = "".join(self.buffer)
+        self.buffer = []
+        self.size = 0
+        if self.compressor:
+            data = self.compressor.compress(data)
+        return data
+
+
+class TreeUnpacker:
+    """ Unpacks a tar archive as produced by L{TreePacker} into the given
+        directory, while being written to. Regular files and directories
+        are restored with their mode and modification time, other entries
+        are skipped.
+    """
+    def __init__(self, top, compress=False):
+        self.top = top
+        if compress:
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
         else:
-            if in_backslash:
-                if char == "n":
-                    token += "\n"
-                elif char == "r":
-                    token += "\r"
-                elif char == "t":
-                    token += "\t"
-                elif char == "x":
-                    in_hex_char = True
-                elif char == "\\":
-                    token += "\\"
+            self.decompressor = None
+        self.buffer = ""
+        self.finished = False
+        self.paxHeaders = {}
+        self.dirTimes = []
+
+        # the entry whose data is being read
+        self.info = None
+        self.fd = None
+        self.remaining = 0
+        self.padding = 0
+        self.data = []
+
+    def write(self, data):
+        if self.decompressor:
+            data = self.decompressor.decompress(data)
+        self.buffer += data
+        offset = 0
+        while not self.finished:
+            if self.info is not None:
+                offset = self.consumeData(offset)
+                if self.info is not None:
+                    break
+            elif len(self.buffer) - offset >= tarfile.BLOCKSIZE:
+                header = self.buffer[offset:offset + tarfile.BLOCKSIZE]
+                offset += tarfile.BLOCKSIZE
+                if header == tarfile.NUL * tarfile.BLOCKSIZE:
+                    self.finished = True
                 else:
-                    errLogFunc("WARNING: unknown escape character: '%s'"
-                               % repr(char))
-                in_backslash = False
-            elif in_single_string or in_double_string:
-                token += char
-            elif in_number and char in ".0123456789+-e":
-                token += char
+                    self.startEntry(tarfile.TarInfo.frombuf(header))
             else:
-                if char in " \n\r\t":
-                    if in_number:
-                        if "." in token:
-                            args.append(float(token))
-                        else:
-                            args.append(int(token))
-                    token = ""
-                    in_number = False
-                else:
-                    errLogFunc("invalid char outside of token: '%s' in: %s" % (repr(char), rest))
+                break
+        self.buffer = self.buffer[offset:]
 
-    if in_number:
-        if "." in token or 'e' in token:
-            args.append(float(token))
-        else:
-            args.append(int(token))
-    elif in_single_string or in_double_string:
-        errLogFunc("unterminated string at end of line: %s" % repr(token))
-        args.append(token)
+    def startEntry(self, info):
+        for key, value in self.paxHeaders.iteritems():
+            if key == 'path':
+                info.name = value
+            elif key == 'mtime':
+                info.mtime = float(value)
+            elif key == 'size':
+                info.size = int(value)
+        self.paxHeaders = {}
 
-    return args
+        self.info = info
+        self.remaining = info.size
+        self.padding = -info.size % tarfile.BLOCKSIZE
+        if info.type in (tarfile.XHDTYPE, tarfile.XGLTYPE):
+            self.data = []
+            return
+
+        parts = info.name.rstrip('/').split('/')
+        if info.name.startswith('/') or '..' in parts:
+            raise ValueError("invalid path in archive: %s" % info.name)
+        path = os.path.join(self.top, *parts)
+        if info.isdir():
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            # adjusted at the very end, after having added all contents
+            self.dirTimes.append((path, info))
+        elif info.isreg():
+            self.fd = open(path, 'wb')
+        self.info.path = path
+
+    def consumeData(self, offset):
+        count = min(self.remaining, len(self.buffer) - offset)
+        data = self.buffer[offset:offset + count]
+        if self.fd:
+            self.fd.write(data)
+        elif self.info.type in (tarfile.XHDTYPE, tarfile.XGLTYPE):
+            self.data.append(data)
+        self.remaining -= count
+        offset += count
+        if self.remaining > 0:
+            return offset
+
+        count = min(self.padding, len(self.buffer) - offset)
+        self.padding -= count
+        offset += count
+        if self.padding == 0:
+            self.finishEntry()
+        return offset
 
+    def finishEntry(self):
+        info, self.info = self.info, None
+        if info.type == tarfile.XHDTYPE:
+            self.paxHeaders = self.parsePaxHeaders("".join(self.data))
+        elif self.fd:
+            self.fd.close()
+            self.fd = None
+            os.chmod(info.path, info.mode)
+            os.utime(info.path, (info.mtime, info.mtime))
+
+    def parsePaxHeaders(self, data):
+        headers = {}
+        offset = 0
+        while offset < len(data):
+            length, rest = data[offset:].split(' ', 1)
+            record = data[offset:offset + int(length)]
+            key, value = record.split(' ', 1)[1][:-1].split('=', 1)
+            headers[key] = value
+            offset += int(length)
+        return headers
+
+    def close(self):
+        """ Adjusts the directories and checks that the archive is
+            complete.
+        """
+        if self.fd:
+            self.fd.close()
+            self.fd = None
+        if not self.finished:
+            raise ValueError("truncated archive")
+        for path, info in reversed(self.dirTimes):
+            os.chmod(path, info.mode)
+            os.utime(path, (info.mtime, info.mtime))
+
+
+def linkTree(src, dest):
+    """ Recreates the directory tree at src in the existing directory
+        dest. Files are hard linked, or copied where that's not possible,
+        i.e. across file systems.
+    """
+    for root, dirs, files in os.walk(src):
+        target = os.path.join(dest, root[len(src) + 1:])
+        for name in dirs:
+            path = os.path.join(target, name)
+            if not os.path.isdir(path):
+                os.mkdir(path)
+        for name in files:
+            try:
+                os.link(os.path.join(root, name), os.path.join(target, name))
+            except OSError, e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise
+                shutil.copy2(os.path.join(root, name),
+                             os.path.join(target, name))
+
+
+def lockDirectory(path):
+    """ Takes an exclusive lock on the directory at path, by means of a
+        lock file next to it, without waiting. Returns the file descriptor
+        holding the lock, which gets released by closing it. Raises an
+        IOError, if the lock is held already.
+    """
+    fd = os.open(path + ".lock", os.O_WRONLY | os.O_CREAT, 0644)
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError, e:
+        os.close(fd)
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+            raise IOError(e.errno, "Directory locked: %s" % path)
+        raise
+    return fd
+
+
+class FileHandleCache:
+    """ Keeps a bounded number of output files open, closing the least
+        recently used one if necessary. A file is truncated when first
+        opened and appended to, if reopened after eviction. May be shared
+        between threads.
+    """
+    def __init__(self, directory, maxOpen=64):
+        assert maxOpen > 0
+        self.directory = directory
+        self.maxOpen = maxOpen
+        self.handles = collections.OrderedDict()
+        self.known = set()
+        self.lock = threading.Lock()
+
+    def write(self, filename, data):
+        """ Appends data to the given file, relative to the directory.
+        """
+        self.lock.acquire()
+        try:
+            self.getHandle(filename).write(data)
+        finally:
+            self.lock.release()
+
+    def getHandle(self, filename):
+        if filename in self.handles:
+            fd = self.handles.pop(filename)
+        else:
+            while len(self.handles) >= self.maxOpen:
+                name, evicted = self.handles.popitem(last=False)
+                evicted.close()
+            if filename in self.known:
+                mode = 'a'
+            else:
+                mode = 'w'
+            fd = open(os.path.join(self.directory, filename), mode)
+            self.known.add(filename)
+        # re-insert as the most recently used one
+        self.handles[filename] = fd
+        return fd
 
+    def close(self):
+        """ Closes all open files. They get reopened on the next write.
+        """
+        self.lock.acquire()
+        try:
+            handles, self.handles = self.handles, collections.OrderedDict()
+            for fd in handles.itervalues():
+                fd.close()
+        finally:
+            self.lock.release()
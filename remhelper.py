@@ -1,11 +1,477 @@
 #!/usr/bin/env python
 
-import sys, os, re, pty, time, copy, shutil, getopt, signal
-import subprocess, platform, asyncore, exceptions
+import sys, os, re, pty, stat, time, zlib, errno, shutil, struct, getopt
+import fcntl, signal, fnmatch, tarfile, subprocess, platform, asyncore, \
+    exceptions
 
 # FIXME: checkout signal and multiprocessing modules
 
 
+ENV_VAR_RE = re.compile(
+    r"\$\{([A-Za-z_][A-Za-z0-9_]*)\}|\$([A-Za-z_][A-Za-z0-9_]*)")
+
+def substituteEnvVars(value, env):
+    """ Expands $VAR and ${VAR} references in a single pass, leaving
+        undefined ones untouched. Same as in dtester.processes, which
+        cannot be imported here.
+    """
+    if not "$" in value:
+        return value
+
+    def replace(match):
+        name = match.group(1) or match.group(2)
+        if name in env:
+            return env[name]
+        else:
+            return match.group(0)
+
+    return ENV_VAR_RE.sub(replace, value)
+
+
+# The default escalation for stopping processes, as sent by the test
+# harness: signals to send and the time to wait before escalating.
+DEFAULT_STOP_SCHEDULE = "%d:10,%d:10,%d" % (signal.SIGINT, signal.SIGTERM,
+                                            signal.SIGKILL)
+
+def parseStopSchedule(schedule):
+    steps = []
+    for step in schedule.split(","):
+        if ":" in step:
+            sig, timeout = step.split(":", 1)
+            steps.append((int(sig), float(timeout)))
+        else:
+            steps.append((int(step), None))
+    return steps
+
+
+# A single argument in its repr() representation: a string in single or
+# double quotes or a decimal number.
+ARG_RE = re.compile(r"""[ \t\r\n]*(?:
+      '([^'\\]*(?:\\.[^'\\]*)*)'
+    | "([^"\\]*(?:\\.[^"\\]*)*)"
+    | ([-+]?[0-9.][0-9.eE+-]*)
+    )""", re.VERBOSE | re.DOTALL)
+
+TRAILING_SPACE_RE = re.compile(r"[ \t\r\n]*$")
+
+def parseArgs(rest, errLogFunc):
+    """ Parse python args in their repr() representation, supporting
+        strings and decimal numbers. Same as in dtester.utils, which
+        cannot be imported here.
+    """
+    args = []
+    pos = 0
+    end = len(rest)
+    while pos < end:
+        m = ARG_RE.match(rest, pos)
+        if m is None:
+            if TRAILING_SPACE_RE.match(rest, pos):
+                break
+            token = rest[pos:].lstrip()
+            if token[0] in "'\"":
+                errLogFunc("unterminated string at end of line: %s" %
+                           repr(token))
+                try:
+                    args.append(token[1:].decode('string_escape'))
+                except ValueError:
+                    args.append(token[1:])
+                break
+            errLogFunc("invalid char outside of token: '%s' in: %s" %
+                       (repr(token[0]), rest))
+            pos = end - len(token) + 1
+            continue
+
+        single, double, number = m.groups()
+        if single is not None:
+            args.append(single.decode('string_escape'))
+        elif double is not None:
+            args.append(double.decode('string_escape'))
+        else:
+            try:
+                if "." in number or "e" in number or "E" in number:
+                    args.append(float(number))
+                else:
+                    args.append(int(number))
+            except ValueError:
+                errLogFunc("invalid number: '%s' in: %s" % (number, rest))
+        pos = m.end()
+
+    return args
+
+
+def formatArgs(args):
+    """ Formats arguments for L{parseArgs}.
+    """
+    result = []
+    for arg in args:
+        if isinstance(arg, (int, long)):
+            # avoids the 'L' suffix of longs
+            result.append("%d" % arg)
+        else:
+            result.append(repr(arg))
+    return " ".join(result)
+
+
+# The binary framing of the protocol, as negotiated in the 'hello'
+# handshake, same as in dtester.utils. Each frame consists of the length
+# of its body followed by typed fields, the first one being the command
+# name. Strings are length-prefixed raw bytes, integers and floats have a
+# fixed size.
+BINARY_PROTOCOL = "binary1"
+FRAME_HEADER = struct.Struct("!I")
+FIELD_LENGTH = struct.Struct("!cI")
+FIELD_INT = struct.Struct("!cq")
+FIELD_FLOAT = struct.Struct("!cd")
+
+def encodeFrame(cmd, args):
+    """ Encodes a command and its arguments, which may be strings,
+        integers or floats, as a single frame.
+    """
+    fields = [FIELD_LENGTH.pack('s', len(cmd)), cmd]
+    for arg in args:
+        if isinstance(arg, str):
+            fields.append(FIELD_LENGTH.pack('s', len(arg)))
+            fields.append(arg)
+        elif isinstance(arg, (int, long)):
+            fields.append(FIELD_INT.pack('i', arg))
+        elif isinstance(arg, float):
+            fields.append(FIELD_FLOAT.pack('f', arg))
+        else:
+            raise TypeError("cannot encode %s" % repr(arg))
+    body = "".join(fields)
+    return FRAME_HEADER.pack(len(body)) + body
+
+
+class FrameDecoder:
+    """ Decodes a stream of frames, see L{encodeFrame}.
+    """
+    def __init__(self):
+        self.buffer = ""
+
+    def feed(self, data):
+        """ Returns a list of (cmd, args) tuples for all frames completed
+            by the given data.
+        """
+        buf = self.buffer + data
+        offset = 0
+        frames = []
+        while len(buf) - offset >= FRAME_HEADER.size:
+            length, = FRAME_HEADER.unpack_from(buf, offset)
+            end = offset + FRAME_HEADER.size + length
+            if end > len(buf):
+                break
+            fields = self.decodeFields(buf, offset + FRAME_HEADER.size, end)
+            frames.append((fields[0], fields[1:]))
+            offset = end
+        self.buffer = buf[offset:]
+        return frames
+
+    def decodeFields(self, buf, offset, end):
+        fields = []
+        while offset < end:
+            ftype = buf[offset]
+            if ftype == 's':
+                ftype, length = FIELD_LENGTH.unpack_from(buf, offset)
+                offset += FIELD_LENGTH.size
+                fields.append(buf[offset:offset + length])
+                offset += length
+            elif ftype == 'i':
+                fields.append(FIELD_INT.unpack_from(buf, offset)[1])
+                offset += FIELD_INT.size
+            elif ftype == 'f':
+                fields.append(FIELD_FLOAT.unpack_from(buf, offset)[1])
+                offset += FIELD_FLOAT.size
+            else:
+                raise ValueError("invalid field type %s" % repr(ftype))
+        return fields
+
+
+# Archives of directory trees, same as in dtester.utils. Size of the
+# chunks of an archive to send at once and the maximum number of chunks
+# in flight.
+TAR_CHUNK_SIZE = 65536
+TAR_WINDOW = 16
+
+def ignoreNames(ignore):
+    """ Returns a predicate for names matching any of the semicolon
+        separated shell patterns given.
+    """
+    patterns = []
+    if ignore:
+        patterns = ignore.split(';')
+    def ignored(name):
+        for pattern in patterns:
+            if fnmatch.fnmatch(name, pattern):
+                return True
+        return False
+    return ignored
+
+class TreePacker:
+    """ Produces a tar archive of a directory tree in PAX format, gzip
+        compressed if requested, in chunks of about TAR_CHUNK_SIZE bytes.
+        Files are read piecewise, so even large files need not fit into
+        memory. Entries with a name matching the ignore patterns are
+        skipped, including all contents of such directories.
+    """
+    def __init__(self, top, ignore=None, compress=False):
+        self.top = top
+        self.ignored = ignoreNames(ignore)
+        if compress:
+            self.compressor = zlib.compressobj(6, zlib.DEFLATED,
+                                               16 + zlib.MAX_WBITS)
+        else:
+            self.compressor = None
+        self.buffer = []
+        self.size = 0
+        self.written = 0
+
+    def iterEntries(self):
+        for root, dirs, files in os.walk(self.top):
+            dirs[:] = [d for d in sorted(dirs) if not self.ignored(d)]
+            rel = root[len(self.top) + 1:].split(os.sep)
+            if rel == ['']:
+                rel = []
+            for name in dirs:
+                yield '/'.join(rel + [name]), os.path.join(root, name)
+            for name in sorted(files):
+                if not self.ignored(name):
+                    yield '/'.join(rel + [name]), os.path.join(root, name)
+
+    def chunks(self):
+        """ Yields the chunks of the archive.
+        """
+        for name, path in self.iterEntries():
+            st = os.stat(path)
+            info = tarfile.TarInfo(name)
+            # the sub-second part only fits into a PAX header
+            info.mtime = int(st.st_mtime)
+            info.pax_headers['mtime'] = u"%.6f" % st.st_mtime
+            info.mode = stat.S_IMODE(st.st_mode)
+            if stat.S_ISDIR(st.st_mode):
+                info.type = tarfile.DIRTYPE
+            elif stat.S_ISREG(st.st_mode):
+                info.size = st.st_size
+            else:
+                continue
+            self.write(info.tobuf(tarfile.PAX_FORMAT, "utf-8"))
+
+            if info.isreg():
+                fd = open(path, 'rb')
+                try:
+                    remaining = info.size
+                    while remaining > 0:
+                        data = fd.read(min(remaining, TAR_CHUNK_SIZE))
+                        if len(data) == 0:
+                            raise IOError("%s: file shrunk while reading" %
+                                          path)
+                        remaining -= len(data)
+                        self.write(data)
+                        if self.size >= TAR_CHUNK_SIZE:
+                            yield self.flush()
+                finally:
+                    fd.close()
+                blocks, rest = divmod(info.size, tarfile.BLOCKSIZE)
+                if rest > 0:
+                    self.write(tarfile.NUL * (tarfile.BLOCKSIZE - rest))
+
+            if self.size >= TAR_CHUNK_SIZE:
+                yield self.flush()
+
+        # end of archive marker, padded to a full record
+        self.write(tarfile.NUL * (2 * tarfile.BLOCKSIZE))
+        blocks, rest = divmod(self.written, tarfile.RECORDSIZE)
+        if rest > 0:
+            self.write(tarfile.NUL * (tarfile.RECORDSIZE - rest))
+        data = self.flush()
+        if self.compressor:
+            data += self.compressor.flush(zlib.Z_FINISH)
+        if len(data) > 0:
+            yield data
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.size += len(data)
+        self.written += len(data)
+
+    def flush(self):
+        data = "".join(self.buffer)
+        self.buffer = []
+        self.size = 0
+        if self.compressor:
+            data = self.compressor.compress(data)
+        return data
+
+
+class TreeUnpacker:
+    """ Unpacks a tar archive as produced by L{TreePacker} into the given
+        directory, while being written to. Regular files and directories
+        are restored with their mode and modification time, other entries
+        are skipped.
+    """
+    def __init__(self, top, compress=False):
+        self.top = top
+        if compress:
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self.decompressor = None
+        self.buffer = ""
+        self.finished = False
+        self.paxHeaders = {}
+        self.dirTimes = []
+
+        # the entry whose data is being read
+        self.info = None
+        self.fd = None
+        self.remaining = 0
+        self.padding = 0
+        self.data = []
+
+    def write(self, data):
+        if self.decompressor:
+            data = self.decompressor.decompress(data)
+        self.buffer += data
+        offset = 0
+        while not self.finished:
+            if self.info is not None:
+                offset = self.consumeData(offset)
+                if self.info is not None:
+                    break
+            elif len(self.buffer) - offset >= tarfile.BLOCKSIZE:
+                header = self.buffer[offset:offset + tarfile.BLOCKSIZE]
+                offset += tarfile.BLOCKSIZE
+                if header == tarfile.NUL * tarfile.BLOCKSIZE:
+                    self.finished = True
+                else:
+                    self.startEntry(tarfile.TarInfo.frombuf(header))
+            else:
+                break
+        self.buffer = self.buffer[offset:]
+
+    def startEntry(self, info):
+        for key, value in self.paxHeaders.iteritems():
+            if key == 'path':
+                info.name = value
+            elif key == 'mtime':
+                info.mtime = float(value)
+            elif key == 'size':
+                info.size = int(value)
+        self.paxHeaders = {}
+
+        self.info = info
+        self.remaining = info.size
+        self.padding = -info.size % tarfile.BLOCKSIZE
+        if info.type in (tarfile.XHDTYPE, tarfile.XGLTYPE):
+            self.data = []
+            return
+
+        parts = info.name.rstrip('/').split('/')
+        if info.name.startswith('/') or '..' in parts:
+            raise ValueError("invalid path in archive: %s" % info.name)
+        path = os.path.join(self.top, *parts)
+        if info.isdir():
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            # adjusted at the very end, after having added all contents
+            self.dirTimes.append((path, info))
+        elif info.isreg():
+            self.fd = open(path, 'wb')
+        self.info.path = path
+
+    def consumeData(self, offset):
+        count = min(self.remaining, len(self.buffer) - offset)
+        data = self.buffer[offset:offset + count]
+        if self.fd:
+            self.fd.write(data)
+        elif self.info.type in (tarfile.XHDTYPE, tarfile.XGLTYPE):
+            self.data.append(data)
+        self.remaining -= count
+        offset += count
+        if self.remaining > 0:
+            return offset
+
+        count = min(self.padding, len(self.buffer) - offset)
+        self.padding -= count
+        offset += count
+        if self.padding == 0:
+            self.finishEntry()
+        return offset
+
+    def finishEntry(self):
+        info, self.info = self.info, None
+        if info.type == tarfile.XHDTYPE:
+            self.paxHeaders = self.parsePaxHeaders("".join(self.data))
+        elif self.fd:
+            self.fd.close()
+            self.fd = None
+            os.chmod(info.path, info.mode)
+            os.utime(info.path, (info.mtime, info.mtime))
+
+    def parsePaxHeaders(self, data):
+        headers = {}
+        offset = 0
+        while offset < len(data):
+            length, rest = data[offset:].split(' ', 1)
+            record = data[offset:offset + int(length)]
+            key, value = record.split(' ', 1)[1][:-1].split('=', 1)
+            headers[key] = value
+            offset += int(length)
+        return headers
+
+    def close(self):
+        """ Adjusts the directories and checks that the archive is
+            complete.
+        """
+        if self.fd:
+            self.fd.close()
+            self.fd = None
+        if not self.finished:
+            raise ValueError("truncated archive")
+        for path, info in reversed(self.dirTimes):
+            os.chmod(path, info.mode)
+            os.utime(path, (info.mtime, info.mtime))
+
+
+def linkTree(src, dest):
+    """ Recreates the directory tree at src in the existing directory
+        dest. Files are hard linked, or copied where that's not possible,
+        i.e. across file systems. Same as in dtester.utils, which cannot
+        be imported here.
+    """
+    for root, dirs, files in os.walk(src):
+        target = os.path.join(dest, root[len(src) + 1:])
+        for name in dirs:
+            path = os.path.join(target, name)
+            if not os.path.isdir(path):
+                os.mkdir(path)
+        for name in files:
+            try:
+                os.link(os.path.join(root, name), os.path.join(target, name))
+            except OSError, e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise
+                shutil.copy2(os.path.join(root, name),
+                             os.path.join(target, name))
+
+
+def lockDirectory(path):
+    """ Takes an exclusive lock on the directory at path, by means of a
+        lock file next to it, without waiting. Returns the file descriptor
+        holding the lock, which gets released by closing it. Raises an
+        IOError, if the lock is held already. Same as in dtester.utils.
+    """
+    fd = os.open(path + ".lock", os.O_WRONLY | os.O_CREAT, 0644)
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError, e:
+        os.close(fd)
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+            raise IOError(e.errno, "Directory locked: %s" % path)
+        raise
+    return fd
+
+
 class CommandProcessor:
 
     def parseCommand(self, line):
@@ -15,83 +481,7 @@ class CommandProcessor:
             cmd = line
             rest = ""
 
-        # parse arguments
-        in_single_string = False
-        in_double_string = False
-        in_number = False
-        in_backslash = False
-        token = ""
-        args = []
-        for char in rest:
-            if char == "'" and not in_double_string and not in_number:
-                if not in_single_string:
-                    in_single_string = True
-                elif in_backslash:
-                    token += "'"
-                    in_backslash = False
-                else:
-                    args.append(token)
-                    in_single_string = False
-                    token = ""
-            elif char == '"' and not in_single_string and not in_number:
-                if not in_double_string:
-                    in_double_string = True
-                elif in_backslash:
-                    token += '"'
-                    in_backslash = False
-                else:
-                    args.append(token)
-                    in_double_string = False
-                    token = ""
-            elif char == "\\" and not in_backslash:
-                if in_single_string or in_double_string:
-                    in_backslash = True
-                else:
-                    self.logParserError("WARNING: invalid position for backslash, ignored!")
-            elif char in "-.0123456789" and not in_backslash:
-                if in_number or in_single_string or in_double_string:
-                    token += char
-                else:
-                    token += char
-                    in_number = True
-            else:
-                if in_backslash:
-                    if char == "n":
-                        token += "\n"
-                    elif char == "r":
-                        token += "\r"
-                    elif char == "t":
-                        token += "\t"
-                    elif char == "\\":
-                        token += "\\"
-                    else:
-                        self.logParserError("WARNING: unknown escape character: '%s'" % repr(char))
-                    in_backslash = False
-                elif in_single_string or in_double_string:
-                    token += char
-                elif in_number and char in ".0123456789+-e":
-                    token += char
-                else:
-                    if char in " \n\r\t":
-                        if in_number:
-                            if "." in token:
-                                args.append(float(token))
-                            else:
-                                args.append(int(token))
-                        token = ""
-                        in_number = False
-                    else:
-                        self.logParserError("invalid char outside of token: '%s' (in %s)" % (repr(char), repr(line)))
-
-        if in_number:
-            if "." in token or "e" in token:
-                args.append(float(token))
-            else:
-                args.append(int(token))
-        elif in_single_string or in_double_string:
-            self.logParserError("unterminated string at end of line: %s" % repr(token))
-            args.append(token)
-
+        args = parseArgs(rest, self.logParserError)
         self.processCommand(cmd, args)
 
     def processCommand(self, cmd, args):
@@ -192,18 +582,39 @@ class writePipeDispatcher(asyncore.file_dispatcher):
         self.closed = False
         self.buffer = ""
 
+        # callbacks to invoke once the data written before them has been
+        # sent, as (end offset, callback) tuples.
+        self.acks = []
+        self.total_buffered = 0
+        self.total_sent = 0
+        self.drain_callback = None
+
     def readable(self):
         return False
 
     def writable(self):
         return len(self.buffer) > 0
 
-    def write(self, data):
+    def write(self, data, ack=None):
         self.buffer += data
+        self.total_buffered += len(data)
+        if ack:
+            if self.total_sent == self.total_buffered:
+                ack()
+            else:
+                self.acks.append((self.total_buffered, ack))
 
     def handle_write(self):
         sent = self.send(self.buffer)
         self.buffer = self.buffer[sent:]
+        self.total_sent += sent
+        while len(self.acks) > 0 and self.acks[0][0] <= self.total_sent:
+            offset, ack = self.acks.pop(0)
+            ack()
+        if len(self.buffer) == 0 and self.drain_callback:
+            callback = self.drain_callback
+            self.drain_callback = None
+            callback()
 
     def handle_close(self):
         self.close()
@@ -215,11 +626,23 @@ class readCmdPipeDispatcher(readPipeDispatcher, CommandProcessor):
     def __init__(self, parent, fd, name, map=None):
         readPipeDispatcher.__init__(self, parent, fd, name, map=map)
         self.buffer = ""
+        self.decoder = None
 
     def handle_read(self):
-        data = self.recv(8192)
-        self.buffer += data
+        data = self.recv(65536)
+        # Replies to all of the commands read at once are sent together.
+        self.parent.beginReplies()
+        try:
+            self.processData(data)
+        finally:
+            self.parent.endReplies()
+
+    def processData(self, data):
+        if self.decoder:
+            self.processFrames(data)
+            return
 
+        self.buffer += data
         idx = self.buffer.find("\n")
         while idx >= 0:
             line = self.buffer[:idx]
@@ -227,17 +650,47 @@ class readCmdPipeDispatcher(readPipeDispatcher, CommandProcessor):
 
             # advance
             self.buffer = self.buffer[idx+1:]
+
+            if self.decoder:
+                # switched to the binary protocol, pass on the rest
+                data, self.buffer = self.buffer, ""
+                self.processFrames(data)
+                return
             idx = self.buffer.find("\n")
 
+    def processFrames(self, data):
+        try:
+            frames = self.decoder.feed(data)
+        except (ValueError, struct.error), e:
+            self.logParserError(str(e))
+            return
+        for cmd, args in frames:
+            self.processCommand(cmd, args)
+
     def logParserError(self, msg):
         self.parent.reportCmdError("parser error: %s" % msg)
 
     def processCommand(self, cmd, args):
-        if cmd == 'set_work_dir':
+        if cmd == 'use_protocol':
+            # switch to the binary protocol for all further commands and
+            # replies
+            if len(args) != 2 or args[1] != BINARY_PROTOCOL:
+                self.parent.reportCmdError('unsupported protocol')
+            else:
+                self.decoder = FrameDecoder()
+                self.parent.useProtocol(*args)
+        elif cmd == 'set_work_dir':
             if len(args) != 2:
                 self.parent.reportCmdError('work_dir expects exactly two arguments')
             else:
                 self.parent.setWorkDir(*args)
+        elif cmd == 'evlog_stream':
+            # stream event log records back, limited to the given number
+            # of bytes per second, zero meaning unlimited.
+            if len(args) != 2:
+                self.parent.reportCmdError('evlog_stream expects exactly two arguments')
+            else:
+                self.parent.startEvlogStream(*args)
         elif cmd == 'tear_down':
             if len(args) != 1:
                 self.parent.reportCmdError('tear_down expects exactly one argument')
@@ -279,6 +732,53 @@ class readCmdPipeDispatcher(readPipeDispatcher, CommandProcessor):
                 self.parent.reportCmdError('copy expects three or four arguments')
             else:
                 self.parent.startCopy(*args)
+        elif cmd == 'link_tree':
+            # recreate a directory tree with hard links to its files
+            if len(args) != 3:
+                self.parent.reportCmdError('link_tree expects exactly three arguments')
+            else:
+                self.parent.startLinkTree(*args)
+        elif cmd == 'lock_dir':
+            # lock a directory for exclusive use, until 'unlock_dir' or
+            # termination of the helper
+            if len(args) != 2:
+                self.parent.reportCmdError('lock_dir expects exactly two arguments')
+            else:
+                self.parent.startLockDir(*args)
+        elif cmd == 'unlock_dir':
+            if len(args) != 2:
+                self.parent.reportCmdError('unlock_dir expects exactly two arguments')
+            else:
+                self.parent.startUnlockDir(*args)
+        elif cmd == 'tar_pack':
+            # send an archive of a directory tree in 'tar_data' replies,
+            # each to be acknowledged by a 'tar_ack'
+            if len(args) < 3 or len(args) > 4:
+                self.parent.reportCmdError('tar_pack expects three or four arguments')
+            else:
+                self.parent.startTarPack(*args)
+        elif cmd == 'tar_ack':
+            if len(args) != 1:
+                self.parent.reportCmdError('tar_ack expects exactly one argument')
+            else:
+                self.parent.ackTarData(*args)
+        elif cmd == 'tar_unpack':
+            # unpack an archive sent by 'tar_feed' commands, each
+            # acknowledged by 'tar_fed', and terminated by 'tar_end'
+            if len(args) != 3:
+                self.parent.reportCmdError('tar_unpack expects exactly three arguments')
+            else:
+                self.parent.startTarUnpack(*args)
+        elif cmd == 'tar_feed':
+            if len(args) != 2:
+                self.parent.reportCmdError('tar_feed expects exactly two arguments')
+            else:
+                self.parent.feedTarData(*args)
+        elif cmd == 'tar_end':
+            if len(args) != 1:
+                self.parent.reportCmdError('tar_end expects exactly one argument')
+            else:
+                self.parent.endTarUnpack(*args)
         elif cmd == 'proc_prepare':
             # prepare a command to run
             if len(args) < 3:
@@ -308,6 +808,13 @@ class readCmdPipeDispatcher(readPipeDispatcher, CommandProcessor):
                 self.parent.reportCmdError('proc_write expects exactly one or two arguments')
             else:
                 self.parent.writeProcess(*args)
+        elif cmd == 'proc_feed':
+            # write to standard in of the process, acknowledged by
+            # 'proc_fed' as soon as the data has been passed on.
+            if len(args) != 2:
+                self.parent.reportCmdError('proc_feed expects exactly two arguments')
+            else:
+                self.parent.feedProcess(*args)
         elif cmd == 'proc_close_stdin':
             # start a prepared subprocess
             if len(args) != 1:
@@ -315,9 +822,10 @@ class readCmdPipeDispatcher(readPipeDispatcher, CommandProcessor):
             else:
                 self.parent.closeProcessStdin(*args)
         elif cmd == 'proc_stop':
-            # stop a running process
-            if len(args) != 1:
-                self.parent.reportCmdError('proc_stop expects exactly one argument')
+            # stop a running process, optionally following the given
+            # escalation schedule
+            if len(args) < 1 or len(args) > 2:
+                self.parent.reportCmdError('proc_stop expects one or two arguments')
             else:
                 self.parent.stopProcess(*args)
         elif cmd == 'proc_add_hook':
@@ -352,24 +860,22 @@ class ProcessMonitor:
         self.proc = None
 
         self.deferred_stdin_close = False
+        self.stop_timer = None
 
         # buffers input data sent before process started
         self.in_buffer = ""
+        self.in_buffer_acks = []
 
         self.hooks = {}
         self.hook_max_id = 1
 
-        self.env = copy.copy(os.environ)
+        self.env = dict(os.environ)
 
     def setWorkingDirectory(self, cwd):
         self.cwd = cwd
 
     def addEnvVar(self, name, value):
-        # perform substitution
-        for n, v in self.env.iteritems():
-            value = value.replace("$" + n, v)
-            value = value.replace("${" + n + "}", v)
-        self.env[name] = value
+        self.env[name] = substituteEnvVars(value, self.env)
 
     def start_subprocess(self, use_pty, use_shell):
         self.use_pty = use_pty
@@ -391,12 +897,14 @@ class ProcessMonitor:
                 self.master, slave = pty.openpty()
                 # ttyname = os.ttyname(slave)
                 self.proc = subprocess.Popen(self.cmdline, cwd=self.cwd, env=self.env, shell=use_shell,
-                    stdin=slave, stdout=slave, stderr=slave, close_fds=True)
+                    stdin=slave, stdout=slave, stderr=slave, close_fds=True,
+                    preexec_fn=os.setpgrp)
 
                 os.close(slave)
             else:
                 self.proc = subprocess.Popen(self.cmdline, cwd=self.cwd, env=self.env, shell=use_shell,
-                    stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                    stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                    preexec_fn=os.setpgrp)
         except exceptions.OSError, e:
             self.parent.reportJobFailed(self.jobid, e.strerror + (" (%s)" % repr(self.cmdline)))
             return
@@ -424,6 +932,9 @@ class ProcessMonitor:
         if len(self.in_buffer) > 0:
             self.in_pipe.write(self.in_buffer)
             self.in_buffer = ""
+        for ack in self.in_buffer_acks:
+            self.in_pipe.write("", ack)
+        self.in_buffer_acks = []
 
         if self.deferred_stdin_close:
             self.closeStdin()
@@ -431,10 +942,28 @@ class ProcessMonitor:
         if self.out_pipe.closed and self.err_pipe.closed:
             self.handle_process_terminated()
 
-    def stop_subprocess(self):
-        os.kill(self.proc.pid, signal.SIGINT)
-        # FIXME: should check whether or not the process terminated,
-        # possibly send a SIGKILL later on
+    def stop_subprocess(self, schedule=DEFAULT_STOP_SCHEDULE):
+        if self.stop_timer is None:
+            self.send_stop_signal(parseStopSchedule(schedule))
+
+    def send_stop_signal(self, steps):
+        """ Signals the process group, escalating to the next step of the
+            schedule unless the process terminates in time.
+        """
+        self.stop_timer = None
+        if self.proc.returncode is not None:
+            return
+
+        sig, timeout = steps[0]
+        try:
+            os.killpg(self.proc.pid, sig)
+        except exceptions.OSError, e:
+            # the process terminated in the meantime
+            return
+
+        if timeout is not None and len(steps) > 1:
+            self.stop_timer = self.parent.callLater(timeout,
+                self.send_stop_signal, steps[1:])
 
     def close_pipe(self, name):
         if self.out_pipe and self.err_pipe:
@@ -442,12 +971,27 @@ class ProcessMonitor:
                 self.handle_process_terminated()
 
     def handle_process_terminated(self):
+        if self.stop_timer is not None:
+            self.parent.cancelTimer(self.stop_timer)
+            self.stop_timer = None
+
+        # Reap the process via wait4 to get its resource usage, then let
+        # the Popen object know about the return code.
+        rusage = None
+        try:
+            pid, status, rusage = os.wait4(self.proc.pid, 0)
+            if os.WIFSIGNALED(status):
+                self.proc.returncode = -os.WTERMSIG(status)
+            else:
+                self.proc.returncode = os.WEXITSTATUS(status)
+        except exceptions.OSError, e:
+            pass
         retcode = self.proc.wait()
-        self.parent.processTerminated(self.jobid, retcode)
+        self.parent.processTerminated(self.jobid, retcode, rusage)
 
     def addHook(self, stream, hookid, pattern):
         if stream not in ('out', 'err'):
-            self.outfd.write("cmd_error 'no such stream'\n")
+            self.parent.reportCmdError('no such stream')
             return
         hook = {'id': hookid, 'stream': stream, 'pattern': re.compile(pattern)}
         self.hooks[hookid] = hook
@@ -477,17 +1021,24 @@ class ProcessMonitor:
                 if pattern.search(data):
                     self.parent.hookMatched(self.jobid, hook['id'], data)
 
-    def write(self, data):
+    def write(self, data, ack=None):
         if self.in_pipe:
-            self.in_pipe.write(data)
+            self.in_pipe.write(data, ack)
         else:
             self.in_buffer += data
+            if ack:
+                self.in_buffer_acks.append(ack)
 
     def closeStdin(self):
         if not self.proc:
             self.deferred_stdin_close = True
             return
 
+        # don't discard input not written, yet
+        if len(self.in_pipe.buffer) > 0 and not self.in_pipe.closed:
+            self.in_pipe.drain_callback = self.closeStdin
+            return
+
         self.in_pipe.handle_close()
 
         if self.use_pty:
@@ -499,33 +1050,189 @@ class ProcessMonitor:
             self.handle_process_terminated()
 
 
+# Maximum delay before compressed event log data gets synced to disk.
+EVLOG_SYNC_INTERVAL = 1.0
+
+
+class CompressedLog:
+    """ A zlib compressed log file. Data written gets flushed to a sync
+        point no later than EVLOG_SYNC_INTERVAL seconds after having been
+        written, so the log remains readable, even if the helper crashes.
+    """
+    def __init__(self, helper, path):
+        self.helper = helper
+        self.fd = open(path, "wb")
+        self.compressor = zlib.compressobj()
+        self.syncTimer = None
+
+    def write(self, data):
+        self.fd.write(self.compressor.compress(data))
+        if self.syncTimer is None:
+            self.syncTimer = self.helper.callLater(EVLOG_SYNC_INTERVAL,
+                                                   self.sync)
+
+    def sync(self):
+        self.syncTimer = None
+        self.fd.write(self.compressor.flush(zlib.Z_SYNC_FLUSH))
+        self.fd.flush()
+
+    def close(self):
+        if self.syncTimer is not None:
+            self.helper.cancelTimer(self.syncTimer)
+            self.syncTimer = None
+        self.fd.write(self.compressor.flush(zlib.Z_FINISH))
+        self.fd.close()
+
+
+# Interval for sending streamed event log records and the maximum size
+# of a single batch of records.
+EVLOG_STREAM_INTERVAL = 0.2
+EVLOG_STREAM_BATCH_SIZE = 65536
+
+
+class EventLogStreamer:
+    """ Sends event log records back to the controller in batches of
+        'evlog_records' messages, in the same text format as the event
+        log. The optional rate limit in bytes per second may delay
+        records, but they never get dropped.
+    """
+    def __init__(self, helper, max_rate):
+        self.helper = helper
+        self.max_rate = max_rate
+        self.allowance = max_rate * EVLOG_STREAM_INTERVAL
+        self.last_flush = time.time()
+        self.buffer = []
+        self.flushTimer = None
+
+    def append(self, record):
+        self.buffer.append(record)
+        if self.flushTimer is None:
+            self.flushTimer = self.helper.callLater(EVLOG_STREAM_INTERVAL,
+                                                    self.flush)
+
+    def flush(self):
+        self.flushTimer = None
+        now = time.time()
+        if self.max_rate > 0:
+            # allows bursts of up to a second worth of data
+            self.allowance = min(self.max_rate, self.allowance +
+                                 (now - self.last_flush) * self.max_rate)
+            count = 0
+            while count < len(self.buffer) and self.allowance > 0:
+                self.allowance -= len(self.buffer[count])
+                count += 1
+        else:
+            count = len(self.buffer)
+        self.last_flush = now
+
+        self.send(self.buffer[:count])
+        self.buffer = self.buffer[count:]
+        if len(self.buffer) > 0:
+            self.flushTimer = self.helper.callLater(EVLOG_STREAM_INTERVAL,
+                                                    self.flush)
+
+    def send(self, records):
+        batch = []
+        size = 0
+        for record in records:
+            batch.append(record)
+            size += len(record)
+            if size >= EVLOG_STREAM_BATCH_SIZE:
+                self.helper.report("evlog_records", "".join(batch))
+                batch = []
+                size = 0
+        if len(batch) > 0:
+            self.helper.report("evlog_records", "".join(batch))
+
+    def finish(self):
+        """ Sends all remaining records, regardless of the rate limit.
+        """
+        if self.flushTimer is not None:
+            self.helper.cancelTimer(self.flushTimer)
+            self.flushTimer = None
+        self.send(self.buffer)
+        self.buffer = []
+
+
 class Helper:
     def __init__(self, cmdfd, outfd):
         self.cmdfd = cmdfd
         self.outfd = outfd
         self.pcmd = readCmdPipeDispatcher(self, cmdfd, name="__cmd")
         self.evlog = None
+        self.evlogStream = None
+        self.binary = False
+
+        # while collecting replies, successfully completed jobs are
+        # reported in a single 'done_jobs' message
+        self.replyDepth = 0
+        self.doneJobs = []
 
         self.jobs = {}
         self.workdir = None
 
+        # archives being sent, as [chunk iterator, chunks in flight], and
+        # unpackers of archives being received, by job id
+        self.tarPacks = {}
+        self.tarUnpacks = {}
+
+        # file descriptors holding directory locks, by path
+        self.dirLocks = {}
+
+        # pending timers as [time, callback, args] lists, sorted by time
+        self.timers = []
+
     def run(self):
         # get system information and send as part of 'hello'
         system, hostname, release, version, machine, processor = platform.uname()
-        self.outfd.write("hello %s %s %s %s %s %s\n" % (repr(hostname), repr(system), repr(release), repr(version), repr(machine), repr(os.sep)))
+        self.outfd.write("hello %s %s %s %s %s %s %s\n" % (repr(hostname), repr(system), repr(release), repr(version), repr(machine), repr(os.sep), repr(BINARY_PROTOCOL)))
         self.outfd.flush()
         try:
-            asyncore.loop()
+            while asyncore.socket_map:
+                timeout = 30.0
+                if len(self.timers) > 0:
+                    timeout = max(0.0, self.timers[0][0] - time.time())
+                asyncore.loop(timeout=timeout, count=1)
+                self.runTimers()
         except KeyboardInterrupt:
             self.outfd.write("\n")
 
+    def callLater(self, delay, callback, *args):
+        timer = [time.time() + delay, callback, args]
+        self.timers.append(timer)
+        self.timers.sort(key=lambda t: t[0])
+        return timer
+
+    def cancelTimer(self, timer):
+        if timer in self.timers:
+            self.timers.remove(timer)
+
+    def runTimers(self):
+        now = time.time()
+        while len(self.timers) > 0 and self.timers[0][0] <= now:
+            when, callback, args = self.timers.pop(0)
+            callback(*args)
+
     def close_pipe(self, name):
         if name == "__cmd":
             self.terminate()
 
     def evlogAppend(self, jobid, channel, log_data):
         t = time.time()
-        self.evlog.write("%d:%d:%s:%s\n" % (t, jobid, channel, repr(log_data)))
+        record = "%.6f:%d:%s:%s\n" % (t, jobid, channel, repr(log_data))
+        self.evlog.write(record)
+        if self.evlogStream:
+            self.evlogStream.append(record)
+
+    def startEvlogStream(self, jobid, max_rate):
+        """ Starts streaming all further event log records to the
+            controller, in addition to writing them to the event log.
+        """
+        if self.evlogStream:
+            self.reportJobFailed(jobid, "event log already streamed.")
+        else:
+            self.evlogStream = EventLogStreamer(self, max_rate)
+            self.reportJobDone(jobid)
 
     def setWorkDir(self, jobid, path):
         """ This is the main initialization call and should only be issued
@@ -545,7 +1252,7 @@ class Helper:
             os.makedirs(path)
             os.chdir(path)
 
-            self.evlog = open("event.log", "w")
+            self.evlog = CompressedLog(self, "event.log.z")
             self.evlogAppend(0, 'out', "started in %s\n" % self.workdir)
 
         except exceptions.OSError, e:
@@ -566,8 +1273,8 @@ class Helper:
         def y(etype, abs_path):
             st = os.stat(abs_path)
             ppath = abs_path[len(top)+1:]
-            self.reportLine("list_%s %d %s %f %f %f" % (
-                etype, jobid, repr(ppath), st.st_atime, st.st_mtime, st.st_ctime))
+            self.report("list_" + etype, jobid, ppath, st.st_atime,
+                        st.st_mtime, st.st_ctime, st.st_size)
 
         try:
             assert not top.endswith('/')
@@ -644,6 +1351,81 @@ class Helper:
         else:
             self.reportJobDone(jobid)
 
+    def startLinkTree(self, jobid, src, dest):
+        try:
+            linkTree(src, dest)
+        except (IOError, OSError), e:
+            self.reportJobFailed(jobid, str(e))
+        else:
+            self.reportJobDone(jobid)
+
+    def startLockDir(self, jobid, path):
+        if path in self.dirLocks:
+            self.reportJobFailed(jobid, "Directory locked: %s" % path)
+            return
+        try:
+            self.dirLocks[path] = lockDirectory(path)
+        except (IOError, OSError), e:
+            self.reportJobFailed(jobid, str(e))
+        else:
+            self.reportJobDone(jobid)
+
+    def startUnlockDir(self, jobid, path):
+        if path not in self.dirLocks:
+            self.reportJobFailed(jobid, "Directory not locked: %s" % path)
+            return
+        os.close(self.dirLocks.pop(path))
+        self.reportJobDone(jobid)
+
+    def startTarPack(self, jobid, path, compress, ignore=None):
+        packer = TreePacker(path, ignore, compress)
+        self.tarPacks[jobid] = [packer.chunks(), 0]
+        self.sendTarData(jobid)
+
+    def sendTarData(self, jobid):
+        state = self.tarPacks[jobid]
+        while state[1] < TAR_WINDOW:
+            try:
+                data = state[0].next()
+            except StopIteration:
+                del self.tarPacks[jobid]
+                self.reportJobDone(jobid)
+                return
+            except (IOError, OSError), e:
+                del self.tarPacks[jobid]
+                self.reportJobFailed(jobid, str(e))
+                return
+            self.report("tar_data", jobid, data)
+            state[1] += 1
+
+    def ackTarData(self, jobid):
+        if jobid in self.tarPacks:
+            self.tarPacks[jobid][1] -= 1
+            self.sendTarData(jobid)
+
+    def startTarUnpack(self, jobid, path, compress):
+        self.tarUnpacks[jobid] = TreeUnpacker(path, compress)
+
+    def feedTarData(self, jobid, data):
+        # Data for an archive that failed to unpack is dropped, but still
+        # acknowledged.
+        if jobid in self.tarUnpacks:
+            try:
+                self.tarUnpacks[jobid].write(data)
+            except Exception, e:
+                del self.tarUnpacks[jobid]
+                self.reportJobFailed(jobid, str(e))
+        self.report("tar_fed", jobid)
+
+    def endTarUnpack(self, jobid):
+        if jobid in self.tarUnpacks:
+            try:
+                self.tarUnpacks.pop(jobid).close()
+            except Exception, e:
+                self.reportJobFailed(jobid, str(e))
+            else:
+                self.reportJobDone(jobid)
+
     def prepareProcess(self, jobid, output_type, *cmdline):
         self.jobs[jobid] = ProcessMonitor(self, jobid, output_type, cmdline)
         # no confirmation required
@@ -660,9 +1442,9 @@ class Helper:
         self.jobs[jobid].start_subprocess(use_pty, use_shell)
         # returns pid as soon as fork() terminated
 
-    def stopProcess(self, jobid):
+    def stopProcess(self, jobid, schedule=DEFAULT_STOP_SCHEDULE):
         try:
-            self.jobs[jobid].stop_subprocess()
+            self.jobs[jobid].stop_subprocess(schedule)
             # no confirmation required, process will trigger done anyway
         except Exception, e:
             self.reportJobFailed(jobid, "failed stopping process: " + str(e))
@@ -670,58 +1452,106 @@ class Helper:
     def writeProcess(self, jobid, data):
         self.jobs[jobid].write(data)
 
+    def feedProcess(self, jobid, data):
+        self.jobs[jobid].write(data, lambda: self.report("proc_fed", jobid))
+
     def closeProcessStdin(self, jobid):
         self.jobs[jobid].closeStdin()
 
     def addProcessHook(self, jobid, stream, hookid, pattern):
         self.jobs[jobid].addHook(stream, hookid, pattern)
-        self.reportLine("hook_added %d %d" % (jobid, hookid))
+        self.report("hook_added", jobid, hookid)
 
     def dropProcessHook(self, jobid, hookid):
         self.jobs[jobid].dropHook(hookid)
-        self.reportLine("hook_dropped %d %d" % (jobid, hookid))
+        self.report("hook_dropped", jobid, hookid)
 
     # called from the ProcessMonitor
     def gotProcessPid(self, jobid, pid):
-        self.reportLine("proc_pid %d %d" % (jobid, pid))
-
-    def processTerminated(self, jobid, retcode):
+        self.report("proc_pid", jobid, pid)
+
+    def processTerminated(self, jobid, retcode, rusage=None):
+        if rusage is not None:
+            self.report("proc_rusage",
+                jobid, rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss,
+                rusage.ru_nvcsw, rusage.ru_nivcsw, rusage.ru_inblock,
+                rusage.ru_oublock)
         self.reportJobDone(jobid, retcode)
 
     def hookMatched(self, jobid, hookid, line):
-        self.reportLine("hook_matched %d %d %s" % (jobid, hookid, repr(line)))
+        self.report("hook_matched", jobid, hookid, line)
 
 
 
     def reportCmdError(self, msg):
-        self.reportLine("cmd_error %s" % repr(msg))
+        self.report("cmd_error", msg)
 
     def reportJobDone(self, jobid, retcode=0):
-        if retcode == 0:
-            self.reportLine("done %d" % jobid)
+        if retcode != 0:
+            self.report("done", jobid, retcode)
+        elif self.replyDepth > 0:
+            self.doneJobs.append(jobid)
         else:
-            self.reportLine("done %d %d" % (jobid, retcode))
+            self.report("done", jobid)
 
     def reportJobFailed(self, jobid, msg):
-        self.reportLine("failed %d %s" % (jobid, repr(msg)))
+        self.report("failed", jobid, msg)
 
-    def reportLine(self, msg):
-        self.outfd.write(msg + "\n")
-        self.outfd.flush()
+    def report(self, cmd, *args):
+        if self.binary:
+            self.outfd.write(encodeFrame(cmd, args))
+        elif len(args) > 0:
+            self.outfd.write("%s %s\n" % (cmd, formatArgs(args)))
+        else:
+            self.outfd.write(cmd + "\n")
+        if self.replyDepth == 0:
+            self.outfd.flush()
+
+    def beginReplies(self):
+        """ Starts collecting replies, rather than flushing each one.
+        """
+        self.replyDepth += 1
+
+    def endReplies(self):
+        self.replyDepth -= 1
+        if self.replyDepth == 0:
+            self.reportDoneJobs()
+            self.outfd.flush()
+
+    def reportDoneJobs(self):
+        jobs, self.doneJobs = self.doneJobs, []
+        if len(jobs) == 1:
+            self.report("done", jobs[0])
+        elif len(jobs) > 1:
+            self.report("done_jobs", *jobs)
+
+    def useProtocol(self, jobid, protocol):
+        """ Acknowledges switching to the binary protocol, the last reply
+            in text form.
+        """
+        self.reportDoneJobs()
+        self.report("protocol", jobid, protocol)
+        self.binary = True
 
     def terminate(self):
+        if self.evlog is None:
+            # already terminated by tear_down
+            return
         self.evlogAppend(0, 'out', "cleaning up %s\n" % self.workdir)
         for root, dirs, files in os.walk(self.workdir, topdown=False):
             for name in files:
                 path = os.path.join(root, name)
                 assert path.startswith(self.workdir)
                 path = path[len(self.workdir)+1:]
-                if path == "event.log":
+                if path == "event.log.z":
                     continue
                 self.evlogAppend(0, 'out', "WARNING: undeleted file: %s\n" % path)
 
         self.evlog.close()
         self.evlog = None
+        if self.evlogStream:
+            self.evlogStream.finish()
+            self.evlogStream = None
 
 
 if __name__ == "__main__":